@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the POSCAR/CONTCAR parser on a synthetic structure and report throughput
+"""
+
+from argparse import ArgumentParser
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from vasptypes import Poscar
+import vasptypes
+from synthetic import write_synthetic_contcar
+
+
+def execute(arguments):
+    parser = ArgumentParser(description='Time Poscar.from_file on a synthetic CONTCAR')
+    parser.add_argument('-n', '--ions', type=int, default=1000000, help='Number of ions <DEFAULT 1000000>')
+    parser.add_argument('-r', '--repeats', type=int, default=3, help='Number of timed parses <DEFAULT 3>')
+    parser.add_argument('--no_selective', action='store_true', help='Omit selective dynamics flags')
+    parser.add_argument('--no_velocities', action='store_true', help='Omit the velocity block')
+    parser.add_argument('--tokenize', action='store_true',
+                        help='Tokenize every block instead of converting fixed width columns')
+    args = parser.parse_args(arguments)
+    if args.tokenize:
+        vasptypes._FIXED_MIN_ROWS = sys.maxsize
+
+    with TemporaryDirectory() as tmp:
+        path = Path(tmp, 'CONTCAR')
+        write_synthetic_contcar(path, args.ions, not(args.no_selective), not(args.no_velocities))
+        size = path.stat().st_size
+        times = []
+        for _ in range(args.repeats):
+            start = perf_counter()
+            Poscar.from_file(path, cache=False)
+            times.append(perf_counter() - start)
+
+    best = min(times)
+    print( f'{args.ions} ions, {size/1e6:.1f} MB: best {best:.3f} s, {size/1e6/best:.1f} MB/s' )
+
+
+if __name__ == "__main__":
+    execute(sys.argv[1:])
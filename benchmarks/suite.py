@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+"""
+Time the hot paths of vapack on synthetic inputs and compare with a baseline
+
+Each benchmark is timed as the median of several runs, then run once more
+under tracemalloc for its peak memory. Results are written as JSON. Against
+a baseline, a benchmark regresses when its median is slower by more than
+the time tolerance or it peaks higher by more than the memory tolerance.
+Regressed benchmarks are run again a few times, so one noisy run does not
+fail the suite, and any regression that persists exits with status 1. Times
+are scaled by a calibration loop run on both machines, so a baseline
+recorded on one laptop is usable on another. The versions of Python and
+numpy change the speed of the hot paths in ways calibration cannot follow,
+so they are stored with the results and a baseline of other versions is
+refused with status 2. A baseline is best recorded over several rounds of the suite, in
+the environment of environment.yml. Everything runs offline in a temporary
+directory, including the cache.
+"""
+
+from argparse import ArgumentParser
+from datetime import datetime
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import json
+import numpy as np
+import os
+import platform
+import sys
+import tracemalloc
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from vasptypes import Poscar, Potcar, Oszicar
+from vasptypes_extension import box_select, chain_select, center_around, interpolate_path
+import inkit
+from synthetic import synthetic_poscar, write_synthetic_poscar, write_synthetic_oszicar,\
+                      write_synthetic_templates, write_synthetic_potentials
+
+
+BASELINE = Path(__file__).resolve().parent / 'baseline.json'
+RESULTS_VERSION = 2
+# Structure sizes of a normal run, and the largest added by --full
+SIZES = [10, 1000, 100000]
+FULL_SIZES = [1000000]
+# Differences below these are noise, whatever the tolerance
+TIME_FLOOR = 0.005
+MEMORY_FLOOR = 64 << 10
+
+
+def bench_from_file(directory:Path, n:int):
+    path = Path(directory, f'POSCAR_{n}')
+    write_synthetic_poscar(path, n)
+    return lambda: Poscar.from_file(path, cache=False)
+
+def bench_from_file_cached(directory:Path, n:int):
+    path = Path(directory, f'POSCAR_{n}')
+    write_synthetic_poscar(path, n)
+    Poscar.from_file(path)
+    return lambda: Poscar.from_file(path)
+
+def bench_to_string(directory:Path, n:int):
+    poscar = synthetic_poscar(n)
+    return poscar.to_string
+
+def bench_convert(directory:Path, n:int):
+    poscar = synthetic_poscar(n)
+    return lambda: poscar.copy()._convert_to_cartesian()
+
+def bench_box_select(directory:Path, n:int):
+    poscar = synthetic_poscar(n)
+    return lambda: box_select(poscar, [0.25, 0.75], [0.25, 0.75], [0.25, 0.75])
+
+def bench_chain_select(directory:Path, n:int):
+    poscar = synthetic_poscar(n)
+    return lambda: chain_select(poscar, 0, 2.0, extent=10)
+
+def bench_center_around(directory:Path, n:int):
+    poscar = synthetic_poscar(n)
+    return lambda: center_around(poscar, n // 2)
+
+def bench_interpolate(directory:Path, n:int):
+    start = synthetic_poscar(n)
+    rng = np.random.default_rng(1)
+    end = start.copy(positions=start.positions + rng.normal(0, 0.01, start.positions.shape))
+    return lambda: interpolate_path(start, end, 5)
+
+def bench_potcar(directory:Path, size:int):
+    potcar = Potcar(['Fe', 'O', 'H'], write_synthetic_potentials(Path(directory, 'potentials'), size))
+    output = Path(directory, 'POTCAR')
+    return lambda: potcar.generate_file(output)
+
+def bench_oszicar(directory:Path, steps:int):
+    path = Path(directory, f'OSZICAR_{steps}')
+    write_synthetic_oszicar(path, steps)
+    return lambda: Oszicar(path)
+
+def bench_inkit_merge(directory:Path, count:int):
+    template_dir = Path(directory, f'templates_{count}')
+    paths = write_synthetic_templates(template_dir, count)
+    # Compile the templates once, as any run after the first finds them cached
+    inkit.load_templates(paths, template_dir)
+    return lambda: inkit.format_incar(inkit.merge_templates(inkit.load_templates(paths, template_dir)))
+
+
+# Name, setup function, sizes of a normal run, and sizes added by --full
+BENCHMARKS = [
+    ('poscar.from_file', bench_from_file, SIZES, FULL_SIZES),
+    ('poscar.from_file.cached', bench_from_file_cached, SIZES, FULL_SIZES),
+    ('poscar.to_string', bench_to_string, SIZES, FULL_SIZES),
+    ('poscar.convert', bench_convert, SIZES, FULL_SIZES),
+    ('box_select', bench_box_select, SIZES, FULL_SIZES),
+    ('chain_select', bench_chain_select, SIZES, FULL_SIZES),
+    ('center_around', bench_center_around, SIZES, FULL_SIZES),
+    ('interpolate', bench_interpolate, SIZES, FULL_SIZES),
+    ('potcar.generate_file', bench_potcar, [1 << 20], [16 << 20]),
+    ('oszicar', bench_oszicar, [100, 10000], [100000]),
+    ('inkit.merge', bench_inkit_merge, [2, 10, 50], [500]),
+]
+
+
+def environment() -> dict:
+    '''
+    Versions a baseline is only valid for
+    '''
+    return {'python': platform.python_version(), 'numpy': np.__version__}
+
+
+def environment_differences(baseline:dict) -> list:
+    '''
+    Return a description of each version that differs between this environment
+    and that of a baseline. Python is compared by its minor version.
+    '''
+    differences = []
+    for name, version in environment().items():
+        other = baseline.get('environment', {}).get(name)
+        if name == 'python' and other is not None:
+            same = version.split('.')[:2] == other.split('.')[:2]
+        else:
+            same = version == other
+        if not( same ):
+            differences.append(f'{name} {version} against {other or "unknown"}')
+    return differences
+
+
+def calibrate(repeats:int=9) -> float:
+    '''
+    Time a fixed mix of interpreted and numpy work, the yardstick for the speed
+    of a machine, as the median of several runs
+    '''
+    rng = np.random.default_rng(0)
+    values = rng.random(1 << 20)
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        np.sort(values)
+        sum( i * i for i in range(1 << 18) )
+        ' '.join( f'{v:.8f}' for v in values[:1 << 16] ).split()
+        times.append(perf_counter() - start)
+    return float(np.median(times))
+
+
+def measure(function, repeats:int) -> dict:
+    '''
+    Return the best and median time of repeated calls, and the peak traced memory of one more
+    '''
+    times = []
+    for _ in range(repeats):
+        start = perf_counter()
+        function()
+        times.append(perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(times), 'median': float(np.median(times)), 'peak_bytes': peak, 'repeats': repeats}
+
+
+def run(pattern:str=None, full:bool=False, repeats:int=5, verbose:bool=True, keys:list=None) -> dict:
+    '''
+    Run every benchmark whose name contains pattern, or only those with the
+    given name/size keys, returning the results document
+    '''
+    cache_directory = os.environ.get('VAPACK_CACHE_DIR')
+    # Calibrate on both sides of the run, as the speed of a machine drifts
+    calibration = calibrate()
+    with TemporaryDirectory() as directory:
+        # Keep the cache of the benchmarks away from the user's
+        os.environ['VAPACK_CACHE_DIR'] = str(Path(directory, 'cache'))
+        try:
+            results = _run(Path(directory), pattern, full, repeats, verbose, keys)
+        finally:
+            if cache_directory is None:
+                del os.environ['VAPACK_CACHE_DIR']
+            else:
+                os.environ['VAPACK_CACHE_DIR'] = cache_directory
+    return {
+        'version': RESULTS_VERSION,
+        'created': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': environment(),
+        'machine': {'platform': platform.platform(), 'processor': platform.machine()},
+        'calibration': (calibration + calibrate()) / 2,
+        'results': results,
+    }
+
+
+def _run(directory:Path, pattern:str, full:bool, repeats:int, verbose:bool, keys:list=None) -> dict:
+    results = {}
+    for name, setup, sizes, full_sizes in BENCHMARKS:
+        if pattern is not None and not( pattern in name ):
+            continue
+        for size in sizes + (full_sizes if full or keys is not None else []):
+            key = f'{name}/{size}'
+            if keys is not None and not( key in keys ):
+                continue
+            result = measure(setup(directory, size), repeats)
+            results[key] = result
+            if verbose:
+                print(f"{key:<36} {result['median']*1e3:>11.3f} ms "
+                      f"{result['peak_bytes']/(1 << 20):>10.2f} MiB", file=sys.stderr)
+    return results
+
+
+def combine(documents:list) -> dict:
+    '''
+    Merge the results of several rounds of the suite into one document, keeping
+    the median time and calibration and the largest peak of each benchmark
+    '''
+    combined = dict(documents[-1], calibration=float(np.median([ d['calibration'] for d in documents ])))
+    results = {}
+    for key in documents[-1]['results']:
+        rounds = [ d['results'][key] for d in documents if key in d['results'] ]
+        results[key] = {'seconds': min( r['seconds'] for r in rounds ),
+                        'median': float(np.median([ r['median'] for r in rounds ])),
+                        'peak_bytes': max( r['peak_bytes'] for r in rounds ),
+                        'repeats': sum( r['repeats'] for r in rounds )}
+    combined['results'] = results
+    return combined
+
+
+def compare(current:dict, baseline:dict, time_tolerance:float=0.5, memory_tolerance:float=0.25) -> list:
+    '''
+    Return the key and a description of each benchmark in both documents that
+    regressed, comparing median times after scaling the baseline by the
+    relative speed of the machines
+    '''
+    scale = current['calibration'] / baseline['calibration']
+    regressions = []
+    for key, result in current['results'].items():
+        if not( key in baseline['results'] ):
+            continue
+        base = baseline['results'][key]
+        expected = base['median'] * scale
+        if result['median'] > max(expected * (1 + time_tolerance), expected + TIME_FLOOR):
+            regressions.append((key, f"{result['median']*1e3:.3f} ms against {expected*1e3:.3f} ms"))
+        if result['peak_bytes'] > max(base['peak_bytes'] * (1 + memory_tolerance),
+                                      base['peak_bytes'] + MEMORY_FLOOR):
+            regressions.append((key, f"peak {result['peak_bytes']/(1 << 20):.2f} MiB "
+                                     f"against {base['peak_bytes']/(1 << 20):.2f} MiB"))
+    return regressions
+
+
+def execute(arguments):
+    parser = ArgumentParser(description='Benchmark vapack on synthetic inputs and check for regressions')
+    parser.add_argument('-k', '--pattern', type=str, help='Only run benchmarks whose name contains this')
+    parser.add_argument('-f', '--full', action='store_true', help='Also run the largest sizes, up to 10^6 ions')
+    parser.add_argument('-r', '--repeats', type=int, default=5, help='Number of timed runs of each benchmark <DEFAULT 5>')
+    parser.add_argument('-n', '--rounds', type=int, default=1,
+                        help='Number of runs of the whole suite, keeping the median of each benchmark <DEFAULT 1>')
+    parser.add_argument('--retries', type=int, default=2,
+                        help='Number of times to run regressed benchmarks again before failing <DEFAULT 2>')
+    parser.add_argument('-o', '--output', type=str, help='Write the results to this JSON file')
+    parser.add_argument('-b', '--baseline', type=str, default=str(BASELINE),
+                        help=f'Baseline to compare against <DEFAULT {BASELINE.name}>')
+    parser.add_argument('-s', '--save_baseline', action='store_true',
+                        help='Write the results to the baseline instead of comparing')
+    parser.add_argument('-t', '--time_tolerance', type=float, default=0.5,
+                        help='Allowed fractional slowdown <DEFAULT 0.5>')
+    parser.add_argument('-m', '--memory_tolerance', type=float, default=0.25,
+                        help='Allowed fractional growth of peak memory <DEFAULT 0.25>')
+    args = parser.parse_args(arguments)
+
+    baseline_path = Path(args.baseline)
+    baseline = json.loads(baseline_path.read_text()) if baseline_path.is_file() else None
+    if not( args.save_baseline ) and baseline is not None:
+        differences = environment_differences(baseline)
+        if len(differences) > 0:
+            print(f"Not comparing with a baseline of another environment: {', '.join(differences)}")
+            print('Run the suite in the environment of environment.yml, or record a baseline with --save_baseline')
+            return 2
+
+    current = combine([ run(args.pattern, args.full, args.repeats) for _ in range(max(1, args.rounds)) ])
+    if args.output is not None:
+        Path(args.output).write_text(json.dumps(current, indent=2) + '\n')
+
+    if args.save_baseline:
+        # Keep the baseline of benchmarks that were not run this time, if it is of the same environment
+        if baseline is not None and len(environment_differences(baseline)) == 0:
+            scale = current['calibration'] / baseline['calibration']
+            for key, result in baseline['results'].items():
+                if not( key in current['results'] ):
+                    current['results'][key] = dict(result, seconds=result['seconds'] * scale,
+                                                   median=result['median'] * scale)
+        baseline_path.write_text(json.dumps(current, indent=2) + '\n')
+        print(f"Saved {len(current['results'])} results to {baseline_path}")
+        return 0
+    if baseline is None:
+        print(f'No baseline at {baseline_path}, record one with --save_baseline')
+        return 0
+
+    regressions = compare(current, baseline, args.time_tolerance, args.memory_tolerance)
+    for _ in range(args.retries):
+        keys = sorted(set( key for key, _ in regressions ))
+        if len(keys) == 0:
+            break
+        print(f'Running {len(keys)} regressed benchmarks again', file=sys.stderr)
+        again = run(keys=keys, repeats=args.repeats)
+        # Keep the better of each attempt on this machine, as noise only ever slows a run down
+        for key, result in again['results'].items():
+            previous = current['results'][key]
+            previous['median'] = min(previous['median'], result['median'])
+            previous['peak_bytes'] = min(previous['peak_bytes'], result['peak_bytes'])
+        regressions = compare(current, baseline, args.time_tolerance, args.memory_tolerance)
+    for key, regression in regressions:
+        print(f'Regression {key}: {regression}')
+    if len(regressions) > 0:
+        return 1
+    print(f"No regressions in {len(current['results'])} benchmarks")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(execute(sys.argv[1:]))
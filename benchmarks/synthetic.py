@@ -0,0 +1,148 @@
+"""
+Generators of synthetic inputs for the benchmarks
+
+Everything is generated from a seed, so runs are repeatable and need no
+VASP installation, potentials, or network access.
+"""
+
+from pathlib import Path
+import numpy as np
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from vasptypes import Poscar
+
+
+# Ions per cubic Angstrom of the synthetic structures, close to that of a solid
+DENSITY = 0.08
+# Fraction of each species in the synthetic structures
+SPECIES = {'Fe': 0.5, 'O': 0.3, 'H': 0.2}
+# Header fields of the synthetic potentials, as they appear in a POTCAR
+POTENTIALS = {
+    'Fe': {'titel': 'PAW_PBE Fe 06Sep2000', 'zval': 8.0, 'enmax': 267.882, 'enmin': 200.911, 'pomass': 55.847},
+    'O':  {'titel': 'PAW_PBE O 08Apr2002', 'zval': 6.0, 'enmax': 400.0, 'enmin': 300.0, 'pomass': 16.0},
+    'H':  {'titel': 'PAW_PBE H 15Jun2001', 'zval': 1.0, 'enmax': 250.0, 'enmin': 200.0, 'pomass': 1.0},
+}
+# Tags and values the synthetic INCAR templates draw from
+INCAR_TAGS = {
+    'ENCUT': [400, 450, 500, 520, 600], 'EDIFF': [1e-4, 1e-5, 1e-6], 'ISMEAR': [0, 1, -5],
+    'SIGMA': [0.01, 0.05, 0.1], 'ALGO': ['Normal', 'Fast', 'All'], 'PREC': ['Normal', 'Accurate'],
+    'NSW': [0, 100, 500], 'IBRION': [-1, 1, 2], 'ISIF': [2, 3], 'POTIM': [0.5, 1.0],
+    'LREAL': ['Auto', '.FALSE.'], 'LWAVE': ['.FALSE.', '.TRUE.'], 'LCHARG': ['.FALSE.', '.TRUE.'],
+    'NELM': [60, 100], 'ISPIN': [1, 2], 'NPAR': [2, 4, 8], 'KPAR': [1, 2], 'TEBEG': [300, 600],
+}
+SECTIONS = ['Initialization', 'Electronic', 'Ionic', 'Algorithms', 'Output', 'Optimizations']
+
+
+def write_synthetic_contcar(path:Path, n:int, selective_dynamics:bool=True,
+                            velocities:bool=True, seed:int=0) -> None:
+    '''
+    Write a CONTCAR-like file with n ions, in the layout VASP itself writes
+    '''
+    rng = np.random.default_rng(seed)
+    header = 'Synthetic\n   1.00000000000000\n'
+    header += ''.join( '  {:22.16f}{:22.16f}{:22.16f}\n'.format(*v) for v in np.diag([40.0]*3) )
+    header += '   Fe   O\n'
+    header += ' {:>6d} {:>6d}\n'.format(n - n//2, n//2)
+    header += 'Selective dynamics\n' if selective_dynamics else ''
+    header += 'Direct\n'
+    with path.open('w') as f:
+        f.write(header)
+        fmt = '{:20.16f}{:20.16f}{:20.16f}' + ('   T   T   F' if selective_dynamics else '') + '\n'
+        for chunk in np.array_split(rng.random((n,3)), max(1, n//100000)):
+            f.write(''.join( fmt.format(*r) for r in chunk ))
+        if velocities:
+            f.write('\n')
+            for chunk in np.array_split(rng.normal(0, 1e-3, (n,3)), max(1, n//100000)):
+                f.write(''.join( '{:16.8E}{:16.8E}{:16.8E}\n'.format(*r) for r in chunk ))
+
+
+def synthetic_poscar(n:int, seed:int=0, selective_dynamics:bool=True) -> Poscar:
+    '''
+    Return a random structure of n ions at solid density in a slightly
+    triclinic cell, mixing the species in the proportions of SPECIES
+    '''
+    rng = np.random.default_rng(seed)
+    length = (n / DENSITY)**(1/3)
+    lattice = length * np.array([[1.0, 0.0, 0.0], [0.1, 1.0, 0.0], [0.0, 0.1, 1.0]])
+    counts = [ int(n * fraction) for fraction in SPECIES.values() ]
+    counts[0] += n - sum(counts)
+    species = { name:count for name, count in zip(SPECIES, counts) if count > 0 }
+    dynamics = np.ones((n,3), dtype=bool)
+    dynamics[::4] = False
+    return Poscar('Synthetic', np.ones(3), lattice, species, selective_dynamics, 'Direct',
+                  positions=rng.random((n,3)), dynamics=dynamics)
+
+
+def write_synthetic_poscar(path:Path, n:int, seed:int=0, selective_dynamics:bool=True) -> Poscar:
+    '''
+    Write the structure of synthetic_poscar to a file and return it
+    '''
+    poscar = synthetic_poscar(n, seed, selective_dynamics)
+    poscar.to_file(path)
+    return poscar
+
+
+def write_synthetic_oszicar(path:Path, steps:int, md:bool=False, electronic:int=12, seed:int=0) -> None:
+    '''
+    Write an OSZICAR of the given number of ionic steps, each preceded by
+    electronic steps, as a relaxation or, with md, as molecular dynamics
+    '''
+    rng = np.random.default_rng(seed)
+    energies = -100.0 + np.cumsum(rng.normal(0, 0.01, steps))
+    with path.open('w') as f:
+        for step, energy in enumerate(energies, 1):
+            f.write('       N       E                     dE             d eps       ncg     rms          rms(c)\n')
+            f.write(''.join( f'DAV: {i:3d}    {energy + 10.0**-i:.12E}   -.{i}E-03   -.1E-05  1000   .1E-02\n'
+                             for i in range(1, electronic+1) ))
+            if md:
+                f.write(f'{step:6d} T=   {300 + rng.normal(0, 10):6.0f}. E= {energy + 1:.8E} F= {energy:.8E} '
+                        f'E0= {energy + 1e-4:.8E}  EK= {0.1:.5E} SP= 0.00E+00 SK= 0.00E+00\n')
+            else:
+                f.write(f'{step:6d} F= {energy:.8E} E0= {energy + 1e-4:.8E}  d E ={-1e-3:.6E}\n')
+
+
+def write_synthetic_templates(directory:Path, count:int, tags:int=8, seed:int=0) -> list[Path]:
+    '''
+    Write a stack of count inkit YAML templates, each setting a random choice
+    of tags with random values across the INCAR sections, and return their paths
+    '''
+    rng = np.random.default_rng(seed)
+    directory.mkdir(parents=True, exist_ok=True)
+    names = list(INCAR_TAGS)
+    paths = []
+    for i in range(count):
+        chosen = rng.choice(len(names), size=min(tags, len(names)), replace=False)
+        sections = { section:[] for section in SECTIONS }
+        for j in chosen:
+            values = INCAR_TAGS[names[j]]
+            sections[SECTIONS[j % len(SECTIONS)]].append((names[j], values[rng.integers(len(values))]))
+        lines = ['---']
+        for section, entries in sections.items():
+            lines.append(f'{section}:')
+            for tag, value in entries:
+                lines.extend([f'  - tag: {tag}', f'    value: {value}', f'    comment: Synthetic {tag.lower()}'])
+        path = Path(directory, f'synthetic_{i:04d}.yaml')
+        path.write_text('\n'.join(lines) + '\n')
+        paths.append(path)
+    return paths
+
+
+def write_synthetic_potentials(directory:Path, size:int=1 << 20) -> Path:
+    '''
+    Write a GGA potential set holding a POTCAR of about size bytes for each
+    species in POTENTIALS, with the header fields Potcar reads, and return it
+    '''
+    for name, fields in POTENTIALS.items():
+        path = Path(directory, 'GGA', name, 'POTCAR')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        header = (f"  {fields['titel']}\n {fields['zval']:.1f}\n parameters from PSCTR are:\n"
+                  f"   TITEL  = {fields['titel']}\n"
+                  f"   POMASS = {fields['pomass']:8.3f}; ZVAL   = {fields['zval']:8.3f}    mass and valenz\n"
+                  f"   ENMAX  = {fields['enmax']:8.3f}; ENMIN  = {fields['enmin']:8.3f} eV\n")
+        line = '  0.123456789E+00  0.234567890E+00  0.345678901E+00  0.456789012E+00  0.567890123E+00\n'
+        with path.open('w') as f:
+            f.write(header)
+            f.write(line * max(1, (size - len(header)) // len(line)))
+            f.write(' End of Dataset\n')
+    return Path(directory, 'GGA')
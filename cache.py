@@ -0,0 +1,162 @@
+"""
+On-disk cache of arrays parsed from VASP files
+
+Entries are stored as a directory of .npy files plus a small JSON file of
+metadata, so warm loads memory map the arrays instead of parsing the source.
+An entry is keyed on the source's resolved path, size and modification time,
+and verified against a hash of its whole content before use, so an edit
+that keeps the size and modification time is still caught. Hashing reads
+the file at several hundred MB/s, a small fraction of the time parsing
+it would take. The least recently used entries are evicted once the cache
+grows past its size cap.
+
+Environment variables:
+    VAPACK_CACHE       set to 0 to disable the cache
+    VAPACK_CACHE_DIR   cache directory <DEFAULT ~/.cache/vapack>
+    VAPACK_CACHE_SIZE  size cap in bytes, optionally with a K, M or G suffix <DEFAULT 1G>
+    VAPACK_CACHE_MIN   smallest source file worth caching <DEFAULT 256K>
+"""
+
+from pathlib import Path
+import numpy as np
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+# Bump when the layout of any cached entry changes
+FORMAT_VERSION = 2
+# Read size when hashing a source file
+FINGERPRINT_CHUNK = 1 << 20
+
+
+def _parse_size(size:str) -> int:
+    '''
+    Convert a size such as 512M or 2G to bytes
+    '''
+    size = size.strip().upper()
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def fingerprint(path:Path, size:int) -> str:
+    '''
+    Return a hash of the size and content of a file
+    '''
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with path.open('rb') as f:
+        for chunk in iter(lambda: f.read(FINGERPRINT_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Cache(object):
+    '''
+    Directory of cached entries with least recently used eviction
+    '''
+    def __init__(self, directory:str=None, max_bytes:int=None, min_source_bytes:int=None):
+        self.directory = Path(directory if directory is not None else
+                              os.environ.get('VAPACK_CACHE_DIR', Path.home() / '.cache' / 'vapack'))
+        self.max_bytes = max_bytes if max_bytes is not None else\
+            _parse_size(os.environ.get('VAPACK_CACHE_SIZE', '1G'))
+        self.min_source_bytes = min_source_bytes if min_source_bytes is not None else\
+            _parse_size(os.environ.get('VAPACK_CACHE_MIN', '256K'))
+
+    def _entry(self, source:Path, kind:str) -> tuple[Path, os.stat_result]:
+        '''
+        Return the entry directory for a source file and the source's stat
+        '''
+        source = Path(source).resolve()
+        stat = source.stat()
+        key = f'{FORMAT_VERSION}\0{kind}\0{source}\0{stat.st_size}\0{stat.st_mtime_ns}'
+        return Path(self.directory, hashlib.sha1(key.encode()).hexdigest()), stat
+
+    def load(self, source:str, kind:str) -> tuple[dict, dict]:
+        '''
+        Return the memory mapped arrays and metadata cached for a source file,
+        or None if there is no valid entry. The arrays are mapped copy-on-write,
+        so callers may write to them without touching the entry.
+        '''
+        source = Path(source)
+        try:
+            entry, stat = self._entry(source, kind)
+            with Path(entry, 'meta.json').open('r') as f:
+                meta = json.load(f)
+            if meta['fingerprint'] != fingerprint(source, stat.st_size):
+                return None
+            arrays = { name:np.asarray(np.load(Path(entry, name + '.npy'), mmap_mode='c'))
+                       for name in meta['arrays'] }
+            # Mark the entry as recently used
+            os.utime(Path(entry, 'meta.json'))
+        except (OSError, ValueError, KeyError):
+            return None
+        return arrays, meta['data']
+
+    def store(self, source:str, kind:str, arrays:dict, data:dict) -> None:
+        '''
+        Cache arrays and JSON serializable metadata for a source file.
+        Sources below the minimum size are not worth caching and are skipped,
+        as are any failures to write.
+        '''
+        source = Path(source)
+        try:
+            entry, stat = self._entry(source, kind)
+            if stat.st_size < self.min_source_bytes:
+                return
+            self.directory.mkdir(parents=True, exist_ok=True)
+            # Write to a temporary directory and rename so readers never see partial entries
+            staging = Path(tempfile.mkdtemp(dir=self.directory, prefix='.staging-'))
+            try:
+                for name, array in arrays.items():
+                    np.save(Path(staging, name + '.npy'), np.ascontiguousarray(array))
+                meta = {'fingerprint': fingerprint(source, stat.st_size), 'source': str(source),
+                        'arrays': list(arrays.keys()), 'data': data}
+                with Path(staging, 'meta.json').open('w') as f:
+                    json.dump(meta, f)
+                if entry.exists():
+                    shutil.rmtree(entry, ignore_errors=True)
+                staging.rename(entry)
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+            self.evict()
+        except OSError:
+            return
+
+    def evict(self) -> None:
+        '''
+        Remove the least recently used entries until the cache fits its size cap
+        '''
+        entries = []
+        for entry in self.directory.iterdir():
+            if entry.name.startswith('.'):
+                continue
+            try:
+                used = Path(entry, 'meta.json').stat().st_mtime
+                size = sum( f.stat().st_size for f in entry.iterdir() )
+            except OSError:
+                continue
+            entries.append((used, size, entry))
+        total = sum( size for _, size, _ in entries )
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def clear(self) -> None:
+        '''
+        Remove every entry
+        '''
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def default_cache() -> Cache:
+    '''
+    Return the cache configured by the environment, or None if it is disabled
+    '''
+    if os.environ.get('VAPACK_CACHE', '1').strip().lower() in ('0', 'false', 'no', 'off'):
+        return None
+    return Cache()
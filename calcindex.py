@@ -0,0 +1,516 @@
+"""
+SQLite index of the calculation directories under a project tree
+
+Each directory holding a metadata.yml, INCAR, POSCAR or OUTCAR is one
+calculation. Scans are incremental: a directory is only read again when the
+newest modification time of it and its input and output files has changed,
+and directories that have disappeared are dropped. The database holds:
+
+    calculations  one row per directory: metadata fields, composition summary,
+                  number of ionic steps, final energies and maximum force
+    tags          INCAR tag/value pairs of each calculation
+    composition   species counts of each calculation
+
+Each calculation is also keyed by a canonical hash of its inputs, so a
+calculation that was already run can be found before it is queued again.
+The POSCAR is reduced to its lattice, species in sorted order, and wrapped
+direct coordinates rounded to a tolerance; the INCAR to its tag/value pairs
+without comments; the POTCAR to the TITEL of each potential. Reformatting
+an input, reordering INCAR tags, or a convert round trip keeps the hash.
+"""
+
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from vasptypes import Incar, IncarArray, Poscar, Outcar, Oszicar, _POTCAR_FIELDS
+import packager
+
+
+# Files whose presence marks a calculation directory
+MARKERS = [packager.METADATA_FILE, 'INCAR', 'POSCAR', 'OUTCAR']
+# Files whose modification invalidates an indexed directory
+WATCHED = [packager.METADATA_FILE, 'INCAR', 'POSCAR', 'KPOINTS', 'POTCAR', 'CONTCAR', 'OUTCAR', 'OSZICAR']
+# The end of an OUTCAR of a run that finished normally
+FINISHED_MARKER = b'General timing and accounting'
+DEFAULT_DATABASE = 'vapack.db'
+# Bumped whenever the tables, the input hash or the watched files change,
+# which rebuilds the index
+SCHEMA_VERSION = 3
+
+# Rounding of direct coordinates and lattice vectors in the input hash
+CANONICAL_TOLERANCE = 1e-5
+# INCAR tags that only label the calculation
+LABEL_TAGS = ['SYSTEM']
+# INCAR tags with one value per ion, or per ion and direction, and with one
+# value per species; these follow the ions when the species are sorted
+PER_ION_TAGS = ['MAGMOM', 'M_CONSTR']
+PER_SPECIES_TAGS = ['LDAUL', 'LDAUU', 'LDAUJ', 'RWIGS', 'POMASS', 'LANGEVIN_GAMMA']
+# Statuses of calculations that were handed to the cluster
+SUBMITTED = ['packaged', 'queued', 'running', 'complete']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS calculations (
+    path TEXT PRIMARY KEY,
+    signature INTEGER NOT NULL,
+    indexed REAL NOT NULL,
+    id TEXT,
+    human_name TEXT,
+    status TEXT,
+    created TEXT,
+    formula TEXT,
+    natoms INTEGER,
+    nsteps INTEGER,
+    finished INTEGER,
+    free_energy REAL,
+    energy REAL,
+    energy_sigma_0 REAL,
+    max_force REAL,
+    input_hash TEXT,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS tags (
+    path TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (path, tag)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS composition (
+    path TEXT NOT NULL,
+    species TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (path, species)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS calculations_status ON calculations (status);
+CREATE INDEX IF NOT EXISTS calculations_id ON calculations (id);
+CREATE INDEX IF NOT EXISTS calculations_formula ON calculations (formula);
+CREATE INDEX IF NOT EXISTS calculations_energy ON calculations (energy_sigma_0);
+CREATE INDEX IF NOT EXISTS calculations_input_hash ON calculations (input_hash);
+CREATE INDEX IF NOT EXISTS tags_tag_value ON tags (tag, value);
+CREATE INDEX IF NOT EXISTS composition_species ON composition (species, count);
+'''
+
+# Columns of the calculations table filled by read_calculation
+COLUMNS = ['path', 'signature', 'indexed', 'id', 'human_name', 'status', 'created', 'formula',
+           'natoms', 'nsteps', 'finished', 'free_energy', 'energy', 'energy_sigma_0',
+           'max_force', 'input_hash', 'error']
+
+
+def signature(directory:Path) -> int:
+    '''
+    Newest modification time of a directory and the files the index reads from it
+    '''
+    newest = os.stat(directory).st_mtime_ns
+    for name in WATCHED:
+        try:
+            newest = max(newest, os.stat(Path(directory, name)).st_mtime_ns)
+        except OSError:
+            pass
+    return newest
+
+
+def find_calculations(root:str) -> list:
+    '''
+    Return every calculation directory under root, skipping hidden directories
+    '''
+    found = []
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories[:] = sorted( d for d in subdirectories if not( d.startswith('.') ) )
+        if any( marker in files for marker in MARKERS ):
+            found.append(Path(directory))
+    return found
+
+
+def _canonical_value(value) -> str:
+    '''
+    Format an INCAR value so that equal values give equal text: numbers are
+    floats, repeated values are runs, and strings are case folded
+    '''
+    if isinstance(value, (IncarArray, list, tuple, np.ndarray)):
+        values = np.asarray(value)
+        if values.dtype != bool:
+            values = values.astype(float)
+        return Incar.format_value(IncarArray.from_values(values))
+    if isinstance(value, str):
+        return ' '.join(value.split()).upper()
+    if isinstance(value, (int, float)) and not( isinstance(value, bool) ):
+        return Incar.format_value(float(value))
+    return Incar.format_value(value)
+
+
+def _potential_titles(path:Path) -> list:
+    '''
+    TITEL of each potential in a POTCAR, in order
+    '''
+    with path.open('rb') as f:
+        return [ title.decode() for title in _POTCAR_FIELDS['titel'].findall(f.read()) ]
+
+
+def _species_order(poscar:Poscar, incar:dict) -> list:
+    '''
+    Indices of the species in sorted order, or in their original order
+    if an INCAR tag has values that could not be reordered with them
+    '''
+    counts = list(poscar.species.values())
+    n = len(poscar.positions)
+    for tag, value in incar.items():
+        if not( isinstance(value, (IncarArray, list, tuple)) ):
+            continue
+        if (tag in PER_SPECIES_TAGS and len(value) != len(counts)) or\
+           (tag in PER_ION_TAGS and (n == 0 or len(value) % n != 0)):
+            return list(range(len(counts)))
+    return sorted(range(len(counts)), key=lambda i: list(poscar.species)[i])
+
+
+def canonical_inputs(directory:str, tolerance:float=CANONICAL_TOLERANCE) -> dict:
+    '''
+    Reduce the inputs of a calculation to the canonical form that is hashed:
+    the lattice, species, wrapped direct positions (as integer multiples of
+    the tolerance), and selective dynamics of the POSCAR, with the species
+    sorted; the
+    INCAR tags without comments or labels, with per ion and per species
+    values reordered to match; the TITEL of each potential in the POTCAR;
+    and the KPOINTS without its comment, with whitespace normalized.
+    Returns None for a directory without a POSCAR.
+    '''
+    directory = Path(directory)
+    if not( Path(directory, 'POSCAR').is_file() ):
+        return None
+    poscar = Poscar.from_file(Path(directory, 'POSCAR')).copy()
+    incar = Incar.from_file(Path(directory, 'INCAR')) if Path(directory, 'INCAR').is_file() else Incar()
+    titles = _potential_titles(Path(directory, 'POTCAR')) if Path(directory, 'POTCAR').is_file() else []
+
+    # Wrap after rounding, so coordinates just below 1 become 0
+    steps = int(round(1 / tolerance))
+    poscar._convert_to_direct()
+    positions = np.rint(poscar.positions * steps).astype(np.int64) % steps
+    lattice = poscar.lattice * np.asarray(poscar.scale, dtype=float).reshape(-1)
+    lattice = np.rint(lattice / tolerance).astype(np.int64)
+
+    names = list(poscar.species)
+    counts = list(poscar.species.values())
+    starts = np.concatenate([[0], np.cumsum(counts)]).astype(int)
+    order = _species_order(poscar, incar)
+    ions = np.concatenate([ np.arange(starts[i], starts[i+1]) for i in order ] + [np.zeros(0, dtype=int)])
+
+    tags = {}
+    for tag, value in incar.items():
+        if tag in LABEL_TAGS:
+            continue
+        if isinstance(value, (IncarArray, list, tuple)):
+            values = np.asarray(value)
+            if tag in PER_SPECIES_TAGS and len(values) == len(counts):
+                value = values[order]
+            elif tag in PER_ION_TAGS and len(ions) > 0 and len(values) % len(ions) == 0:
+                value = values.reshape(len(ions), -1)[ions].reshape(-1)
+        tags[tag] = _canonical_value(value)
+
+    kpoints = None
+    if Path(directory, 'KPOINTS').is_file():
+        lines = Path(directory, 'KPOINTS').read_text(errors='replace').splitlines()[1:]
+        kpoints = [ ' '.join(line.split()) for line in lines if len(line.split()) > 0 ]
+
+    return {
+        'lattice': lattice.tolist(),
+        'species': [ [names[i], counts[i], titles[i] if i < len(titles) else None] for i in order ],
+        'positions': positions[ions],
+        'dynamics': poscar.dynamics[ions] if poscar.selective_dynamics else None,
+        'incar': sorted(tags.items()),
+        'kpoints': kpoints,
+    }
+
+
+def input_hash(directory:str, tolerance:float=CANONICAL_TOLERANCE) -> str:
+    '''
+    Hash of the canonical inputs of a calculation, or None without a POSCAR
+    '''
+    inputs = canonical_inputs(directory, tolerance)
+    if inputs is None:
+        return None
+    digest = hashlib.blake2b(digest_size=16)
+    for key, value in inputs.items():
+        # Ion arrays are hashed as raw bytes, which is far quicker than as text
+        if isinstance(value, np.ndarray):
+            value = np.ascontiguousarray(value, dtype='<i8')
+            digest.update(f'{key}{value.shape}'.encode())
+            digest.update(value.tobytes())
+        else:
+            digest.update(f'{key}{json.dumps(value, separators=(",", ":"))}'.encode())
+    return digest.hexdigest()
+
+
+def _finished(outcar:Path) -> bool:
+    with outcar.open('rb') as f:
+        f.seek(max(0, outcar.stat().st_size - 16384))
+        return FINISHED_MARKER in f.read()
+
+
+def read_calculation(directory:str, stamp:int=None) -> tuple:
+    '''
+    Read everything the index keeps about one calculation directory, returning
+    a row of the calculations table, the INCAR tags, and the composition.
+    Unreadable files are recorded in the error column rather than raised.
+    '''
+    directory = Path(directory)
+    row = dict.fromkeys(COLUMNS)
+    row.update(path=str(directory.resolve()), indexed=time.time(),
+               signature=signature(directory) if stamp is None else stamp)
+    tags, composition, errors = [], [], []
+
+    metadata = packager.read_metadata(directory)
+    for key in ['id', 'human_name', 'status', 'created']:
+        row[key] = metadata.get(key)
+
+    try:
+        row['input_hash'] = input_hash(directory)
+    except Exception as error:
+        errors.append(f'input hash: {error}')
+
+    if Path(directory, 'INCAR').is_file():
+        try:
+            incar = Incar.from_file(Path(directory, 'INCAR'))
+            tags = [ (key, Incar.format_value(value)) for key, value in incar.items() ]
+        except Exception as error:
+            errors.append(f'INCAR: {error}')
+
+    # The final structure if there is one, otherwise the initial one
+    for name in ['CONTCAR', 'POSCAR']:
+        path = Path(directory, name)
+        if path.is_file() and path.stat().st_size > 0:
+            try:
+                poscar = Poscar.from_file(path)
+                composition = list(poscar.species.items())
+                row['formula'] = ''.join( f'{s}{c}' for s, c in composition )
+                row['natoms'] = sum( c for _, c in composition )
+            except Exception as error:
+                errors.append(f'{name}: {error}')
+            break
+
+    outcar_path = Path(directory, 'OUTCAR')
+    oszicar_path = Path(directory, 'OSZICAR')
+    try:
+        if outcar_path.is_file():
+            row['finished'] = int(_finished(outcar_path))
+            with Outcar(outcar_path, persist=False) as outcar:
+                row['nsteps'] = len(outcar)
+                if len(outcar) > 0:
+                    energies = outcar.energy(len(outcar)-1)
+                    row['free_energy'] = energies.get('free_energy')
+                    row['energy'] = energies.get('energy_without_entropy')
+                    row['energy_sigma_0'] = energies.get('energy_sigma_0')
+                    forces = outcar.forces(len(outcar)-1)
+                    row['max_force'] = float(np.sqrt((forces**2).sum(axis=1)).max()) if len(forces) > 0 else None
+        elif oszicar_path.is_file():
+            oszicar = Oszicar(oszicar_path)
+            row['nsteps'] = len(oszicar)
+            if len(oszicar) > 0:
+                row['free_energy'] = oszicar.values[-1].get('F')
+                row['energy_sigma_0'] = oszicar.values[-1].get('E0')
+    except Exception as error:
+        errors.append(f'OUTCAR: {error}')
+
+    row['error'] = '; '.join(errors) if len(errors) > 0 else None
+    return row, tags, composition
+
+
+def _read_item(item:tuple) -> tuple:
+    return read_calculation(*item)
+
+
+class CalculationIndex(object):
+    '''
+    SQLite database of calculation directories
+    '''
+    def __init__(self, database:str=DEFAULT_DATABASE):
+        self.database = Path(database)
+        self.connection = sqlite3.connect(self.database)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # The index only holds what can be read again, so an old one is rebuilt
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            with self.connection:
+                for table in ['calculations', 'tags', 'composition']:
+                    self.connection.execute(f'DROP TABLE IF EXISTS {table}')
+            self.connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def update(self, root:str='.', jobs:int=1, prune:bool=True) -> dict:
+        '''
+        Index the calculations under root, reading only new or changed
+        directories, optionally with a pool of worker processes. With prune,
+        indexed directories under root that no longer exist are removed.
+        Returns the number of added, updated, unchanged and removed directories.
+        '''
+        known = { row['path']:row['signature'] for row in
+                  self.connection.execute('SELECT path, signature FROM calculations') }
+        stale, seen = [], set()
+        counts = {'added': 0, 'updated': 0, 'unchanged': 0, 'removed': 0}
+        for directory in find_calculations(root):
+            path = str(directory.resolve())
+            seen.add(path)
+            stamp = signature(directory)
+            if known.get(path) == stamp:
+                counts['unchanged'] += 1
+                continue
+            counts['updated' if path in known else 'added'] += 1
+            stale.append((str(directory), stamp))
+
+        pool = None
+        if jobs == 1 or len(stale) < 2:
+            results = map(_read_item, stale)
+        else:
+            pool = ProcessPoolExecutor(jobs)
+            workers = jobs or os.cpu_count() or 1
+            results = pool.map(_read_item, stale, chunksize=max(1, len(stale) // (8 * workers)))
+
+        # One transaction for the whole scan
+        try:
+            with self.connection:
+                for row, tags, composition in results:
+                    self._store(row, tags, composition)
+                if prune:
+                    prefix = str(Path(root).resolve()).rstrip(os.sep) + os.sep
+                    for path in known:
+                        if not( path in seen ) and (path + os.sep).startswith(prefix):
+                            self._delete(path)
+                            counts['removed'] += 1
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        return counts
+
+    def add(self, directories:list) -> None:
+        '''
+        Index the given calculation directories now, changed or not
+        '''
+        with self.connection:
+            for directory in directories:
+                self._store(*read_calculation(directory))
+
+    def _store(self, row:dict, tags:list, composition:list) -> None:
+        self._delete(row['path'])
+        self.connection.execute(f"INSERT INTO calculations ({', '.join(COLUMNS)}) "
+                                f"VALUES ({', '.join('?'*len(COLUMNS))})",
+                                [ row[c] for c in COLUMNS ])
+        self.connection.executemany('INSERT INTO tags VALUES (?, ?, ?)',
+                                    [ (row['path'], tag, value) for tag, value in tags ])
+        self.connection.executemany('INSERT INTO composition VALUES (?, ?, ?)',
+                                    [ (row['path'], s, c) for s, c in composition ])
+
+    def _delete(self, path:str) -> None:
+        for table in ['calculations', 'tags', 'composition']:
+            self.connection.execute(f'DELETE FROM {table} WHERE path = ?', (path,))
+
+    def query(self, status:str=None, formula:str=None, species:list=[], tags:dict={},
+              where:str=None, order:str='path', limit:int=None) -> list:
+        '''
+        Return calculations matching every given condition: status, formula,
+        containing all the given species, INCAR tags with the given values
+        (as written by Incar.format_value), and an optional SQL condition
+        on the calculations table.
+        '''
+        conditions, parameters = [], []
+        if status is not None:
+            conditions.append('c.status = ?')
+            parameters.append(status)
+        if formula is not None:
+            conditions.append('c.formula = ?')
+            parameters.append(formula)
+        for s in species:
+            conditions.append('c.path IN (SELECT path FROM composition WHERE species = ?)')
+            parameters.append(s)
+        for tag, value in tags.items():
+            conditions.append('c.path IN (SELECT path FROM tags WHERE tag = ? AND value = ?)')
+            parameters.extend([tag.upper(), Incar.format_value(value)])
+        if where is not None:
+            conditions.append(f'({where})')
+        sql = 'SELECT c.* FROM calculations c'
+        if len(conditions) > 0:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        if order not in COLUMNS:
+            raise RuntimeError(f'Cannot order calculations by {order}')
+        sql += f' ORDER BY c.{order}'
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+        return self.connection.execute(sql, parameters).fetchall()
+
+    def tags(self, path:str) -> dict:
+        return { row['tag']:row['value'] for row in
+                 self.connection.execute('SELECT tag, value FROM tags WHERE path = ?', (path,)) }
+
+    def duplicates(self, directory:str, digest:str=None) -> list:
+        '''
+        Return the indexed calculations, other than the directory itself, whose
+        inputs hash the same as those of the directory. Calculations that
+        finished come first, then those with any ionic steps.
+        '''
+        digest = input_hash(directory) if digest is None else digest
+        if digest is None:
+            return []
+        return self.connection.execute(
+            'SELECT * FROM calculations WHERE input_hash = ? AND path != ? '
+            'ORDER BY finished IS NOT 1, nsteps IS NULL OR nsteps = 0, path',
+            (digest, str(Path(directory).resolve()))).fetchall()
+
+
+def link_result(directory:str, duplicate:sqlite3.Row) -> list:
+    '''
+    Symbolically link the results of an earlier identical calculation into a
+    directory, leaving its inputs and any other files of its own alone, and
+    record in its metadata which calculation it duplicates. Returns the names
+    of the linked files.
+    '''
+    linked = []
+    for path in packager.result_files(duplicate['path'], exclude=packager.INPUT_FILES):
+        target = Path(directory, path.name)
+        if not( target.exists() or target.is_symlink() ):
+            target.symlink_to(path)
+            linked.append(path.name)
+    packager.update_metadata(directory, status='duplicate', duplicate_of=duplicate['path'])
+    return linked
+
+
+def find_duplicates(directories:list, database:str=DEFAULT_DATABASE) -> dict:
+    '''
+    Map each directory whose inputs repeat those of an indexed calculation
+    that was submitted or has results, or of an earlier directory in the
+    list, to the calculations it repeats, as dictionaries of their index
+    rows. Without a database only the directories are compared with each other.
+    '''
+    found, first = {}, {}
+    index = CalculationIndex(database) if Path(database).is_file() else None
+    try:
+        for directory in directories:
+            digest = input_hash(directory)
+            if digest is None:
+                continue
+            matches = [] if index is None else [ dict(row) for row in index.duplicates(directory, digest)
+                                                 if row['status'] in SUBMITTED or has_result(row) ]
+            if digest in first:
+                matches.append({'path': first[digest], 'status': 'pending', 'finished': None, 'nsteps': None})
+            else:
+                first[digest] = str(Path(directory).resolve())
+            if len(matches) > 0:
+                found[directory] = matches
+    finally:
+        if index is not None:
+            index.close()
+    return found
+
+
+def has_result(calculation) -> bool:
+    return calculation['finished'] == 1 or (calculation['nsteps'] or 0) > 0
@@ -3,12 +3,28 @@
 from sys import argv
 from argparse import ArgumentParser
 from pathlib import Path
-from yaml import load, CLoader
+from yaml import load, dump, CLoader, CDumper, YAMLError
+from cache import default_cache
+from profiling import phase, count_read, count_written
+import profiling
+from vasptypes import Poscar, Potcar
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from datetime import datetime
+from uuid import uuid4
+import hashlib
+import pickle
+import shutil
+import os
 
 
 TAB_SIZE = 4
 KEY_WIDTH = 3*TAB_SIZE
 VAL_WIDTH = 3*TAB_SIZE
+# Bump when the layout of compiled templates changes
+TEMPLATE_CACHE_VERSION = 1
+# Calculation metadata file shared with utilities/package.sh
+METADATA_FILE = 'metadata.yml'
 
 
 def incar_system_line(incar_dict:dict, system_str:str):
@@ -54,76 +70,464 @@ def format_incar(incar_dict:dict) -> str:
     return '\n\n'.join(section_strings)
 
 
-def update_incar_tag(incar_dict:dict, new_tag:dict, section='Unspecified'):
+def index_incar_dict(incar_dict:dict) -> dict:
     '''
-    Update the INCAR dictionary with the given new tag (and section)
+    Build an index of the INCAR dictionary mapping each tag name to its first
+    occurence and each lower case section name to its key
     '''
-    # First replace any existing occurences, ignoring the section parameter
+    index = {'tags': {}, 'sections': {}}
     for section_key, section_value in incar_dict.items():
+        index['sections'].setdefault(section_key.lower(), section_key)
         if not( type(section_value) in [tuple, list] ):
             continue
         for tag in section_value:
-            if tag['tag'] == new_tag['tag']:
-                tag['value'] = new_tag['value']
-                tag['comment'] = new_tag['comment']
-                return
-    
+            index['tags'].setdefault(tag['tag'], tag)
+    return index
+
+
+def update_incar_tag(incar_dict:dict, new_tag:dict, section='Unspecified', index:dict=None):
+    '''
+    Update the INCAR dictionary with the given new tag (and section)
+    An index from index_incar_dict makes each update constant time, and is kept up to date
+    '''
+    if index is None:
+        index = index_incar_dict(incar_dict)
+
+    # First replace any existing occurences, ignoring the section parameter
+    tag = index['tags'].get(new_tag['tag'])
+    if tag is not None:
+        tag['value'] = new_tag['value']
+        tag['comment'] = new_tag['comment']
+        return
+
     # If the tag isn't preexisting, search for the correct section to add the tag
-    for section_key in incar_dict.keys():
-        if section_key.lower() == section.lower():
-            # If section is empty, initialize it as a list
-            if incar_dict[section_key] is None:
-                incar_dict[section_key] = []
-            incar_dict[section_key].append(new_tag)
-            return
+    new_tag = dict(new_tag)
+    index['tags'][new_tag['tag']] = new_tag
+    section_key = index['sections'].get(section.lower())
+    if section_key is not None:
+        # If section is empty, initialize it as a list
+        if incar_dict[section_key] is None:
+            incar_dict[section_key] = []
+        incar_dict[section_key].append(new_tag)
+        return
     
     # If neither tag nor section exist, create them both
-    incar_dict.update({section.lower().capitalize(): [new_tag]})
+    section_key = section.lower().capitalize()
+    index['sections'][section.lower()] = section_key
+    incar_dict.update({section_key: [new_tag]})
 
 
-def update_incar_dict(incar_dict:dict, new_dict:dict):
+def update_incar_dict(incar_dict:dict, new_dict:dict, index:dict=None):
     '''
     Update the INCAR dict with information in the new dict
+    Pass the same index when merging a stack of templates to avoid reindexing
     '''
+    if index is None:
+        index = index_incar_dict(incar_dict)
     for section, tags in new_dict.items():
         if tags == None:
             continue
         for tag in tags:
-            update_incar_tag(incar_dict, tag, section)
+            update_incar_tag(incar_dict, tag, section, index)
+
+
+def validate_template(data, source:str='template') -> dict:
+    '''
+    Check that template data is a dictionary of sections holding lists of tags,
+    returning a copy with each tag ordered as tag, value, comment
+    '''
+    if data is None:
+        return {}
+    if not( isinstance(data, dict) ):
+        raise RuntimeError(f'{source} must be a dictionary of sections')
+    validated = {}
+    for section, tags in data.items():
+        if tags is None:
+            validated[section] = None
+            continue
+        if not( isinstance(tags, list) ):
+            raise RuntimeError(f'Section {section} of {source} must be a list of tags')
+        validated[section] = []
+        for tag in tags:
+            if not( isinstance(tag, dict) ) or not( 'tag' in tag ) or not( 'value' in tag ):
+                raise RuntimeError(f'Every tag in section {section} of {source} needs a tag and a value')
+            unknown = set(tag.keys()) - {'tag', 'value', 'comment'}
+            if len(unknown) > 0:
+                raise RuntimeError(f"Tag {tag['tag']} in {source} has unknown keys {sorted(unknown)}")
+            comment = tag.get('comment')
+            validated[section].append({'tag': tag['tag'], 'value': tag['value'],
+                                       'comment': '' if comment is None else comment})
+    return validated
+
+
+def _template_cache_path(template_dir:Path) -> Path:
+    '''
+    Return the compiled template cache file of a template directory, or None if caching is disabled
+    '''
+    cache = default_cache()
+    if cache is None:
+        return None
+    digest = hashlib.sha1(os.path.abspath(template_dir).encode()).hexdigest()
+    return Path(cache.directory, f'inkit-{digest}.pickle')
+
+
+def _compile_template(path:Path, stat:os.stat_result) -> tuple:
+    '''
+    Parse and validate one template into a cache entry of its mtime, size,
+    and either the pickled data or the validation error
+    '''
+    try:
+        with path.open('r') as f:
+            text = f.read()
+        count_read(len(text))
+        data = validate_template(load(text, Loader=CLoader), str(path))
+        return (stat.st_mtime_ns, stat.st_size, pickle.dumps(data), None)
+    except (RuntimeError, YAMLError) as error:
+        return (stat.st_mtime_ns, stat.st_size, None, str(error))
+
+
+# Compiled templates by template directory, kept for the life of the process
+_compiled_templates = {}
+
+
+@phase('parse')
+def load_templates(template_files:list, template_dir:Path) -> list:
+    '''
+    Return the validated data of each template file. Templates are compiled into
+    one cache file per template directory, so warm runs only check mtimes
+    and never parse YAML. Without a cache only the requested templates are
+    compiled, once per process. Every call returns fresh copies that may be edited.
+    '''
+    cache_path = _template_cache_path(template_dir)
+    directory = os.path.abspath(template_dir)
+    compiled = _compiled_templates.get(directory)
+    if compiled is None and cache_path is not None:
+        try:
+            with cache_path.open('rb') as f:
+                compiled = pickle.load(f)
+            if compiled.get('version') != TEMPLATE_CACHE_VERSION:
+                compiled = None
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            compiled = None
+    changed = False
+    if compiled is None:
+        compiled = {'version': TEMPLATE_CACHE_VERSION, 'entries': {}}
+        # Compile the whole directory on the first run, if there is a cache to keep it
+        if cache_path is not None:
+            for path in sorted(template_dir.glob('*.yaml')):
+                compiled['entries'][os.path.abspath(path)] = _compile_template(path, path.stat())
+            changed = True
+
+    templates = []
+    for path in template_files:
+        stat = path.stat()
+        key = os.path.abspath(path)
+        entry = compiled['entries'].get(key)
+        if entry is None or entry[0] != stat.st_mtime_ns or entry[1] != stat.st_size:
+            entry = _compile_template(path, stat)
+            compiled['entries'][key] = entry
+            changed = True
+        if entry[3] is not None:
+            raise RuntimeError(entry[3])
+        templates.append(pickle.loads(entry[2]))
+
+    _compiled_templates[directory] = compiled
+    if cache_path is not None and changed:
+        temporary = cache_path.with_name(f'{cache_path.name}.{os.getpid()}.tmp')
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            with temporary.open('wb') as f:
+                pickle.dump(compiled, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, cache_path)
+        except OSError:
+            if temporary.exists():
+                temporary.unlink()
+    return templates
+
+
+@phase('transform')
+def merge_templates(templates:list) -> dict:
+    '''
+    Merge a stack of template data in order, later templates overriding earlier ones
+    '''
+    data = None
+    index = None
+    for new_data in templates:
+        if data is None:
+            data = new_data
+            index = index_incar_dict(data)
+        else:
+            update_incar_dict(data, new_data, index)
+    return data
+
+
+@phase('transform')
+def expand_placeholders(incar_dict:dict, parameters:dict) -> dict:
+    '''
+    Replace {NAME} placeholders in the tag values of the INCAR dictionary with the given parameters
+    '''
+    for section_value in incar_dict.values():
+        if not( type(section_value) in [tuple, list] ):
+            continue
+        for tag in section_value:
+            if isinstance(tag['value'], str) and '{' in tag['value']:
+                try:
+                    tag['value'] = tag['value'].format_map(parameters)
+                except KeyError as error:
+                    raise RuntimeError(f"No value given for placeholder {error} of tag {tag['tag']}")
+    return incar_dict
+
+
+def parse_parameters(entries:list) -> dict:
+    '''
+    Convert a list of KEY=VALUE strings to a dictionary
+    '''
+    parameters = {}
+    for entry in entries:
+        key, _, value = entry.partition('=')
+        if len(value) == 0:
+            raise RuntimeError(f'Parameter {entry} must be given as KEY=VALUE')
+        parameters[key] = value
+    return parameters
+
+
+def _template_paths(names:list, template_dir:Path) -> list:
+    '''
+    Create paths to the template files, adding the .yaml suffix if it is not specified manually
+    '''
+    return [ Path(template_dir, i + '.yaml'*(i.find('.yaml')<0)) for i in names ]
+
+
+def expand_manifest(manifest:dict, root:Path) -> list:
+    '''
+    Expand a sweep manifest into one job per structure and point of the parameter grid.
+    Parameters given as lists are grid axes, anything else is a constant. String
+    parameters may refer to other parameters, such as TEEND: "{TEBEG}".
+    Paths in the manifest are relative to root.
+    '''
+    for key in ['templates', 'structures']:
+        if not( key in manifest ):
+            raise RuntimeError(f'Sweep manifest has no {key}')
+    parameters = manifest.get('parameters') or {}
+    axes = [ key for key, value in parameters.items() if isinstance(value, list) ]
+    directory = manifest.get('directory',
+                             '{structure}' + ''.join( f'_{key}{{{key}}}' for key in axes ))
+
+    # Structures may be given as name: path or name: {poscar: path, potentials: [...]}
+    structures = {}
+    for name, structure in manifest['structures'].items():
+        if not( isinstance(structure, dict) ):
+            structure = {'poscar': structure}
+        structures[name] = {'poscar': str(Path(root, structure['poscar'])),
+                            'potentials': structure.get('potentials')}
+
+    potcar_dir = manifest.get('potcar')
+    common = {
+        'templates': [ str(p) for p in _template_paths(manifest['templates'], Path(root, manifest.get('templatedir', 'templates/yaml'))) ],
+        'template_dir': str(Path(root, manifest.get('templatedir', 'templates/yaml'))),
+        'system': manifest.get('system'),
+        'potcar': None if potcar_dir is None else str(Path(root, potcar_dir)),
+        'link': manifest.get('link', True),
+        'files': [ str(Path(root, f)) for f in manifest.get('files', []) ],
+        'name': manifest.get('name', ''),
+    }
+
+    jobs = []
+    for name, structure in structures.items():
+        for values in product(*[ parameters[key] for key in axes ]):
+            point = dict(parameters, **dict(zip(axes, values)), structure=name)
+            point = { key:(value.format_map(point) if isinstance(value, str) else value)
+                      for key, value in point.items() }
+            jobs.append(dict(common, structure=structure, parameters=point,
+                             directory=str(Path(root, directory.format_map(point)))))
+    return jobs
+
+
+# Structures and POTCARs already prepared by this process, by source
+_sweep_poscars = {}
+
+
+def _metadata_header(path:Path) -> dict:
+    '''
+    Read the identity lines of an existing metadata.yml so that regenerating a directory keeps them
+    '''
+    header = {}
+    try:
+        with path.open('r') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ['human_name', 'id', 'created'] and not( key in header ):
+                    header[key] = value.strip()
+    except OSError:
+        pass
+    return header
+
+
+def _sweep_structure(source:str) -> tuple[str, list]:
+    '''
+    Return the POSCAR text and species of a structure, read once per process
+    '''
+    if not( source in _sweep_poscars ):
+        poscar = Poscar.from_file(source)
+        _sweep_poscars[source] = (poscar.to_string(), list(poscar.species.keys()))
+    return _sweep_poscars[source]
+
+
+def _share_potcars(points:list) -> None:
+    '''
+    Write one POTCAR for each distinct potential set of the linked jobs,
+    into the first job that uses it, and record it in every job with that
+    set so each worker process links to it rather than writing its own
+    '''
+    written = {}
+    for point in points:
+        if point['potcar'] is None or not( point['link'] ):
+            continue
+        potentials = point['structure']['potentials'] or _sweep_structure(point['structure']['poscar'])[1]
+        potcar = Potcar(potentials, point['potcar'])
+        key = potcar._key(potcar.potential_paths())
+        if not( key in written ):
+            target = Path(point['directory'], 'POTCAR')
+            potcar.generate_file(target, link=True)
+            written[key] = str(target.resolve())
+        point['potcar_written'] = (key, written[key])
+
+
+@phase('write')
+def write_sweep_job(job:dict) -> str:
+    '''
+    Write one calculation directory of a sweep: INCAR, POSCAR, POTCAR, any extra files, and metadata.yml
+    '''
+    directory = Path(job['directory'])
+    directory.mkdir(parents=True, exist_ok=True)
+    parameters = job['parameters']
+
+    # INCAR from the template stack with the placeholders of this point filled in
+    data = expand_placeholders(merge_templates(load_templates([ Path(p) for p in job['templates'] ],
+                                                              Path(job['template_dir']))), parameters)
+    if not( job['system'] == None ):
+        data = incar_system_line(data, job['system'].format_map(parameters))
+    with Path(directory, 'INCAR').open('w') as f:
+        f.write(format_incar(data))
+
+    poscar_text, species = _sweep_structure(job['structure']['poscar'])
+    with Path(directory, 'POSCAR').open('w') as f:
+        f.write(poscar_text)
+
+    # Identical POTCARs are hard linked rather than written again, including
+    # to the one the parent process wrote for this potential set
+    if job['potcar'] is not None:
+        if job.get('potcar_written') is not None:
+            key, path = job['potcar_written']
+            Potcar._written.setdefault(key, Path(path))
+        potentials = job['structure']['potentials'] or species
+        Potcar(potentials, job['potcar']).generate_file(Path(directory, 'POTCAR'), link=job['link'])
+
+    for extra in job['files']:
+        shutil.copyfile(extra, Path(directory, Path(extra).name))
+
+    # Metadata in the format of utilities/package.sh, plus the sweep point
+    metadata_path = Path(directory, METADATA_FILE)
+    header = _metadata_header(metadata_path)
+    lines = ['---',
+             f"human_name: {header.get('human_name', job['name'].format_map(parameters))}",
+             f"id: {header.get('id', uuid4().hex[:12])}",
+             f"created: {header.get('created', datetime.now().strftime('%Y-%m-%dT%H:%M:%S'))}",
+             'status: initialized']
+    sweep = {'structure': parameters['structure'], 'templates': [ Path(p).stem for p in job['templates'] ],
+             'parameters': { k:v for k, v in parameters.items() if k != 'structure' }}
+    temporary = Path(directory, f'.{METADATA_FILE}.tmp')
+    with temporary.open('w') as f:
+        f.write('\n'.join(lines) + '\n')
+        dump({'sweep': sweep}, f, Dumper=CDumper, default_flow_style=False, sort_keys=False)
+    os.replace(temporary, metadata_path)
+    return str(directory)
+
+
+def sweep(manifest_file:str, jobs:int=None, verbose:bool=False) -> list:
+    '''
+    Generate every calculation directory of a sweep manifest with a pool of worker processes
+    '''
+    manifest_path = Path(manifest_file)
+    with manifest_path.open('r') as f:
+        manifest = load(f.read(), Loader=CLoader)
+    if not( isinstance(manifest, dict) ):
+        raise RuntimeError(f'{manifest_path} must be a dictionary')
+    points = expand_manifest(manifest, manifest_path.parent)
+
+    # Validate the templates and placeholders once before fanning out
+    expand_placeholders(merge_templates(load_templates([ Path(p) for p in points[0]['templates'] ],
+                                                       Path(points[0]['template_dir']))),
+                        points[0]['parameters'])
+    directories = [ p['directory'] for p in points ]
+    if len(set(directories)) != len(directories):
+        raise RuntimeError('Sweep directories are not unique, add the grid parameters to the directory pattern')
+
+    _share_potcars(points)
+    if jobs == 1 or len(points) == 1:
+        written = [ write_sweep_job(p) for p in points ]
+    else:
+        # Hand out the points in chunks to keep the pool overhead down
+        workers = jobs or os.cpu_count() or 1
+        with ProcessPoolExecutor(workers) as pool:
+            written = list(pool.map(write_sweep_job, points, chunksize=max(1, len(points) // (8 * workers))))
+    if verbose:
+        print(f'Wrote {len(written)} calculation directories')
+    return written
 
 
 def execute(arguments):
     parser = ArgumentParser(description='Create an INCAR file from provided templates')
 
-    parser.add_argument('source', nargs='+', type=str, help='Source files for INCAR templates')
+    parser.add_argument('source', nargs='*', type=str, help='Source files for INCAR templates')
     parser.add_argument('-o','--output', type=str, default='INCAR', help='Output file directory and name')
     parser.add_argument('-d', '--templatedir', type=str, default='templates/yaml', help='Template directory')
     parser.add_argument('-s', '--system', type=str, help='System name')
+    parser.add_argument('-p', '--parameters', nargs='+', default=[],
+                        help='Values of template placeholders as KEY=VALUE')
+    parser.add_argument('-m', '--manifest', type=str,
+                        help='Sweep manifest to generate calculation directories from instead of one INCAR')
+    parser.add_argument('-j', '--jobs', type=int, help='Number of worker processes for sweeps <DEFAULT number of CPUs>')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('--profile', action='store_true',
+                        help='Write the time of each phase, bytes read and written, and peak memory as a JSON line '
+                             'to stderr | Also enabled by VAPACK_PROFILE=1')
+    parser.add_argument('--profile_file', type=str, metavar='FILE',
+                        help='Append the profile JSON line to FILE instead of stderr | Also enabled by VAPACK_PROFILE=FILE')
+    parser.add_argument('--profile_dump', type=str, metavar='FILE', help='Also write cProfile statistics of the run to FILE')
 
     args = parser.parse_args(arguments)
 
+    if args.profile or args.profile_file is not None or args.profile_dump is not None:
+        profiling.configure(args.profile_file, args.profile_dump)
+    if args.manifest == None and len(args.source) == 0:
+        parser.error('at least one template is required without a manifest')
+    with profiling.profiled('inkit', 'sweep' if args.manifest is not None else 'merge'):
+        run(args)
+
+
+def run(args) -> None:
+    if not( args.manifest == None ):
+        sweep(args.manifest, args.jobs, args.verbose)
+        return
+
     template_dir = Path(args.templatedir)
-    # Create paths to the files, adding the .yaml suffix if it is not specified manually
-    template_files = [ Path(template_dir, i + '.yaml'*(i.find('.yaml')<0)) for i in args.source ]
+    template_files = _template_paths(args.source, template_dir)
     
-    data = None
-    for template in template_files:
-        with template.open('r') as f:
-            template_str = f.read()
-            if data == None:
-                data = load(template_str, Loader=CLoader)
-            else:
-                new_data = load(template_str, Loader=CLoader)
-                update_incar_dict(data, new_data)
+    data = merge_templates(load_templates(template_files, template_dir))
+    if len(args.parameters) > 0:
+        data = expand_placeholders(data, parse_parameters(args.parameters))
     
     if not( args.system == None ):
         data = incar_system_line(data, args.system)
 
     incar_file = Path(args.output)
 
-    incar_str = format_incar(data)
-    with incar_file.open('w') as f:
-        f.write(incar_str)
+    with phase('write'):
+        incar_str = format_incar(data)
+        with incar_file.open('w') as f:
+            f.write(incar_str)
+        count_written(len(incar_str))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+"""
+Plot, and optionally follow, the progress of a VASP run from its OSZICAR or OUTCAR
+"""
+
+from sys import argv, stdout, stderr
+from argparse import ArgumentParser
+from pathlib import Path
+from shutil import get_terminal_size
+from time import sleep
+import numpy as np
+import re
+
+from vasptypes import Oszicar, Outcar
+
+
+# Width of the axis label gutter and the plot title for each quantity
+LABEL_WIDTH = 12
+TITLES = {
+    'E': ('Energy plot from OSZICAR', 'Energy', ' eV '),
+    'F': ('Free energy plot from OSZICAR', 'Free E', ' eV '),
+    'E0': ('Energy (sigma->0) plot from OSZICAR', 'Energy', ' eV '),
+    'T': ('Temperature plot from OSZICAR', ' Temp ', '  K '),
+    'force': ('Maximum Force Norm plot from OUTCAR', 'Force ', 'eV/Å'),
+}
+
+
+class DecimatedSeries(object):
+    '''
+    Running minimum and maximum of a series of steps in a fixed number of buckets.
+    When the steps outgrow the buckets, neighboring buckets are merged and each
+    covers twice as many steps, so adding a value and drawing are constant time.
+    '''
+    def __init__(self, buckets:int, begin:int=1, end:int=0):
+        self.buckets = buckets
+        self.begin = begin
+        self.end = end
+        self.width = 1 if end == 0 else max(1, int(np.ceil((end-begin+1)/buckets)))
+        self.low = np.full(buckets, np.inf)
+        self.high = np.full(buckets, -np.inf)
+        self.last = begin-1
+
+    def add(self, step:int, value:float) -> None:
+        '''
+        Add the value of one step, ignoring steps outside of the window.
+        '''
+        if step < self.begin or (self.end > 0 and step > self.end) or np.isnan(value):
+            return
+        bucket = (step-self.begin) // self.width
+        while bucket >= self.buckets:
+            self._merge()
+            bucket = (step-self.begin) // self.width
+        self.low[bucket] = min(self.low[bucket], value)
+        self.high[bucket] = max(self.high[bucket], value)
+        self.last = max(self.last, step)
+
+    def _merge(self) -> None:
+        '''
+        Merge neighboring pairs of buckets, doubling the steps each one covers.
+        '''
+        half = (self.buckets+1)//2
+        low, high = np.full(self.buckets, np.inf), np.full(self.buckets, -np.inf)
+        low[:half] = np.fmin.reduceat(self.low, np.arange(0, self.buckets, 2))
+        high[:half] = np.fmax.reduceat(self.high, np.arange(0, self.buckets, 2))
+        self.low, self.high = low, high
+        self.width *= 2
+
+    def used(self) -> int:
+        '''
+        Return the number of buckets that have been reached.
+        '''
+        return (self.last-self.begin)//self.width + 1 if self.last >= self.begin else 0
+
+
+def format_plot(series:DecimatedSeries, quantity:str, height:int, width:int) -> str:
+    '''
+    Draw the buckets of a series as a text plot in the same layout as plot.sh
+    '''
+    title, ylabel, unit = TITLES[quantity]
+    used = series.used()
+    if used == 0:
+        return 'No steps to plot yet.\n'
+    low, high = series.low[:used], series.high[:used]
+    filled = np.isfinite(low)
+    top, bottom = high[filled].max(), low[filled].min()
+    rows = max(1, height-2)
+    if abs(top-bottom) < 1e-6:
+        top, bottom = top + 5e-7, bottom - 5e-7
+
+    # Each row covers an equal range, marking buckets whose range reaches it
+    edges = top - (top-bottom)/rows*np.arange(rows+1)
+    marks = (low[None,:] <= edges[:-1,None]) & (high[None,:] >= edges[1:,None]) & filled[None,:]
+    lines = [ ' '*max(0, (LABEL_WIDTH+used+2-len(title))//2) + title ]
+    for j, row in enumerate(marks):
+        if j == 0:
+            label = f'{top:.6g}'
+        elif j == rows-1:
+            label = f'{bottom:.6g}'
+        elif j == rows//2 - 1:
+            label = ylabel
+        elif j == rows//2:
+            label = unit
+        else:
+            label = ''
+        lines.append(f'{label:>{LABEL_WIDTH-1}} |' + ''.join( np.where(row, '.', ' ') ))
+    lines.append(' '*LABEL_WIDTH + '|' + '_'*used)
+    first, last = str(series.begin), str(series.last)
+    padding = max(1, (used - len(first) - len(last) - 4)//2)
+    lines.append(' '*(LABEL_WIDTH+1) + first + ' '*padding + 'Step' + ' '*padding + last)
+    return '\n'.join(lines) + '\n'
+
+
+class Monitor(object):
+    '''
+    Incrementally read an OSZICAR (energies, temperature) or OUTCAR (force norm)
+    and keep a decimated series of the chosen quantity.
+    '''
+    def __init__(self, file:Path, quantity:str, buckets:int, begin:int=1, end:int=0):
+        self.quantity = quantity
+        self.series = DecimatedSeries(buckets, begin, end)
+        if quantity == 'force':
+            self.source = Outcar(file, persist=False)
+            self.read = 0
+        else:
+            self.source = Oszicar(file)
+            self.read = 0
+        self.update(refresh=False)
+
+    def update(self, refresh:bool=True) -> int:
+        '''
+        Read appended data and add any new steps to the series.
+        '''
+        if refresh:
+            self.source.refresh()
+        count = len(self.source)
+        for index in range(self.read, count):
+            if self.quantity == 'force':
+                forces = self.source.forces(index)
+                self.series.add(index+1, np.sqrt((forces**2).sum(axis=1)).max())
+            else:
+                values = self.source.values[index]
+                # Relaxations have no E= field, so fall back to F= as plot.sh does
+                key = 'F' if self.quantity == 'E' and not( 'E' in values ) else self.quantity
+                self.series.add(self.source.steps[index], values.get(key, np.nan))
+        new = count - self.read
+        self.read = count
+        return new
+
+
+def execute(arguments):
+    parser = ArgumentParser(description='Plot the progress of a VASP run from an OSZICAR or OUTCAR')
+
+    parser.add_argument('file', type=str, help='OSZICAR, or OUTCAR with -F')
+    parser.add_argument('-y', '--height', type=int, default=20, help='Plot height <DEFAULT 20>')
+    parser.add_argument('-w', '--width', type=int, default=get_terminal_size().columns,
+                        help='Plot width <DEFAULT terminal width>')
+    parser.add_argument('-b', '--begin', type=int, default=1, help='First step to plot <DEFAULT 1>')
+    parser.add_argument('-e', '--end', type=int, default=0, help='Last step to plot <DEFAULT last step>')
+    parser.add_argument('-F', '--force', action='store_true', help='Plot the maximum force norm from an OUTCAR')
+    parser.add_argument('-q', '--quantity', choices=['E','F','E0','T'], default='E',
+                        help='OSZICAR quantity to plot <DEFAULT E>')
+    parser.add_argument('-f', '--follow', action='store_true', help='Keep redrawing as the file grows')
+    parser.add_argument('-i', '--interval', type=float, default=2.0, help='Seconds between updates when following')
+
+    args = parser.parse_args(arguments)
+
+    # Sanity checks on the file and the options, as in plot.sh
+    file = Path(args.file)
+    with file.open('rb') as f:
+        first_line = f.readline().decode(errors='replace')
+    if args.force and not( re.search(r'vasp\.[56].*', first_line) ):
+        print('Are you sure this is an OUTCAR file?', file=stderr)
+        return 1
+    if not( args.force ) and not( re.search(r'N\s*E\s*dE\s*d eps\s*ncg\s*rms\s*rms\(c\)', first_line) ):
+        print('Are you sure this is an OSZICAR file?', file=stderr)
+        return 1
+    if args.begin < 1:
+        print('Starting index cannot be lower than 1', file=stderr)
+        return 1
+    if args.end != 0 and args.end < args.begin:
+        print('Starting index cannot preceed ending', file=stderr)
+        return 1
+
+    buckets = args.width - LABEL_WIDTH - 2
+    if buckets < 10 or args.height < 3:
+        print('Viewport is too small!!!', file=stderr)
+        return 1
+    quantity = 'force' if args.force else args.quantity
+    monitor = Monitor(file, quantity, buckets, args.begin, args.end)
+    if not( args.follow ) and args.end > 0 and monitor.series.last < args.end:
+        print('End value cannot exceed final step value', file=stderr)
+        return 1
+
+    stdout.write(format_plot(monitor.series, quantity, args.height, args.width))
+    while args.follow:
+        try:
+            sleep(args.interval)
+            if monitor.update() > 0:
+                stdout.write('\x1b[H\x1b[2J' + format_plot(monitor.series, quantity, args.height, args.width))
+                stdout.flush()
+        except KeyboardInterrupt:
+            break
+    return 0
+
+
+if __name__ == "__main__":
+    exit(execute(argv[1:]))
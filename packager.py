@@ -0,0 +1,439 @@
+"""
+Packaging of calculation directories for the cluster and of their results
+
+Replaces utilities/package.sh. Input bundles are self extracting shell
+archives written in one streaming pass: every distinct file content is
+stored once, under its hash, and copied (POTCARs hard linked) into each
+calculation on extraction, so a bundle of many calculations carries each
+POTCAR and template once. Result archives are zip files whose members are
+compressed in parallel across files, written to a temporary file and
+renamed into place. The status in metadata.yml is updated the same way,
+once the archive it describes is complete.
+"""
+
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from tempfile import SpooledTemporaryFile
+import base64
+import hashlib
+import io
+import os
+import re
+import shutil
+import struct
+import time
+import zipfile
+import zlib
+
+
+METADATA_FILE = 'metadata.yml'
+JOB_SCRIPT = 'vasp.slurm'
+INPUT_FILES = ['INCAR', 'POSCAR', 'POTCAR', 'KPOINTS', JOB_SCRIPT, METADATA_FILE]
+OUTPUT_PREFIX = 'C-'
+BUNDLE_SUFFIX = '.shar'
+# Files hard linked from the store on extraction, as nothing edits them
+LINKED_FILES = ['POTCAR']
+# Results larger than this are left out of the archive, except for those always kept
+RESULT_MAX_BYTES = 100 << 20
+RESULT_ALWAYS = ['OUTCAR']
+
+# Read size when streaming files
+CHUNK_BYTES = 1 << 20
+# Compressed members are held in memory up to this size before spilling to disk
+SPOOL_BYTES = 32 << 20
+# Directory of the content store inside an extracted bundle
+STORE = '.vapack-store'
+# Length of the hashes naming the blobs in the store
+DIGEST_CHARS = 32
+
+# Zip records, as laid out in the PKWARE application note
+_ZIP_LOCAL = struct.Struct('<4s5H3L2H')
+_ZIP_CENTRAL = struct.Struct('<4s6H3L5H2L')
+_ZIP_END = struct.Struct('<4s4H2LH')
+_ZIP64_END = struct.Struct('<4sQ2H2L4Q')
+_ZIP64_LOCATOR = struct.Struct('<4sLQL')
+# Sizes and offsets past this are written with the zip64 extensions
+ZIP64_LIMIT = zipfile.ZIP64_LIMIT
+
+
+def new_calculation_id() -> str:
+    '''
+    Return a new 12 character calculation ID, as package.sh generates them
+    '''
+    return hashlib.sha256(str(time.time_ns()).encode()).hexdigest()[:12]
+
+
+def read_metadata(directory:str) -> dict:
+    '''
+    Return the top level key: value fields of a calculation's metadata.yml
+    '''
+    fields = {}
+    path = Path(directory, METADATA_FILE)
+    if not( path.exists() ):
+        return fields
+    with path.open('r') as f:
+        for line in f:
+            match = re.match(r'([A-Za-z_]\w*):[ \t]*(.*?)\s*$', line)
+            if match is not None and not( match.group(1) in fields ):
+                fields[match.group(1)] = match.group(2)
+    return fields
+
+
+def updated_metadata(directory:str, **fields) -> str:
+    '''
+    Return the contents of a calculation's metadata.yml with top level
+    fields set, without writing it
+    '''
+    path = Path(directory, METADATA_FILE)
+    lines = path.read_text().splitlines() if path.exists() else ['---']
+    remaining = dict(fields)
+    for i, line in enumerate(lines):
+        key = line.split(':', 1)[0]
+        if ':' in line and key in remaining:
+            lines[i] = f'{key}: {remaining.pop(key)}'
+    lines.extend( f'{key}: {value}' for key, value in remaining.items() )
+    return '\n'.join(lines) + '\n'
+
+
+def update_metadata(directory:str, **fields) -> None:
+    '''
+    Set top level fields of a calculation's metadata.yml, such as its status.
+    The file is replaced atomically so a reader never sees a partial update.
+    '''
+    text = updated_metadata(directory, **fields)
+    temporary = Path(directory, f'.{METADATA_FILE}.{os.getpid()}.tmp')
+    with temporary.open('w') as f:
+        f.write(text)
+    os.replace(temporary, Path(directory, METADATA_FILE))
+
+
+def initialize(directory:str, human_name:str=None) -> dict:
+    '''
+    Create the metadata of a calculation, keeping the ID and creation date of
+    existing metadata as package.sh -i does. Returns the metadata fields.
+    '''
+    fields = read_metadata(directory)
+    update_metadata(directory,
+                    human_name=human_name if human_name is not None else fields.get('human_name', ''),
+                    id=fields.get('id') or new_calculation_id(),
+                    created=fields.get('created') or datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+                    status='initialized')
+    return read_metadata(directory)
+
+
+def set_status(directory:str, status:str) -> None:
+    update_metadata(directory, status=status)
+
+
+def _open_source(source) -> io.IOBase:
+    '''
+    Open a file, or bytes standing in for one, for reading
+    '''
+    return io.BytesIO(source) if isinstance(source, bytes) else source.open('rb')
+
+
+def _quote(text:str) -> str:
+    '''
+    Quote a string for the shell
+    '''
+    return "'" + text.replace("'", "'\\''") + "'"
+
+
+def _blob_header(command:str, digest:str) -> bytes:
+    return f"{command} > {_quote(f'{STORE}/{digest}')} <<'_VAPACK_{digest}_'\n".encode()
+
+
+def _write_blob(out, source, size:int, binary:bool) -> str:
+    '''
+    Stream one file, or bytes standing in for one, into the archive as a
+    here-document that recreates it exactly, hashing it on the way. Text is
+    stored as is and trimmed to its size by head, anything else is base64.
+    The blob is named by the hash, so its header is written with a
+    placeholder and filled in at the end. Returns the hash, or None if text
+    turns out to hold NUL bytes, which a here-document cannot carry.
+    '''
+    command = 'base64 -d' if binary else f'head -c {size}'
+    start = out.tell()
+    out.write(_blob_header(command, '0' * DIGEST_CHARS))
+    digest = hashlib.blake2b(digest_size=DIGEST_CHARS // 2)
+    read = 0
+    with _open_source(source) as f:
+        if binary:
+            # Encode in multiples of 57 bytes so the lines join up across chunks
+            for chunk in iter(lambda: f.read(57 * 18396), b''):
+                digest.update(chunk)
+                read += len(chunk)
+                out.write(base64.encodebytes(chunk))
+        else:
+            for chunk in iter(lambda: f.read(CHUNK_BYTES), b''):
+                if b'\0' in chunk:
+                    return None
+                digest.update(chunk)
+                read += len(chunk)
+                out.write(chunk)
+            out.write(b'\n')
+    if read != size:
+        raise RuntimeError(f'{source} changed size while being packaged')
+    digest = digest.hexdigest()
+    out.write(f'_VAPACK_{digest}_\n'.encode())
+    end = out.tell()
+    out.seek(start)
+    out.write(_blob_header(command, digest))
+    out.seek(end)
+    return digest
+
+
+def _store_blob(out, source, stored:set, known:dict) -> str:
+    '''
+    Write a file, or bytes standing in for one, to the archive unless its
+    content is already stored, and return its hash. Each file is read once,
+    hashed as it is written: a copy of a stored blob is cut off again once
+    its hash is known, and a file seen before with the same inode, size and
+    modification time is not read at all. Only text found to hold NUL bytes
+    is read a second time, to store it as base64.
+    '''
+    identity = None
+    if isinstance(source, bytes):
+        size = len(source)
+    else:
+        stat = source.stat()
+        size = stat.st_size
+        identity = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        if identity in known:
+            return known[identity]
+    start = out.tell()
+    digest = _write_blob(out, source, size, False)
+    if digest is None:
+        out.seek(start)
+        out.truncate()
+        digest = _write_blob(out, source, size, True)
+    if digest in stored:
+        out.seek(start)
+        out.truncate()
+    stored.add(digest)
+    if identity is not None:
+        known[identity] = digest
+    return digest
+
+
+def package(directories:list, output:str=None, files:list=None, submitter:str=None,
+            submit:bool=True) -> Path:
+    '''
+    Write the input files of one or more calculation directories to a self
+    extracting shell archive. Extracting it creates C-<id> for each
+    calculation and, unless run with --unpack-only, submits each job script.
+    Each distinct file content is written once. Directories without
+    metadata are initialized, and every calculation is marked as packaged
+    once the archive is complete. Returns the path of the archive.
+    '''
+    files = INPUT_FILES if files is None else files
+    calculations = []
+    for directory in directories:
+        directory = Path(directory)
+        metadata = read_metadata(directory)
+        if not( 'id' in metadata ) or len(metadata['id']) == 0:
+            metadata = initialize(directory)
+        calculations.append((directory, metadata['id']))
+
+    if output is None:
+        output = f'{OUTPUT_PREFIX}{calculations[0][1]}{BUNDLE_SUFFIX}' if len(calculations) == 1\
+            else f'{OUTPUT_PREFIX}bundle-{new_calculation_id()}{BUNDLE_SUFFIX}'
+    output_path = Path(output)
+
+    temporary = output_path.with_name(f'.{output_path.name}.{os.getpid()}.tmp')
+    try:
+        with temporary.open('wb') as out:
+            out.write(b'#!/bin/sh\n')
+            if submitter is not None:
+                out.write(f'# Packaged by {submitter}\n'.encode())
+            out.write(f'# Created {datetime.now().strftime("%Y-%m-%dT%H:%M:%S")}\n'.encode())
+            out.write(f'set -e\nmkdir -p {STORE}\n'.encode())
+
+            # Hashes of the blobs written, and of the files read by their identity
+            stored, known = set(), {}
+            for directory, calculation_id in calculations:
+                target = _quote(f'{OUTPUT_PREFIX}{calculation_id}')
+                out.write(f'\n# Calculation {OUTPUT_PREFIX}{calculation_id}\nmkdir -p {target}\n'.encode())
+                for name in files:
+                    source = Path(directory, name)
+                    if not( source.is_file() ):
+                        continue
+                    # The packaged metadata already says packaged
+                    if name == METADATA_FILE:
+                        source = updated_metadata(directory, status='packaged').encode()
+                    digest = _store_blob(out, source, stored, known)
+                    source = _quote(f'{STORE}/{digest}')
+                    destination = _quote(f'{OUTPUT_PREFIX}{calculation_id}/{name}')
+                    if name in LINKED_FILES:
+                        out.write(f'ln -f {source} {destination} 2>/dev/null || cp {source} {destination}\n'.encode())
+                    else:
+                        out.write(f'cp {source} {destination}\n'.encode())
+
+            out.write(f'\nrm -rf {STORE}\n'.encode())
+            submissions = [ f'  (cd {_quote(OUTPUT_PREFIX + calculation_id)} && sbatch {JOB_SCRIPT})'
+                            f' || echo "Failed to queue {OUTPUT_PREFIX}{calculation_id}"\n'
+                            for directory, calculation_id in calculations
+                            if Path(directory, JOB_SCRIPT).is_file() ]
+            # An empty if block is a syntax error to sh
+            if submit and len(submissions) > 0:
+                out.write(b'\nif [ ! "$1" = "--unpack-only" ]; then\n')
+                out.write(''.join(submissions).encode())
+                out.write(b'fi\n')
+            out.write(b'exit 0\n')
+        os.chmod(temporary, 0o755)
+        os.replace(temporary, output_path)
+    finally:
+        if temporary.exists():
+            temporary.unlink()
+
+    for directory, _ in calculations:
+        set_status(directory, 'packaged')
+    return output_path
+
+
+def result_files(directory:str, exclude:list=[]) -> list:
+    '''
+    Files of a finished calculation worth keeping: every file in the directory
+    below the size limit, plus those always kept (the OUTCAR) regardless of size.
+    Hidden files and archives are skipped.
+    '''
+    paths = []
+    for path in sorted(Path(directory).iterdir()):
+        if not( path.is_file() ) or path.name in exclude or path.name.startswith('.'):
+            continue
+        # Never archive earlier archives
+        if path.suffix in ['.zip', BUNDLE_SUFFIX]:
+            continue
+        if path.name in RESULT_ALWAYS or path.stat().st_size < RESULT_MAX_BYTES:
+            paths.append(path)
+    return paths
+
+
+def _deflate(path:Path, level:int) -> tuple:
+    '''
+    Compress a file to a raw deflate stream, returning the spooled stream,
+    its CRC, and the uncompressed and compressed sizes
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    spool = SpooledTemporaryFile(max_size=SPOOL_BYTES)
+    crc, size = 0, 0
+    with path.open('rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_BYTES), b''):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            spool.write(compressor.compress(chunk))
+    spool.write(compressor.flush())
+    compressed_size = spool.tell()
+    spool.seek(0)
+    return spool, crc, size, compressed_size
+
+
+def _copy(out, path:Path) -> tuple[int, int]:
+    '''
+    Copy a file into the archive, returning its CRC and size
+    '''
+    crc, size = 0, 0
+    with path.open('rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_BYTES), b''):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            out.write(chunk)
+    return crc, size
+
+
+def _zip_header(info:zipfile.ZipInfo, central:bool=False) -> bytes:
+    '''
+    Return the local or central directory header of a zip member, with the
+    zip64 extra field when its sizes or offset do not fit in 32 bits
+    '''
+    name = info.filename.encode('utf-8')
+    # Bit 11 marks UTF-8 names
+    flags = 0 if name.isascii() else 0x800
+    zip64 = info.file_size > ZIP64_LIMIT or info.compress_size > ZIP64_LIMIT
+    sizes = (0xFFFFFFFF, 0xFFFFFFFF) if zip64 else (info.compress_size, info.file_size)
+    fields = [info.file_size, info.compress_size] if zip64 else []
+    offset = info.header_offset
+    if central and offset > ZIP64_LIMIT:
+        fields.append(offset)
+        offset = 0xFFFFFFFF
+    extra = struct.pack(f'<2H{len(fields)}Q', 1, 8 * len(fields), *fields) if len(fields) > 0 else b''
+    version = 45 if len(extra) > 0 else 20
+    year, month, day, hour, minute, second = info.date_time
+    dos_time = (hour << 11) | (minute << 5) | (second // 2)
+    dos_date = ((year - 1980) << 9) | (month << 5) | day
+    if not( central ):
+        return _ZIP_LOCAL.pack(b'PK\x03\x04', version, flags, info.compress_type, dos_time, dos_date,
+                               info.CRC, *sizes, len(name), len(extra)) + name + extra
+    return _ZIP_CENTRAL.pack(b'PK\x01\x02', (3 << 8) | version, version, flags, info.compress_type, dos_time, dos_date,
+                             info.CRC, *sizes, len(name), len(extra), 0, 0, 0, info.external_attr, offset) + name + extra
+
+
+def _zip_end(count:int, start:int, size:int) -> bytes:
+    '''
+    Return the end of central directory record, preceded by its zip64
+    version when the member count, size or offset do not fit
+    '''
+    end = b''
+    if count >= 0xFFFF or start > ZIP64_LIMIT or size > ZIP64_LIMIT:
+        end += _ZIP64_END.pack(b'PK\x06\x06', _ZIP64_END.size - 12, 45, 45, 0, 0, count, count, size, start)
+        end += _ZIP64_LOCATOR.pack(b'PK\x06\x07', 0, start + size, 1)
+        count, start, size = min(count, 0xFFFF), min(start, 0xFFFFFFFF), min(size, 0xFFFFFFFF)
+    return end + _ZIP_END.pack(b'PK\x05\x06', 0, 0, count, count, size, start, 0)
+
+
+def archive_results(directory:str, output:str=None, compress:bool=False, level:int=6,
+                    jobs:int=None) -> Path:
+    '''
+    Write the results of a calculation to a zip file in one pass. Without
+    compression members are stored, like the zip -0 of package.sh. With it,
+    members are deflated in parallel by a pool of threads, each into its own
+    spooled stream, and appended in order. The zipfile module cannot add
+    compressed data, so the zip records are written here.
+    The archive is updated by replacing it, never left partially written.
+    '''
+    directory = Path(directory)
+    if output is None:
+        output = f"{OUTPUT_PREFIX}{read_metadata(directory).get('id', directory.resolve().name)}.zip"
+    output_path = Path(directory, output) if not( Path(output).is_absolute() ) else Path(output)
+    paths = result_files(directory, exclude=[output_path.name])
+
+    temporary = output_path.with_name(f'.{output_path.name}.{os.getpid()}.tmp')
+    try:
+        with temporary.open('wb') as out, ThreadPoolExecutor(jobs) as pool:
+            futures = [ pool.submit(_deflate, path, level) if compress else None for path in paths ]
+            members = []
+            for path, future in zip(paths, futures):
+                info = zipfile.ZipInfo.from_file(path, path.name, strict_timestamps=False)
+                info.header_offset = out.tell()
+                if future is None:
+                    # Stored members are copied straight in, and the header
+                    # written before them filled in once their CRC is known
+                    info.compress_type = zipfile.ZIP_STORED
+                    info.CRC, info.compress_size = 0, info.file_size
+                    header = _zip_header(info)
+                    out.write(header)
+                    info.CRC, info.file_size = _copy(out, path)
+                    info.compress_size = info.file_size
+                    if len(_zip_header(info)) != len(header):
+                        raise RuntimeError(f'{path} changed size while being archived')
+                    end = out.tell()
+                    out.seek(info.header_offset)
+                    out.write(_zip_header(info))
+                    out.seek(end)
+                else:
+                    spool, info.CRC, info.file_size, info.compress_size = future.result()
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    out.write(_zip_header(info))
+                    with spool:
+                        shutil.copyfileobj(spool, out, CHUNK_BYTES)
+                members.append(info)
+            start = out.tell()
+            for info in members:
+                out.write(_zip_header(info, central=True))
+            out.write(_zip_end(len(members), start, out.tell() - start))
+        os.replace(temporary, output_path)
+    finally:
+        if temporary.exists():
+            temporary.unlink()
+    return output_path
@@ -5,8 +5,8 @@ Command line program that provides easy access to tools in Vasp Tool Kit
 """
 
 import poskit_lib
+import profiling
 from argparse import ArgumentParser
-from copy import deepcopy
 import sys
 
 subcommands = [ sc for sc in poskit_lib.Subcommand.__subclasses__() ]
@@ -15,11 +15,22 @@ subcommands = [ sc for sc in poskit_lib.Subcommand.__subclasses__() ]
 parser = ArgumentParser( description='Do things for VASP' )
 parser.add_argument( '-v', '--verbose', action='store_true' )
 parser.add_argument( '-n', '--no_write', action='store_true' )
+parser.add_argument( '-b', '--batch', action='store_true',
+                     help='Treat the input as a glob pattern or @file list and process every match' )
+parser.add_argument( '-j', '--jobs', type=int,
+                     help='Number of worker processes in batch mode <DEFAULT number of CPUs>' )
+parser.add_argument( '--profile', action='store_true',
+                     help='Write the time of each phase, bytes read and written, and peak memory as a JSON line \
+                        to stderr | Also enabled by VAPACK_PROFILE=1' )
+parser.add_argument( '--profile_file', type=str, metavar='FILE',
+                     help='Append the profile JSON lines to FILE instead of stderr | Also enabled by VAPACK_PROFILE=FILE' )
+parser.add_argument( '--profile_dump', type=str, metavar='FILE',
+                     help='Also write cProfile statistics of the run to FILE' )
 subparsers = parser.add_subparsers()
 
 # Iterate through the subcommands and add the subparsers to the top level
 for subcommand in subcommands:
-    subcommand.parser.set_defaults( func=subcommand.run )
+    subcommand.parser.set_defaults( func=subcommand.run, subcommand=subcommand )
     subparsers.add_parser(subcommand.__name__, parents=[subcommand.parser],
                           add_help=False, help=subcommand.description)
 
@@ -29,11 +40,24 @@ args = parser.parse_args()
 # If a subparser was called, it'll set func in the args namespace
 if args.__contains__('func'):
     # Get a dictionary of the arguments to pass to the run function
-    arg_dict = deepcopy(args.__dict__)
-    # Remove the func entry
+    arg_dict = dict(args.__dict__)
+    # Remove the entries that are not arguments of the run function
     arg_dict.pop('func')
-    # Run the appropriate function with all arguments
-    args.func(**arg_dict)
+    subcommand = arg_dict.pop('subcommand')
+    batch = arg_dict.pop('batch')
+    jobs = arg_dict.pop('jobs')
+    profile = arg_dict.pop('profile')
+    profile_file = arg_dict.pop('profile_file')
+    profile_dump = arg_dict.pop('profile_dump')
+    # Set through the environment so batch workers are profiled too
+    if profile or profile_file is not None or profile_dump is not None:
+        profiling.configure(profile_file, profile_dump)
+    # Run the appropriate function with all arguments, once per input in batch mode
+    with profiling.profiled('poskit', subcommand.__name__, input=arg_dict.get('input'), batch=batch):
+        if batch:
+            failures = poskit_lib.run_batch(subcommand, arg_dict, jobs)
+            sys.exit(1 if len(failures) > 0 else 0)
+        args.func(**arg_dict)
 
 # If func was not set, print the help message and quit
 else:
@@ -1,10 +1,14 @@
-from vasptypes import Ion, Poscar, Incar, Potcar
+from vasptypes import Ion, Poscar, Incar, Potcar, PotentialIndex
 import vasptypes_extension as vte
+import profiling
 from argparse import Namespace
 from pathlib import Path
 import numpy as np
 from argparse import ArgumentParser, Namespace
-from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import glob
+import traceback
+import sys
 
 # Notes to whoever attempts to maintain this:
 #
@@ -23,19 +27,114 @@ from copy import deepcopy
 #    same arguments as are created in its parser's namespace.
 #    In addition, it must also take any that are present in
 #    the parent parser's namespace (currently only 'verbose'
-#    and 'no_write').
+#    and 'no_write'). The batch and profiling options of the
+#    parent parser are consumed by the main program and never
+#    passed on.
+#
+# 4. Subcommands that take a single 'input' can be run in batch
+#    mode. Their outputs are placed beside each input and named
+#    with the subcommand's suffix, or by overriding batch_output.
 
 # Template class for subcommands. Must be derived from to be
 # automatically discovered.
 class Subcommand:
     description = ""
     parser = ArgumentParser()
+    # Added to the input file stem to name outputs in batch mode
+    suffix = None
     @staticmethod
     def run():
         pass
 
+    @classmethod
+    def batch_output(cls, input_path:Path, output:str=None) -> Path:
+        """
+        Return the output path for one input of a batch.
+        """
+        if cls.suffix is None:
+            raise RuntimeError(f'{cls.__name__} does not support batch mode')
+        return input_path.with_name(f"{input_path.stem}{cls.suffix}{input_path.suffix}")
+
+def expand_inputs(pattern:str) -> list[Path]:
+    """
+    Expand a glob pattern, or a file list given as @file with one path per line,
+    into a sorted list of input paths.
+    """
+    if pattern.startswith('@'):
+        lines = Path(pattern[1:]).read_text().splitlines()
+        paths = [ l.strip() for l in lines if len(l.strip()) > 0 and not( l.strip().startswith('#') ) ]
+    else:
+        paths = sorted(glob(pattern, recursive=True))
+    return [ Path(p) for p in paths ]
+
+def _run_batch_item(run, arguments:dict) -> str:
+    """
+    Run one item of a batch, returning the error message if it fails.
+    """
+    try:
+        # Each input gets its own profile line, the batch as a whole gets another.
+        # Workers run many inputs, so their peak resident set size is not the input's
+        with profiling.profiled('poskit', run.__qualname__.split('.')[0], dump=False, rss=False,
+                                input=arguments.get('input')):
+            run(**arguments)
+    except Exception:
+        return traceback.format_exc(limit=-1).strip()
+    return None
+
+def run_batch(subcommand:type, arguments:dict, jobs:int=None) -> dict:
+    """
+    Run a subcommand over every input matched by its 'input' argument using a
+    pool of worker processes. Errors are collected per file rather than
+    aborting the batch, and progress is reported on stderr unless profile
+    lines are written there. Returns a dictionary of failed inputs and their errors.
+    """
+    if not( 'input' in arguments ):
+        raise RuntimeError(f'{subcommand.__name__} does not support batch mode')
+    inputs = expand_inputs(arguments['input'])
+    if len(inputs) == 0:
+        raise RuntimeError(f"No inputs matched {arguments['input']}")
+
+    # Per input arguments with the outputs placed beside the inputs
+    items = {}
+    for input_path in inputs:
+        item = dict(arguments, input=str(input_path))
+        if 'output' in arguments:
+            item['output'] = str(subcommand.batch_output(input_path, arguments['output']))
+        items[input_path] = item
+
+    failures = {}
+    # The progress line is rewritten in place, which would run into profile lines
+    progress = not( profiling.enabled() and profiling.to_stderr() )
+    def report(done:int) -> None:
+        if progress:
+            sys.stderr.write(f"\r{subcommand.__name__}: {done}/{len(items)} done, {len(failures)} failed")
+            sys.stderr.flush()
+
+    if jobs == 1:
+        for done, (input_path, item) in enumerate(items.items(), start=1):
+            error = _run_batch_item(subcommand.run, item)
+            if error is not None:
+                failures[input_path] = error
+            report(done)
+    else:
+        with ProcessPoolExecutor(jobs) as pool:
+            futures = { pool.submit(_run_batch_item, subcommand.run, item):input_path
+                        for input_path, item in items.items() }
+            for done, future in enumerate(as_completed(futures), start=1):
+                error = future.result()
+                if error is not None:
+                    failures[futures[future]] = error
+                report(done)
+    if progress:
+        sys.stderr.write('\n')
+
+    for input_path, error in failures.items():
+        sys.stderr.write(f"{input_path}: {error.splitlines()[-1]}\n")
+    return failures
+
 class convert(Subcommand):
     description='Convert the ion position mode of a given POSCAR'
+    suffix = '_convert'
     parser = ArgumentParser()
     parser.add_argument( 'input', type=str, help='Input file' )
     parser.add_argument( '-m', '--mode', default='toggle', choices=['cartesian','direct','toggle'],
@@ -82,6 +181,7 @@ class convert(Subcommand):
 
 class vacuum(Subcommand):
     description='Add vacuum layers to a given POSCAR'
+    suffix = '_vacuum'
     parser = ArgumentParser()
     parser.add_argument( 'input', type=str, help='Input file' )
     parser.add_argument( 'depth', nargs=3, type=float,
@@ -116,7 +216,7 @@ class vacuum(Subcommand):
         # Take the 3 valued depth, cast to 3x3 diagonal matrix, and add to lattice
         if type(depth) != np.array:
             depth = np.array(depth)
-        poscar.lattice += np.diag(depth)
+        poscar.lattice = poscar.lattice + np.diag(depth)
 
         # Write the new POSCAR
         if not(no_write):
@@ -129,6 +229,99 @@ class vacuum(Subcommand):
             else:
                 print( 'Changes written to {}'.format(output_path) )
 
+class supercell(Subcommand):
+    description = 'Build a supercell from a diagonal or general integer transformation matrix'
+    suffix = '_supercell'
+    parser = ArgumentParser()
+    parser.add_argument( 'input', type=str, help='Input file' )
+    parser.add_argument( 'matrix', nargs='+', type=int,
+                        help='3 integers for a diagonal supercell, or 9 for a general matrix \
+                            given row by row' )
+    parser.add_argument( '-o', '--output', type=str,
+                        help='Output file <DEFAULT \'file-stem\'_supercell.\'file-suffix\'>' )
+
+    @staticmethod
+    def run(input:str, matrix:list[int], output:str=None,
+            verbose:bool=False, no_write:bool=False) -> None:
+        # Determine output location
+        input_path = Path(input)
+        output_path = Path(f"{input_path.stem}_supercell{input_path.suffix}")\
+            if output is None else Path(output)
+
+        if not( len(matrix) in [3, 9] ):
+            raise RuntimeError('Supercell matrix must have 3 or 9 entries!')
+
+        # Read in the file and build the supercell
+        poscar = Poscar.from_file(input_path)
+        result = poscar.supercell(matrix)
+
+        # Verbose message
+        if verbose:
+            print( f'Built a supercell of {len(result.positions)} ions from {input_path}' )
+
+        # Write the new POSCAR
+        if not(no_write):
+            result.to_file(output_path)
+
+        # Verbosity messages
+        if verbose:
+            if no_write:
+                print( 'No changes written' )
+            else:
+                print( 'Changes written to {}'.format(output_path) )
+
+class check(Subcommand):
+    description = 'Report overlapping ions, optionally merging duplicates'
+    suffix = '_merged'
+    parser = ArgumentParser()
+    parser.add_argument( 'input', type=str, help='Input file' )
+    parser.add_argument( '-t', '--threshold', type=float, default=0.5,
+                        help='Minimum allowed distance between ions in Angstroms <DEFAULT 0.5>' )
+    parser.add_argument( '-s', '--species_thresholds', nargs='+', default=[],
+                        help='Per species minimum distances as Species=distance | Each pair \
+                            uses the larger value of its two species' )
+    parser.add_argument( '-m', '--merge', type=float,
+                        help='Merge ions of the same species closer than this tolerance' )
+    parser.add_argument( '-o', '--output', type=str,
+                        help='Output file when merging <DEFAULT \'file-stem\'_merged.\'file-suffix\'>' )
+
+    @staticmethod
+    def run(input:str, threshold:float=0.5, species_thresholds:list=[], merge:float=None,
+            output:str=None, verbose:bool=False, no_write:bool=False) -> None:
+        # Determine output location
+        input_path = Path(input)
+        output_path = Path(f"{input_path.stem}_merged{input_path.suffix}")\
+            if output is None else Path(output)
+
+        # Build the thresholds
+        thresholds = {'default': threshold}
+        for entry in species_thresholds:
+            name, _, value = entry.partition('=')
+            if len(value) == 0:
+                raise RuntimeError(f'Species threshold {entry} must be given as Species=distance')
+            thresholds[name] = float(value)
+
+        poscar = Poscar.from_file(input_path)
+
+        # Merge duplicates first so that only real overlaps remain
+        if merge is not None:
+            removed = poscar.merge_duplicates(merge)
+            if verbose:
+                print( f'Merged {removed} duplicate ions' )
+            if not(no_write) and removed > 0:
+                poscar.to_file(output_path)
+                if verbose:
+                    print( 'Changes written to {}'.format(output_path) )
+
+        first, second, distances = poscar.overlaps(thresholds)
+        names = np.array(list(poscar.species.keys()))[poscar.species_indices]
+        for i, j, d in zip(first, second, distances):
+            print( f'{input_path}: ions {i} ({names[i]}) and {j} ({names[j]}) are {d:.4f} A apart' )
+        if len(first) > 0:
+            raise RuntimeError(f'{input_path} has {len(first)} overlapping pairs of ions')
+        if verbose:
+            print( f'{input_path}: no overlapping ions' )
+
 class potcar(Subcommand):
     description = 'Create a potcar from given input'
     parser = ArgumentParser()
@@ -141,10 +334,20 @@ class potcar(Subcommand):
     parser.add_argument( '-d', '--directory', default='./potcar', type=str,
                         help='Directory of POTCAR folders <DEFAULT ./potcar/> | Can be used \
                             to specify PBE or LDA manually' )
+    parser.add_argument( '-l', '--link', action='store_true',
+                        help='Hard link identical POTCARs instead of copying them again | Linked \
+                            files share their contents, so do not edit them in place' )
+
+    @classmethod
+    def batch_output(cls, input_path:Path, output:str='POTCAR') -> Path:
+        """
+        Place each POTCAR beside its POSCAR under the given output name.
+        """
+        return Path(input_path.parent, Path(output).name)
 
     @staticmethod
     def run(input:str, output:str='POTCAR', potentials:list=[], directory:str='.',
-            verbose:bool=False, no_write:bool=False):
+            link:bool=False, verbose:bool=False, no_write:bool=False):
         # Cast input, output, and directory to paths
         input_path = Path(input)
         output_path = Path(output)
@@ -182,13 +385,52 @@ class potcar(Subcommand):
                 print( 'No changes written' )
             return
         
-        potcar.generate_file(output_path)
+        potcar.generate_file(output_path, link=link)
 
         if verbose:
             print( 'Changes written to {}'.format(output_path) )
 
+class electrons(Subcommand):
+    description = 'Count valence electrons and suggest ENCUT and NBANDS from the POTCAR headers'
+    parser = ArgumentParser()
+    parser.add_argument( 'input', type=str, help='Input POSCAR' )
+    parser.add_argument( '-p', '--potentials', nargs='+', default=[],
+                        help='List of potentials | Useful for potentials that differ from the ion species name')
+    parser.add_argument( '-d', '--directory', default='./potcar', type=str,
+                        help='Directory of POTCAR folders <DEFAULT ./potcar/> | Can be used \
+                            to specify PBE or LDA manually' )
+    parser.add_argument( '-s', '--ispin', type=int, default=1, choices=[1, 2],
+                        help='ISPIN used for the NBANDS estimate <DEFAULT 1>' )
+    parser.add_argument( '-m', '--magnetization', type=float, default=0.0,
+                        help='Total magnetic moment used for the NBANDS estimate with ISPIN = 2 <DEFAULT 0>' )
+    parser.add_argument( '--npar', type=int, default=1,
+                        help='Round NBANDS up to a multiple of this <DEFAULT 1>' )
+    parser.add_argument( '-f', '--factor', type=float, default=1.3,
+                        help='ENCUT as a multiple of the largest ENMAX <DEFAULT 1.3>' )
+    parser.add_argument( '--build', action='store_true',
+                        help='Index every potential in the directory before counting' )
+
+    @staticmethod
+    def run(input:str, potentials:list=[], directory:str='./potcar', ispin:int=1,
+            magnetization:float=0.0, npar:int=1, factor:float=1.3, build:bool=False,
+            verbose:bool=False, no_write:bool=False):
+        poscar = Poscar.from_file(input)
+        species = potentials if len(potentials) > 0 else list(poscar.species.keys())
+        potcar = Potcar(species, directory)
+        if build:
+            PotentialIndex.of(potcar.potential_directory()).build()
+
+        if verbose:
+            for sp, data in zip(species, potcar.metadata()):
+                print( f"{sp:<10s} {data['titel']:<30s} ZVAL={data['zval']:g} "
+                       f"ENMAX={data['enmax']:g} POMASS={data['pomass']:g}" )
+
+        print( f"{input}: NELECT = {potcar.nelect(poscar):g}  ENCUT = {potcar.encut(factor):.0f}  "
+               f"NBANDS = {potcar.nbands(poscar, ispin, magnetization, npar)}" )
+
 class slabfreeze(Subcommand):
     description = "Change the selective dynamics flags for all ions inside defined box"
+    suffix = '_frozen'
     parser = ArgumentParser()
     parser.add_argument( 'input', type=str, help='Input file' )
     parser.add_argument( 'dimensions', nargs=3, type=str,
@@ -236,28 +478,23 @@ class slabfreeze(Subcommand):
         dimensions = Ion.list_to_bools(dimensions)
         
         # Get box selection of ions
-        selection = vte.box_select(poscar, x_range, y_range, z_range, mode)
-
-        # Change the selective dynamics of selection
-        for i, _ in enumerate(poscar.ions):
-            d = dimensions
-            if not( i in selection.indices ):
-                if preserve_unspecified:
-                    continue
-                # poscar.ions[i].selective_dynamics = np.array([True]*3, dtype=bool)
-                d = Ion.list_to_bools(['T','T','T'])
-            poscar.ions[i].selective_dynamics = d
+        selection = vte.box_selection(poscar, x_range, y_range, z_range, mode)
+
+        # Change the selective dynamics of selection, resetting the rest unless preserved
+        if not( preserve_unspecified ):
+            poscar.edit_ions(~selection, selective_dynamics=Ion.list_to_bools(['T','T','T']))
+        poscar.edit_ions(selection, selective_dynamics=dimensions)
         poscar.selective_dynamics = True
 
         # Final verbose message
         if verbose:
-            print(f"Switched {len(selection)}/{len(poscar.ions)} ions")
+            print(f"Switched {len(selection)}/{len(poscar.positions)} ions")
 
         # Write the modified poscar
         poscar.to_file(output_path)
 
 class interpolate(Subcommand):
-    description = 'Linearly interpolate images for a NEB calculation from two POSCAR files'
+    description = 'Interpolate images for a NEB calculation from two POSCAR files'
     parser = ArgumentParser()
     parser.add_argument( 'file1', type=str, help='Input file 1' )
     parser.add_argument( 'file2', type=str, help='Input file 2' )
@@ -265,42 +502,48 @@ class interpolate(Subcommand):
                         help='Number of interpolated images to create', default=1 )
     parser.add_argument( '-c', '--center', action="store_true",
                         help='Center the POSCARS about center of mass (unused)' )
+    parser.add_argument( '--idpp', action='store_true',
+                        help='Refine the linear path with the image dependent pair potential' )
+    parser.add_argument( '--steps', type=int, default=100,
+                        help='Maximum number of IDPP steps <DEFAULT 100>' )
+    parser.add_argument( '--fmax', type=float, default=0.1,
+                        help='IDPP force convergence criterion <DEFAULT 0.1>' )
+    parser.add_argument( '-d', '--directory', type=str, default='.',
+                        help='Directory in which to create the image directories <DEFAULT .>' )
+    parser.add_argument( '-w', '--workers', type=int, default=1,
+                        help='Number of processes writing images <DEFAULT 1>' )
 
     @staticmethod
-    def run(file1:str, file2:str, images:int=1, center:bool=False,
+    def run(file1:str, file2:str, images:int=1, center:bool=False, idpp:bool=False,
+            steps:int=100, fmax:float=0.1, directory:str='.', workers:int=1,
             verbose:bool=False, no_write:bool=False):
         # Load the anchors
         poscar1 = Poscar.from_file(file1)
         poscar2 = Poscar.from_file(file2)
 
-        # TODO: Check if the headers match
-
         # Ensure that there are the same number of ions in each
-        if len(poscar1.ions) != len(poscar2.ions):
+        if len(poscar1.positions) != len(poscar2.positions):
             raise RuntimeError('Number of ions do not match!')
-        
-        # Ensure no ions cross the unit cell boundaries
-        for i, (ion1, ion2) in enumerate(zip(poscar1.ions, poscar2.ions)):
-            if (np.sign(ion1.position)*np.sign(ion2.position)).sum() != 3:
-                print(f"Warning: Ion {i} crossed boundary between anchors!")
-
-        # Template the output poscar image
-        image_template = deepcopy(poscar1)
-
-        # Disable selective dynamics in the output
-        image_template.selective_dynamics = False
-
-        # Interpolate between ion positions and save to template
-        for i in range(images+2):
-            # Erase the existing ion data in the template
-            image_template.ions = []
-            # Get interpolated ion positions
-            for ion1, ion2 in zip(poscar1.ions, poscar2.ions):
-                new_ion = Ion()
-                new_ion.position = ion1.position + (ion2.position-ion1.position)/(images+1)*i
-                new_ion.species = ion1.species
-                image_template.ions.append(new_ion)
-            # Create output path
-            output_path = Path( ".", str(i).zfill(2), "POSCAR" )
-            # Write the file
-            image_template.to_file(output_path)
+
+        # All images at once, with each ion taking its minimum image route
+        path = vte.interpolate_path(poscar1, poscar2, images)
+        if idpp:
+            path, taken = vte.idpp_path(path, poscar1.lattice, steps, fmax)
+            if verbose:
+                print( f'IDPP finished after {taken} steps' )
+
+        if no_write:
+            if verbose:
+                print( 'No changes written' )
+            return
+
+        # Template the output with selective dynamics and all MD state of
+        # the first endpoint (velocities, lattice velocities, predictor-corrector
+        # data) left out
+        image_template = poscar1.copy(selective_dynamics=False, velocity_mode=None,
+                                      velocities=np.zeros_like(poscar1.velocities),
+                                      lattice_velocity=None, mdextra='')
+        outputs = vte.write_images(image_template, path, directory, workers)
+
+        if verbose:
+            print( f'Images written to {outputs[0].parent.parent}/00..{len(outputs)-1:02d}' )
@@ -0,0 +1,221 @@
+"""
+Timing and memory instrumentation of poskit and inkit runs
+
+The library marks its work with phases (parse, transform, select, write, ...)
+and counts the bytes it reads and writes. While a run is profiled, each
+phase's wall time is accumulated exclusively, so time spent in a nested
+phase only counts toward the innermost one and the phases add up to the
+whole run. At the end one JSON line is emitted with the phase times, bytes
+read and written, the tracemalloc peak, and the maximum resident set size.
+The resident set size is the peak over the life of the process, so it is
+null for the items of a batch, which share their worker processes.
+When no run is profiled, a phase costs one global lookup. Tracing memory
+slows code that allocates many small objects, such as formatting POSCARs,
+several times over, so it can be turned off for accurate phase times.
+
+Environment variables:
+    VAPACK_PROFILE         1 to write the JSON line to stderr, or a file to append it to
+    VAPACK_PROFILE_DUMP    file to write cProfile statistics of the run to
+    VAPACK_PROFILE_MEMORY  set to 0 to skip tracemalloc, leaving its peak null
+"""
+
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+import cProfile
+import json
+import os
+import resource
+import sys
+import tracemalloc
+
+
+PROFILE_VARIABLE = 'VAPACK_PROFILE'
+DUMP_VARIABLE = 'VAPACK_PROFILE_DUMP'
+MEMORY_VARIABLE = 'VAPACK_PROFILE_MEMORY'
+# Time outside of any phase
+OTHER = 'other'
+
+# The profiler of the run in progress, if any
+_active = None
+
+
+def _switched_on(variable:str, default:str) -> bool:
+    return os.environ.get(variable, default).strip().lower() not in ('', '0', 'false', 'no', 'off')
+
+
+def enabled() -> bool:
+    '''
+    Return whether the environment asks for runs to be profiled
+    '''
+    return _switched_on(PROFILE_VARIABLE, '0')
+
+
+def to_stderr() -> bool:
+    '''
+    Return whether profile lines are written to stderr rather than to a file
+    '''
+    return os.environ.get(PROFILE_VARIABLE, '1').strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def configure(destination:str=None, dump:str=None) -> None:
+    '''
+    Turn profiling on for this process and the processes it starts, as the
+    --profile options do, appending to a file or, by default, writing to stderr
+    '''
+    os.environ[PROFILE_VARIABLE] = '1' if destination is None else destination
+    if dump is not None:
+        os.environ[DUMP_VARIABLE] = dump
+
+
+class Profiler(object):
+    '''
+    Per phase wall time and byte counts of one run
+    '''
+    def __init__(self):
+        self.phases = {}
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self._stack = [OTHER]
+        self._mark = perf_counter()
+
+    def _switch(self) -> None:
+        now = perf_counter()
+        name = self._stack[-1]
+        self.phases[name] = self.phases.get(name, 0.0) + now - self._mark
+        self._mark = now
+
+    def enter(self, name:str) -> None:
+        self._switch()
+        self._stack.append(name)
+
+    def exit(self, name:str) -> None:
+        self._switch()
+        if len(self._stack) > 1 and self._stack[-1] == name:
+            self._stack.pop()
+
+
+class phase(object):
+    '''
+    Attribute the time of a block, or of every call of a decorated function,
+    to the named phase of the run being profiled
+    '''
+    def __init__(self, name:str):
+        self.name = name
+        self._profiler = None
+
+    def __enter__(self):
+        self._profiler = _active
+        if self._profiler is not None:
+            self._profiler.enter(self.name)
+        return self
+
+    def __exit__(self, *args):
+        if self._profiler is not None:
+            self._profiler.exit(self.name)
+            self._profiler = None
+
+    def __call__(self, function):
+        name = self.name
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            profiler = _active
+            if profiler is None:
+                return function(*args, **kwargs)
+            profiler.enter(name)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiler.exit(name)
+        return wrapper
+
+
+def count_read(size:int) -> None:
+    if _active is not None:
+        _active.bytes_read += size
+
+
+def count_written(size:int) -> None:
+    if _active is not None:
+        _active.bytes_written += size
+
+
+def _emit(record:dict) -> None:
+    line = json.dumps(record, separators=(',', ':')) + '\n'
+    if to_stderr():
+        sys.stderr.write(line)
+        sys.stderr.flush()
+        return
+    # One write of the whole line, so lines of parallel workers never interleave
+    descriptor = os.open(os.environ[PROFILE_VARIABLE].strip(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(descriptor, line.encode())
+    finally:
+        os.close(descriptor)
+
+
+@contextmanager
+def profiled(tool:str, command:str, dump:bool=True, rss:bool=True, **fields):
+    '''
+    Profile the enclosed run if the environment asks for it, emitting its
+    JSON line when it ends, even if it fails. Extra fields, such as the
+    input file, are added to the line. With dump, cProfile statistics are
+    also written if VAPACK_PROFILE_DUMP names a file. Without rss, the
+    maximum resident set size is null, for runs that share their process.
+    '''
+    global _active
+    if not( enabled() ):
+        yield None
+        return
+
+    previous = _active
+    profiler = Profiler()
+    memory = _switched_on(MEMORY_VARIABLE, '1')
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+    elif memory:
+        tracemalloc.start()
+    dump_file = os.environ.get(DUMP_VARIABLE) if dump else None
+    statistics = cProfile.Profile() if dump_file else None
+
+    status = 'ok'
+    start = perf_counter()
+    _active = profiler
+    if statistics is not None:
+        statistics.enable()
+    try:
+        yield profiler
+    except SystemExit as error:
+        status = 'ok' if error.code in (None, 0) else f'exit {error.code}'
+        raise
+    except BaseException as error:
+        status = type(error).__name__
+        raise
+    finally:
+        if statistics is not None:
+            statistics.disable()
+        _active = previous
+        profiler._switch()
+        wall = profiler._mark - start
+        peak = None
+        if tracing or memory:
+            _, peak = tracemalloc.get_traced_memory()
+        if memory and not( tracing ):
+            tracemalloc.stop()
+        if statistics is not None:
+            statistics.dump_stats(dump_file)
+        record = {'tool': tool, 'command': command}
+        record.update(fields)
+        record.update({
+            'status': status,
+            'wall_seconds': round(wall, 6),
+            'phases': { name:round(seconds, 6) for name, seconds in profiler.phases.items() },
+            'bytes_read': profiler.bytes_read,
+            'bytes_written': profiler.bytes_written,
+            'tracemalloc_peak_bytes': peak,
+            # Linux reports kilobytes
+            'max_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if rss else None,
+            'pid': os.getpid(),
+        })
+        _emit(record)
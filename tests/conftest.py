@@ -0,0 +1,12 @@
+'''
+The modules are flat files at the top of the repository, and the synthetic
+input generators live with the benchmarks
+'''
+
+from pathlib import Path
+import sys
+
+ROOT = Path(__file__).resolve().parent.parent
+for path in [ROOT, ROOT / 'benchmarks']:
+    if not( str(path) in sys.path ):
+        sys.path.insert(0, str(path))
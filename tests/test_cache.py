@@ -0,0 +1,121 @@
+'''
+On-disk cache of parsed structures and its invalidation
+'''
+
+import numpy as np
+import os
+import pytest
+
+from cache import Cache, default_cache
+from vasptypes import Poscar
+
+from synthetic import write_synthetic_contcar
+
+
+@pytest.fixture
+def cache_directory(tmp_path, monkeypatch):
+    directory = tmp_path / 'cache'
+    monkeypatch.setenv('VAPACK_CACHE_DIR', str(directory))
+    monkeypatch.setenv('VAPACK_CACHE_MIN', '0')
+    monkeypatch.delenv('VAPACK_CACHE', raising=False)
+    return directory
+
+
+@pytest.fixture
+def parses(monkeypatch):
+    '''
+    Count the POSCARs parsed from their text rather than loaded from the cache
+    '''
+    calls = []
+    from_bytes = Poscar.from_bytes.__func__
+    def counted(cls, data):
+        calls.append(len(data))
+        return from_bytes(cls, data)
+    monkeypatch.setattr(Poscar, 'from_bytes', classmethod(counted))
+    return calls
+
+
+def test_hit_is_writable_and_leaves_entry(tmp_path, cache_directory, parses):
+    path = tmp_path / 'CONTCAR'
+    write_synthetic_contcar(path, 1000)
+    parsed = Poscar.from_file(path)
+    cached = Poscar.from_file(path)
+    assert len(parses) == 1
+    assert np.array_equal(cached.positions, parsed.positions)
+    assert np.array_equal(cached.velocities, parsed.velocities)
+    assert cached.to_string() == parsed.to_string()
+
+    cached.positions[0] = [0.5, 0.5, 0.5]
+    cached.dynamics[:] = True
+    again = Poscar.from_file(path)
+    assert len(parses) == 1
+    assert np.array_equal(again.positions[0], parsed.positions[0])
+    assert np.array_equal(again.dynamics, parsed.dynamics)
+
+
+def test_modified_source_is_parsed_again(tmp_path, cache_directory, parses):
+    path = tmp_path / 'CONTCAR'
+    write_synthetic_contcar(path, 1000, seed=1)
+    Poscar.from_file(path)
+    stat = path.stat()
+
+    # Same size and modification time, different content
+    write_synthetic_contcar(path, 1000, seed=2)
+    assert path.stat().st_size == stat.st_size
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    changed = Poscar.from_file(path)
+    assert len(parses) == 2
+    assert np.array_equal(changed.positions, Poscar.from_file(path, cache=False).positions)
+
+    # Same content, new modification time
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    Poscar.from_file(path)
+    assert len(parses) == 4
+    Poscar.from_file(path)
+    assert len(parses) == 4
+
+
+def test_edit_in_the_middle_is_caught(tmp_path, cache_directory, parses):
+    path = tmp_path / 'CONTCAR'
+    write_synthetic_contcar(path, 20000)
+    Poscar.from_file(path)
+    stat = path.stat()
+
+    # One digit of an ion far from either end of the file, keeping size and time
+    data = bytearray(path.read_bytes())
+    line = data.index(b'\n', len(data) // 2) + 1
+    data[line+4] = ord('9') if data[line+4] != ord('9') else ord('8')
+    path.write_bytes(bytes(data))
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    edited = Poscar.from_file(path)
+    assert len(parses) == 2
+    assert np.array_equal(edited.positions, Poscar.from_file(path, cache=False).positions)
+
+
+def test_small_and_disabled(tmp_path, cache_directory, parses, monkeypatch):
+    path = tmp_path / 'CONTCAR'
+    write_synthetic_contcar(path, 10)
+    monkeypatch.setenv('VAPACK_CACHE_MIN', '1M')
+    Poscar.from_file(path)
+    Poscar.from_file(path)
+    assert len(parses) == 2
+
+    monkeypatch.setenv('VAPACK_CACHE', '0')
+    assert default_cache() is None
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    store = Cache(tmp_path / 'cache', max_bytes=1 << 30, min_source_bytes=0)
+    sources = []
+    for i in range(3):
+        sources.append(tmp_path / f'source{i}')
+        sources[-1].write_bytes(bytes([i]) * 1000)
+        store.store(sources[-1], 'test', {'values': np.full(10000, i)}, {'i': i})
+    assert store.load(sources[0], 'test')[1] == {'i': 0}
+
+    # Loading marks the first as used, so the second goes first
+    store.max_bytes = 2 * 90000
+    store.evict()
+    assert store.load(sources[1], 'test') is None
+    assert store.load(sources[0], 'test') is not None
+    assert store.load(sources[2], 'test') is not None
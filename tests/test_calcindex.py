@@ -0,0 +1,190 @@
+'''
+SQLite index of calculation directories and the canonical input hash
+'''
+
+from pathlib import Path
+import os
+import shutil
+import pytest
+
+from calcindex import CalculationIndex, input_hash
+import packager
+import vapack
+
+
+OUTCAR = '''   number of ions     NIONS =      2
+ POSITION                                       TOTAL-FORCE (eV/Angst)
+ -----------------------------------------------------------------------------------
+      0.00000      0.00000      0.00000         0.300000     0.000000     0.400000
+      1.50000      1.50000      1.50000        -0.300000     0.000000    -0.400000
+ -----------------------------------------------------------------------------------
+  free  energy   TOTEN  =       -10.00000000 eV
+
+  energy  without entropy=      -10.10000000  energy(sigma->0) =      -10.05000000
+
+ General timing and accounting informations for this job:
+'''
+
+
+def calculation(directory:Path, species:str='Fe', incar:str='ENCUT = 520\nISMEAR = 0\n',
+                outcar:bool=False) -> Path:
+    directory.mkdir(parents=True)
+    Path(directory, 'INCAR').write_text(incar)
+    Path(directory, 'POSCAR').write_text(f'Test\n1.0\n3 0 0\n0 3 0\n0 0 3\n{species} O\n1 1\n'
+                                         'Direct\n0 0 0\n0.5 0.5 0.5\n')
+    Path(directory, 'KPOINTS').write_text('Automatic\n0\nGamma\n4 4 4\n')
+    packager.initialize(directory, directory.name)
+    if outcar:
+        Path(directory, 'OUTCAR').write_text(OUTCAR)
+    return directory
+
+
+def touch(path:Path) -> None:
+    '''
+    Move a file's modification time clearly forward
+    '''
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+@pytest.fixture
+def project(tmp_path):
+    root = tmp_path / 'project'
+    calculation(root / 'fe', outcar=True)
+    calculation(root / 'ni', species='Ni', incar='ENCUT = 400\nISMEAR = 0\n')
+    calculation(root / 'nested' / 'co', species='Co')
+    # Hidden directories are not calculations
+    calculation(root / '.trash' / 'fe', outcar=True)
+    return root
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_update_is_incremental(tmp_path, project, jobs):
+    with CalculationIndex(tmp_path / 'index.db') as index:
+        assert index.update(project, jobs=jobs) == {'added': 3, 'updated': 0, 'unchanged': 0, 'removed': 0}
+        assert index.update(project, jobs=jobs) == {'added': 0, 'updated': 0, 'unchanged': 3, 'removed': 0}
+
+        Path(project, 'ni', 'INCAR').write_text('ENCUT = 450\nISMEAR = 0\n')
+        touch(Path(project, 'ni', 'INCAR'))
+        shutil.rmtree(project / 'nested')
+        assert index.update(project, jobs=jobs) == {'added': 0, 'updated': 1, 'unchanged': 1, 'removed': 1}
+        assert index.tags(str(Path(project, 'ni').resolve()))['ENCUT'] == '450'
+
+        # Directories outside the scanned root are left alone
+        calculation(tmp_path / 'elsewhere')
+        index.update(tmp_path / 'elsewhere')
+        assert index.update(project) == {'added': 0, 'updated': 0, 'unchanged': 2, 'removed': 0}
+        assert len(index.query()) == 3
+        assert index.update(project, prune=False)['removed'] == 0
+
+
+def test_results_and_queries(tmp_path, project):
+    with CalculationIndex(tmp_path / 'index.db') as index:
+        index.update(project)
+        fe = index.query(formula='Fe1O1')
+        assert len(fe) == 1
+        assert fe[0]['path'] == str(Path(project, 'fe').resolve())
+        assert fe[0]['human_name'] == 'fe' and fe[0]['natoms'] == 2
+        assert fe[0]['nsteps'] == 1 and fe[0]['finished'] == 1
+        assert fe[0]['energy_sigma_0'] == -10.05 and fe[0]['free_energy'] == -10.0
+        assert fe[0]['max_force'] == pytest.approx(0.5)
+        assert fe[0]['error'] is None
+
+        assert [ row['formula'] for row in index.query(species=['O']) ] == ['Fe1O1', 'Co1O1', 'Ni1O1']
+        assert [ row['formula'] for row in index.query(tags={'encut': 400}) ] == ['Ni1O1']
+        assert len(index.query(status='initialized', species=['Co', 'O'])) == 1
+        assert len(index.query(where='finished IS NULL', order='formula', limit=1)) == 1
+        with pytest.raises(RuntimeError):
+            index.query(order='formula; DROP TABLE tags')
+
+
+def inputs(directory:Path, poscar:str, incar:str='ENCUT = 520\nMAGMOM = 5 0\n',
+           kpoints:str='Automatic\n0\nGamma\n4 4 4\n', potcar:str=None) -> Path:
+    directory.mkdir(parents=True)
+    Path(directory, 'POSCAR').write_text(poscar)
+    Path(directory, 'INCAR').write_text(incar)
+    Path(directory, 'KPOINTS').write_text(kpoints)
+    if potcar is not None:
+        Path(directory, 'POTCAR').write_text(potcar)
+    return directory
+
+
+DIRECT = 'Test\n1.0\n3 0 0\n0 3 0\n0 0 3\nFe O\n1 1\nDirect\n0 0 0\n0.5 0.5 0.25\n'
+
+
+@pytest.mark.parametrize('poscar, incar, kpoints', [
+    # Reformatted, with the positions wrapped
+    ('Another comment\n  1.00\n 3.0 0.0 0.0\n 0.0 3.0 0.0\n 0.0 0.0 3.0\n Fe   O\n 1  1\nDirect\n'
+     '1.0 -0.0 1.0\n-0.5 0.5 1.25\n', None, None),
+    # Cartesian, as a convert writes it
+    ('Test\n1.0\n3 0 0\n0 3 0\n0 0 3\nFe O\n1 1\nCartesian\n0 0 0\n1.5 1.5 0.75\n', None, None),
+    # Species swapped with MAGMOM following them
+    ('Test\n1.0\n3 0 0\n0 3 0\n0 0 3\nO Fe\n1 1\nDirect\n0.5 0.5 0.25\n0 0 0\n', 'ENCUT = 520\nMAGMOM = 0 5\n', None),
+    # Tags reordered and relabelled, with comments and a spelled out array
+    (DIRECT, 'SYSTEM = other\n# Magnetic\nMAGMOM = 5.0 0   ! per ion\n  encut=520.0\n', None),
+    # A new KPOINTS comment and spacing
+    (DIRECT, None, 'Mesh\n 0\nGamma\n 4  4  4\n'),
+])
+def test_hash_invariances(tmp_path, poscar, incar, kpoints):
+    base = input_hash(inputs(tmp_path / 'base', DIRECT))
+    assert base is not None
+    same = inputs(tmp_path / 'same', poscar, **{ key:value for key, value in
+                  [('incar', incar), ('kpoints', kpoints)] if value is not None })
+    assert input_hash(same) == base
+
+
+@pytest.mark.parametrize('poscar, incar, kpoints', [
+    ('Test\n1.0\n3 0 0\n0 3 0\n0 0 3\nFe O\n1 1\nDirect\n0 0 0\n0.5 0.5 0.3\n', None, None),
+    ('Test\n1.0\n3 0 0\n0 3 0\n0 0 3.1\nFe O\n1 1\nDirect\n0 0 0\n0.5 0.5 0.25\n', None, None),
+    # Species swapped without the magnetic moments following them
+    ('Test\n1.0\n3 0 0\n0 3 0\n0 0 3\nO Fe\n1 1\nDirect\n0.5 0.5 0.25\n0 0 0\n', None, None),
+    (DIRECT, 'ENCUT = 500\nMAGMOM = 5 0\n', None),
+    (DIRECT, None, 'Automatic\n0\nGamma\n6 6 6\n'),
+])
+def test_hash_differences(tmp_path, poscar, incar, kpoints):
+    base = input_hash(inputs(tmp_path / 'base', DIRECT))
+    other = inputs(tmp_path / 'other', poscar, **{ key:value for key, value in
+                   [('incar', incar), ('kpoints', kpoints)] if value is not None })
+    assert input_hash(other) != base
+
+
+def test_potentials_are_hashed_by_title(tmp_path):
+    first = inputs(tmp_path / 'first', DIRECT, potcar='  TITEL  = PAW_PBE Fe 06Sep2000\nbody 1\n'
+                                                      '  TITEL  = PAW_PBE O 08Apr2002\nbody 2\n')
+    second = inputs(tmp_path / 'second', DIRECT, potcar='  TITEL  = PAW_PBE Fe 06Sep2000\nother\n'
+                                                        '  TITEL  = PAW_PBE O 08Apr2002\nother\n')
+    third = inputs(tmp_path / 'third', DIRECT, potcar='  TITEL  = PAW_PBE Fe_pv 02Aug2007\n'
+                                                      '  TITEL  = PAW_PBE O 08Apr2002\n')
+    assert input_hash(first) == input_hash(second) != input_hash(third)
+    assert input_hash(tmp_path / 'missing') is None
+
+
+@pytest.mark.parametrize('name, text', [('KPOINTS', 'Automatic\n0\nGamma\n6 6 6\n'),
+                                        ('POTCAR', '  TITEL  = PAW_PBE Fe_pv 02Aug2007\n')])
+def test_input_edits_refresh_the_hash(tmp_path, name, text):
+    potcar = '  TITEL  = PAW_PBE Fe 06Sep2000\n'
+    first = inputs(tmp_path / 'project' / 'first', DIRECT, potcar=potcar)
+    second = inputs(tmp_path / 'project' / 'second', DIRECT, potcar=potcar)
+    with CalculationIndex(tmp_path / 'index.db') as index:
+        index.update(tmp_path / 'project')
+        assert [ row['path'] for row in index.duplicates(second) ] == [str(first.resolve())]
+
+        # Only the edited file changes, not the directory
+        Path(first, name).write_text(text)
+        touch(Path(first, name))
+        assert index.update(tmp_path / 'project')['updated'] == 1
+        assert index.duplicates(second) == []
+        assert index.query(where=f"input_hash = '{input_hash(first)}'")[0]['path'] == str(first.resolve())
+
+
+def test_index_command_tags(tmp_path, project, capsys):
+    database = str(tmp_path / 'index.db')
+    assert vapack.execute(['index', str(project), '-d', database, '--tag', 'ENCUT=400']) == 0
+    listed = capsys.readouterr().out.splitlines()
+    assert len(listed) == 1 and listed[0].startswith(str(Path(project, 'ni').resolve()))
+
+    for entry in ['ENCUT', 'ENCUT=', '=400']:
+        with pytest.raises(SystemExit) as error:
+            vapack.execute(['index', str(project), '-d', database, '--tag', 'ISMEAR=0', entry])
+        assert error.value.code == 2
+        assert f'--tag {entry} must be given as TAG=VALUE' in capsys.readouterr().err
@@ -0,0 +1,149 @@
+'''
+Tokenizing, typing, and writing INCAR files
+'''
+
+import numpy as np
+import pytest
+
+from vasptypes import Incar, IncarArray
+
+
+@pytest.mark.parametrize('text, value', [
+    ('.TRUE.', True),
+    ('.FALSE.', False),
+    ('.t.', True),
+    ('F', False),
+    ('520', 520),
+    ('-3', -3),
+    ('520.', 520.0),
+    ('1.0D-5', 1e-5),
+    ('1d-5', 1e-5),
+    ('2.5E+3', 2500.0),
+    ('.5', 0.5),
+    ('Accurate', 'Accurate'),
+    ('"1.0"', '1.0'),
+])
+def test_scalars(text, value):
+    parsed = Incar.parse_value(text)
+    assert parsed == value
+    assert type(parsed) == type(value)
+
+
+def test_repeat_counts_expand():
+    magmom = Incar.parse_value('2*5.0 3*-1 0.6')
+    assert isinstance(magmom, IncarArray)
+    assert len(magmom) == 6
+    assert magmom.array.dtype == float
+    np.testing.assert_array_equal(magmom.array, [5.0, 5.0, -1.0, -1.0, -1.0, 0.6])
+    assert magmom.to_string() == '2*5.0 3*-1 0.6'
+
+
+def test_repeated_flags_and_fortran_exponents():
+    flags = Incar.parse_value('3*.TRUE. F')
+    assert flags.array.dtype == bool
+    np.testing.assert_array_equal(flags.array, [True, True, True, False])
+    values = Incar.parse_value('2*1.0D-2 1.5d1')
+    np.testing.assert_allclose(values.array, [0.01, 0.01, 15.0])
+
+
+def test_mixed_int_and_float_arrays():
+    ints = Incar.parse_value('1 2 3')
+    assert ints.array.dtype == int
+    mixed = Incar.parse_value('1 2.5 3')
+    assert mixed.array.dtype == float
+    np.testing.assert_array_equal(mixed.array, [1.0, 2.5, 3.0])
+    # Runs keep their own types, so ints are written back as ints
+    assert Incar.parse_value('2*1 0.5').to_string() == '2*1 0.5'
+
+
+def test_words_are_not_arrays():
+    assert Incar.parse_value('Fe O H') == 'Fe O H'
+    assert Incar.parse_value('2*Fe') == '2*Fe'
+    assert Incar.parse_value('x*1.0') == 'x*1.0'
+
+
+def test_array_from_values_compresses_runs():
+    magmom = IncarArray.from_values([0.6, 0.6, 0.6, -0.6, 0.0, 0.0])
+    assert magmom.runs == [(3, 0.6), (1, -0.6), (2, 0.0)]
+    assert Incar.parse_value(magmom.to_string()) == magmom
+
+
+def test_comments_and_statements():
+    incar = Incar.from_string(
+        'ENCUT = 520 ! cutoff\n'
+        'ISPIN = 2 ; MAGMOM = 4*1.0 # moments\n'
+        '# ISMEAR = 0\n'
+        '! a comment line\n'
+        'ismear=-5;sigma=0.05\n'
+        'EMPTY =\n'
+        '\n'
+    )
+    assert list(incar) == ['ENCUT', 'ISPIN', 'MAGMOM', 'ISMEAR', 'SIGMA']
+    assert incar['ISMEAR'] == -5
+    assert incar['SIGMA'] == 0.05
+    # The comment after a line of statements belongs to the last one
+    assert incar.comments == ['cutoff', '', 'moments', '', '']
+
+
+def test_quoted_values_keep_comment_and_separator_characters():
+    incar = Incar.from_string(
+        'SYSTEM = "Fe ! O; H # x" ! note\n'
+        "NAME = 'single'\n"
+        'ALGO = Fast\n'
+    )
+    assert incar['SYSTEM'] == 'Fe ! O; H # x'
+    assert incar['NAME'] == 'single'
+    assert incar['ALGO'] == 'Fast'
+    assert incar.comments[0] == 'note'
+
+
+def test_quoted_values_span_lines():
+    incar = Incar.from_string('WANNIER90_WIN = "begin projections\nFe:d\nend projections"\nISYM = 0\n')
+    assert incar['WANNIER90_WIN'] == 'begin projections\nFe:d\nend projections'
+    assert incar['ISYM'] == 0
+
+
+def test_continuation_lines():
+    incar = Incar.from_string('MAGMOM = 2*5.0 \\\n  2*-5.0 \\\n  4*0 ! afm\nISPIN = 2\n')
+    np.testing.assert_array_equal(incar['MAGMOM'].array, [5, 5, -5, -5, 0, 0, 0, 0])
+    assert incar['ISPIN'] == 2
+    assert incar.comments[0] == 'afm'
+
+
+def test_round_trip():
+    text = (
+        'SYSTEM = "a ! b; c"  ! note\n'
+        'MAGMOM = 2*5.0 3*-1 0.6 ; ISPIN = 2\n'
+        'EDIFF = 1.0D-5 # tolerance\n'
+        'LWAVE = .TRUE.\n'
+        'LCHARG = F\n'
+        'NBANDS = 1 2 3 \\\n  4 5\n'
+        'MIX = 1 2.5 3\n'
+        'GGA = PE\n'
+        'ISYM=0;ENCUT=520.\n'
+    )
+    incar = Incar.from_string(text)
+    again = Incar.from_string(incar.to_string())
+    assert dict(again) == dict(incar)
+    assert again.comments == incar.comments
+    assert again.to_string() == incar.to_string()
+    assert type(again['LCHARG']) == bool
+    assert type(again['ENCUT']) == float
+
+
+@pytest.mark.parametrize('value', ['1.0', 'T', 'a;b', 'a ! b', 'a # b', '2 3', '3*1'])
+def test_strings_that_look_like_other_types_are_quoted(value):
+    incar = Incar({'SYSTEM': value})
+    assert Incar.from_string(incar.to_string())['SYSTEM'] == value
+
+
+def test_lists_and_arrays_are_written_as_runs(tmp_path):
+    incar = Incar({'MAGMOM': [1.0, 1.0, -1.0], 'LDAUL': np.array([2, -1, -1]), 'LORBIT': 11})
+    incar.to_file(tmp_path / 'INCAR')
+    text = (tmp_path / 'INCAR').read_text()
+    assert 'MAGMOM = 2*1.0 -1.0\n' in text
+    assert 'LDAUL  = 2 2*-1\n' in text
+    again = Incar.from_file(tmp_path / 'INCAR')
+    assert again['MAGMOM'] == [1.0, 1.0, -1.0]
+    assert again['LDAUL'] == [2, -1, -1]
+    assert again['LORBIT'] == 11
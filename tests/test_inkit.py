@@ -0,0 +1,88 @@
+'''
+INCAR templates, their compiled cache, and parameter sweeps
+'''
+
+from pathlib import Path
+from yaml import dump
+import pytest
+
+from vasptypes import Potcar
+import inkit
+
+from synthetic import synthetic_poscar, write_synthetic_potentials
+
+
+def write_templates(directory:Path, count:int) -> list:
+    directory.mkdir(parents=True)
+    paths = []
+    for i in range(count):
+        paths.append(Path(directory, f'template{i}.yaml'))
+        paths[-1].write_text(f'---\nElectronic:\n  - tag: ENCUT\n    value: {400 + i}\n    comment: Cutoff\n')
+    return paths
+
+
+@pytest.fixture
+def compiles(monkeypatch):
+    '''
+    Record every template parsed from YAML
+    '''
+    compiled = []
+    compile_template = inkit._compile_template
+    def counted(path, stat):
+        compiled.append(Path(path).name)
+        return compile_template(path, stat)
+    monkeypatch.setattr(inkit, '_compile_template', counted)
+    monkeypatch.setattr(inkit, '_compiled_templates', {})
+    return compiled
+
+
+def test_without_cache_only_requested_templates_compile(tmp_path, monkeypatch, compiles):
+    monkeypatch.setenv('VAPACK_CACHE', '0')
+    paths = write_templates(tmp_path / 'yaml', 9)
+    for _ in range(3):
+        templates = inkit.load_templates(paths[2:4], tmp_path / 'yaml')
+        assert [ t['Electronic'][0]['value'] for t in templates ] == [402, 403]
+    assert compiles == ['template2.yaml', 'template3.yaml']
+
+
+def test_cache_compiles_the_directory_once(tmp_path, monkeypatch, compiles):
+    monkeypatch.setenv('VAPACK_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.delenv('VAPACK_CACHE', raising=False)
+    paths = write_templates(tmp_path / 'yaml', 4)
+    inkit.load_templates(paths[:1], tmp_path / 'yaml')
+    assert len(compiles) == 4
+    inkit.load_templates(paths[1:3], tmp_path / 'yaml')
+    assert len(compiles) == 4
+
+    # Another process reads the cache file, parsing only what changed
+    monkeypatch.setattr(inkit, '_compiled_templates', {})
+    paths[1].write_text('---\nElectronic:\n  - tag: ENCUT\n    value: 600\n')
+    templates = inkit.load_templates(paths[:2], tmp_path / 'yaml')
+    assert compiles[4:] == ['template1.yaml']
+    assert templates[1]['Electronic'][0] == {'tag': 'ENCUT', 'value': 600, 'comment': ''}
+    # Copies returned may be edited freely
+    templates[0]['Electronic'].clear()
+    assert len(inkit.load_templates(paths[:1], tmp_path / 'yaml')[0]['Electronic']) == 1
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_sweep_links_one_potcar_per_potential_set(tmp_path, monkeypatch, jobs):
+    monkeypatch.setenv('VAPACK_CACHE', '0')
+    monkeypatch.setattr(Potcar, '_written', {})
+    write_templates(tmp_path / 'yaml', 1)
+    write_synthetic_potentials(tmp_path / 'potentials', size=4096)
+    synthetic_poscar(10).to_file(tmp_path / 'POSCAR')
+    manifest = {'templates': ['template0'], 'templatedir': 'yaml', 'potcar': 'potentials',
+                'structures': {'base': 'POSCAR', 'other': {'poscar': 'POSCAR', 'potentials': ['O', 'H', 'Fe']}},
+                'parameters': {'ENCUT': [400, 500, 600], 'ISMEAR': 0}}
+    Path(tmp_path, 'sweep.yaml').write_text(dump(manifest))
+
+    written = inkit.sweep(tmp_path / 'sweep.yaml', jobs=jobs)
+    assert len(written) == 6
+    inodes = {}
+    for directory in written:
+        stat = Path(directory, 'POTCAR').stat()
+        inodes.setdefault(Path(directory).name.split('_')[0], set()).add(stat.st_ino)
+    assert [ len(i) for i in inodes.values() ] == [1, 1]
+    assert inodes['base'] != inodes['other']
+    assert Path(written[0], 'INCAR').read_text().count('ENCUT') == 1
@@ -0,0 +1,81 @@
+'''
+NEB image interpolation, linear and refined with the IDPP
+'''
+
+import numpy as np
+import pytest
+import warnings
+
+from vasptypes import Poscar
+from vasptypes_extension import idpp_path, interpolate_path
+
+from synthetic import synthetic_poscar
+
+
+def endpoints(x1:float, x2:float) -> tuple[Poscar, Poscar]:
+    '''
+    Two ions in a cubic cell with the first moving along x from x1 to x2
+    '''
+    def poscar(x):
+        return Poscar('NEB', np.ones(3), 5.0 * np.identity(3), {'Fe': 1, 'O': 1}, False, 'Direct',
+                      positions=[[x, 0.5, 0.5], [0.5, 0.1, 0.1]])
+    return poscar(x1), poscar(x2)
+
+
+def steps_along(path:np.array, lattice:np.array) -> np.array:
+    '''
+    Minimum image length in Angstroms of each ion's move between successive images
+    '''
+    jumps = np.diff(path, axis=0)
+    jumps -= np.rint(jumps)
+    return np.linalg.norm(jumps @ lattice, axis=2)
+
+
+@pytest.mark.parametrize('x1, x2', [(0.98, 0.02), (0.02, 0.98), (0.4, 0.6)])
+def test_linear_path_takes_minimum_image(x1, x2):
+    first, last = endpoints(x1, x2)
+    path = interpolate_path(first, last, 5)
+    assert len(path) == 7
+    assert np.array_equal(path[0], first.positions) and np.array_equal(path[-1], last.positions)
+    distance = abs((x2 - x1) - round(x2 - x1)) * 5.0
+    assert np.allclose(steps_along(path, first.lattice)[:,0], distance / 6)
+    assert np.allclose(steps_along(path, first.lattice)[:,1], 0.0)
+    # The midpoint is on the boundary, not across the cell
+    midpoint = {0.98: 1.0, 0.02: 0.0, 0.4: 0.5}[x1]
+    assert path[3,0,0] == pytest.approx(midpoint, abs=1e-12)
+
+
+@pytest.mark.parametrize('x1, x2', [(0.98, 0.02), (0.02, 0.98)])
+def test_idpp_across_the_boundary(x1, x2):
+    first, last = endpoints(x1, x2)
+    linear = interpolate_path(first, last, 5)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        refined, taken = idpp_path(linear, first.lattice, steps=100, fmax=0.1)
+    assert taken < 100
+    # A straight line across the boundary is already the IDPP path
+    difference = refined - linear
+    assert np.allclose(difference - np.rint(difference), 0.0, atol=1e-6)
+    assert steps_along(refined, first.lattice).max() < 0.1
+    assert np.array_equal(refined[-1], last.positions)
+
+
+def test_idpp_with_many_ions_crossing():
+    start = synthetic_poscar(40, seed=15)
+    end = start.copy(positions=start.positions + [0.3, 0.0, 0.0])
+    end.positions = end.positions - np.floor(end.positions)
+    linear = interpolate_path(start, end, 3)
+    refined, taken = idpp_path(linear, start.lattice, steps=200, fmax=0.05)
+    assert taken < 200
+    # A rigid translation keeps every pair distance, so no ion leaves the line
+    moved = steps_along(refined, start.lattice)
+    assert np.allclose(moved, moved[0,0], atol=1e-3)
+
+
+def test_idpp_warns_when_not_converged():
+    start = synthetic_poscar(20, seed=16)
+    end = synthetic_poscar(20, seed=17)
+    linear = interpolate_path(start, end, 3)
+    with pytest.warns(UserWarning, match='did not converge'):
+        _, taken = idpp_path(linear, start.lattice, steps=2, fmax=1e-6)
+    assert taken == 2
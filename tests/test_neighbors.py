@@ -0,0 +1,152 @@
+'''
+Periodic neighbor searches checked against brute force minimum image distances
+'''
+
+import numpy as np
+import pytest
+
+from vasptypes import NeighborIndex, Poscar
+from vasptypes_extension import chain_select
+
+from synthetic import synthetic_poscar
+
+
+def brute_distances(poscar:Poscar, rows:np.array=None) -> np.array:
+    '''
+    Minimum image distances from the given ions to every ion, over enough
+    periodic images for cutoffs up to twice the cell width
+    '''
+    direct = poscar.positions - np.floor(poscar.positions)
+    rows = np.arange(len(direct)) if rows is None else rows
+    images = np.stack(np.meshgrid(*[np.arange(-2, 3)]*3, indexing='ij'), axis=-1).reshape(-1,3)
+    shifts = images @ poscar.lattice
+    cartesian = direct @ poscar.lattice
+    vectors = cartesian[None,:,:] - cartesian[rows,None,:]
+    return np.sqrt(((vectors[:,:,None,:] + shifts[None,None,:,:])**2).sum(axis=-1)).min(axis=-1)
+
+
+@pytest.mark.parametrize('n, cutoff', [(200, 1.5), (200, 3.0), (200, 6.0), (10, 4.0)])
+def test_query_and_neighbors_match_brute_force(n, cutoff):
+    poscar = synthetic_poscar(n, seed=1)
+    index = NeighborIndex(poscar, cutoff)
+    distances = brute_distances(poscar)
+    for i in range(0, n, max(1, n // 20)):
+        members, found = index.neighbors(i)
+        expected = np.flatnonzero((distances[i] <= cutoff) & (np.arange(n) != i))
+        assert np.array_equal(members, expected)
+        assert np.allclose(found, distances[i,expected])
+
+    # A cartesian point outside the cell is wrapped back in
+    point = poscar.positions[0] @ poscar.lattice + poscar.lattice.sum(axis=0)
+    members, found = index.query(point, cutoff / 2)
+    expected = np.flatnonzero(distances[0] <= cutoff / 2)
+    assert np.array_equal(members, expected)
+    assert np.allclose(found, distances[0,expected])
+
+
+def test_cartesian_mode_gives_same_neighbors():
+    poscar = synthetic_poscar(200, seed=2)
+    cartesian = poscar.copy()
+    cartesian._convert_to_cartesian()
+    direct, converted = NeighborIndex(poscar, 3.0), NeighborIndex(cartesian, 3.0)
+    for i in [0, 17, 199]:
+        assert np.array_equal(direct.neighbors(i)[0], converted.neighbors(i)[0])
+
+
+def test_radius_beyond_cutoff_raises():
+    index = NeighborIndex(synthetic_poscar(50), 2.0)
+    with pytest.raises(RuntimeError):
+        index.query(np.zeros(3), 2.5)
+    with pytest.raises(RuntimeError):
+        NeighborIndex(synthetic_poscar(50), 0.0)
+
+
+def test_chain_select_matches_brute_force():
+    poscar = synthetic_poscar(200, seed=3)
+    distances = brute_distances(poscar)
+    jump = 2.0
+    selected = chain_select(poscar, 0, jump, hydrogen_termination=False)
+
+    # Connected component of ion 0 by breadth first search over the full matrix
+    reached = np.zeros(200, dtype=bool)
+    reached[0] = True
+    frontier = [0]
+    while len(frontier) > 0:
+        near = np.flatnonzero((distances[frontier] <= jump).any(axis=0) & ~reached)
+        reached[near] = True
+        frontier = near.tolist()
+    assert sorted(selected.indices) == np.flatnonzero(reached).tolist()
+    assert selected.indices[0] == 0
+
+
+def brute_pairs(distances:np.array, radius:float) -> tuple[np.array, np.array, np.array]:
+    first, second = np.nonzero(np.triu(distances <= radius, k=1))
+    return first, second, distances[first, second]
+
+
+@pytest.mark.parametrize('n, cutoff', [(200, 1.0), (200, 2.5), (200, 6.0), (12, 4.0)])
+def test_pairs_match_brute_force(n, cutoff):
+    poscar = synthetic_poscar(n, seed=4)
+    first, second, distances = NeighborIndex(poscar, cutoff).pairs()
+    expected_first, expected_second, expected = brute_pairs(brute_distances(poscar), cutoff)
+    assert np.array_equal(first, expected_first)
+    assert np.array_equal(second, expected_second)
+    assert np.allclose(distances, expected)
+
+
+def with_duplicates(n:int, copies:dict, offset:float, seed:int=0) -> Poscar:
+    '''
+    A synthetic structure where ion j sits offset Angstroms from ion i for every i: j in copies
+    '''
+    poscar = synthetic_poscar(n, seed=seed)
+    shift = np.array([offset, 0.0, 0.0]) @ np.linalg.inv(poscar.lattice)
+    for i, j in copies.items():
+        poscar.positions[j] = poscar.positions[i] + shift
+    return poscar
+
+
+# Ions below 1500 are Fe and those from 1500 to 2399 are O, so the first
+# twenty duplicates are of the same species and the next twenty are not
+COPIES = dict([ (i, 1000+i) for i in range(20) ] + [ (i, 2000+i) for i in range(20, 40) ])
+
+
+def test_tiny_cutoff_pairs():
+    poscar = with_duplicates(3000, COPIES, 0.004)
+    index = NeighborIndex(poscar, 0.01)
+    # Cells are widened rather than made far smaller than the ion spacing
+    assert index.shape.prod() <= 2 * len(poscar.positions)
+
+    first, second, distances = index.pairs()
+    assert list(zip(first.tolist(), second.tolist())) == sorted(COPIES.items())
+    assert np.allclose(distances, 0.004)
+    # The nearest image of the difference is exact at radii this far below the cell width
+    close = []
+    for rows in np.array_split(np.arange(3000), 15):
+        differences = poscar.positions[None,:,:] - poscar.positions[rows,None,:]
+        lengths = np.linalg.norm((differences - np.round(differences)) @ poscar.lattice, axis=-1)
+        close.extend( (int(rows[i]), int(j)) for i, j in zip(*np.nonzero(lengths <= 0.01)) if rows[i] < j )
+    assert close == sorted(COPIES.items())
+    members, _ = index.neighbors(2025)
+    assert members.tolist() == [25]
+
+
+def test_overlaps_and_merge_duplicates():
+    poscar = with_duplicates(3000, COPIES, 0.004)
+    distances = brute_distances(poscar, np.arange(40))
+    assert np.sort(distances, axis=1)[:,1].min() == pytest.approx(0.004)
+
+    first, second, found = poscar.overlaps(0.01)
+    assert len(first) == 40 and np.allclose(found, 0.004)
+    # Per species thresholds take the larger value of each pair
+    first, _, _ = poscar.overlaps({'Fe': 0.002, 'O': 0.01})
+    assert first.tolist() == list(range(20, 40))
+    first, _, _ = poscar.overlaps({'default': 0.01, 'Fe': 0.002})
+    assert first.tolist() == list(range(20, 40))
+
+    # Only duplicates of the same species are merged, keeping the first
+    kept = poscar.positions[0:40].copy()
+    assert poscar.merge_duplicates(0.01) == 20
+    assert len(poscar.positions) == 2980
+    assert poscar.species == {'Fe': 1480, 'O': 900, 'H': 600}
+    assert np.array_equal(poscar.positions[0:40], kept)
+    assert len(poscar.overlaps(0.01)[0]) == 20
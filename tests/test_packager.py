@@ -0,0 +1,168 @@
+'''
+Self extracting input bundles and result archives
+'''
+
+from pathlib import Path
+import shutil
+import subprocess
+import zipfile
+import pytest
+
+import packager
+
+
+def calculation(directory:Path, job:bool=True, potential:bytes=b'PAW_PBE Fe 06Sep2000\n' * 100) -> Path:
+    directory.mkdir(parents=True)
+    Path(directory, 'INCAR').write_text('ENCUT = 520\nISMEAR = 0\n')
+    Path(directory, 'POSCAR').write_text(f'{directory.name}\n1.0\n3 0 0\n0 3 0\n0 0 3\nFe\n1\nDirect\n0 0 0\n')
+    Path(directory, 'POTCAR').write_bytes(potential)
+    Path(directory, 'KPOINTS').write_text("It's automatic\n0\nGamma\n4 4 4\n")
+    if job:
+        Path(directory, packager.JOB_SCRIPT).write_text('#!/bin/sh\n#SBATCH -N 1\nsrun vasp_std\n')
+    return directory
+
+
+def unpack(bundle:Path, directory:Path, *arguments) -> None:
+    directory.mkdir()
+    subprocess.run(['sh', str(bundle.resolve()), *arguments], cwd=directory, check=True,
+                   capture_output=True)
+
+
+def test_bundle_round_trip(tmp_path):
+    directories = [ calculation(tmp_path / name) for name in ['a', 'b'] ]
+    # A POTCAR with NUL bytes has to be stored as base64
+    calculation(tmp_path / 'c', potential=bytes(range(256)) * 4)
+    directories.append(tmp_path / 'c')
+    bundle = packager.package(directories, output=tmp_path / 'bundle.shar', submitter='tester')
+
+    text = bundle.read_bytes()
+    assert text.startswith(b'#!/bin/sh\n# Packaged by tester\n')
+    # The shared INCAR, KPOINTS, job script and first POTCAR are each stored
+    # once, beside the other POTCAR and every POSCAR and metadata.yml
+    assert text.count(b"<<'_VAPACK_") == 4 + 1 + 3 + 3
+    assert b'base64 -d' in text
+
+    unpack(bundle, tmp_path / 'out', '--unpack-only')
+    for directory in directories:
+        metadata = packager.read_metadata(directory)
+        assert metadata['status'] == 'packaged'
+        extracted = Path(tmp_path, 'out', f'{packager.OUTPUT_PREFIX}{metadata["id"]}')
+        for name in packager.INPUT_FILES:
+            assert Path(extracted, name).read_bytes() == Path(directory, name).read_bytes()
+    assert not( Path(tmp_path, 'out', packager.STORE).exists() )
+
+
+def test_bundle_without_job_scripts(tmp_path):
+    directory = calculation(tmp_path / 'a', job=False)
+    bundle = packager.package([directory], output=tmp_path / 'bundle.shar')
+    assert not( b'sbatch' in bundle.read_bytes() )
+    # Runs without --unpack-only, as there is nothing to submit
+    unpack(bundle, tmp_path / 'out')
+    identifier = packager.read_metadata(directory)['id']
+    assert Path(tmp_path, 'out', f'{packager.OUTPUT_PREFIX}{identifier}', 'POSCAR').is_file()
+
+
+def test_status_set_only_after_writing(tmp_path, monkeypatch):
+    directory = calculation(tmp_path / 'a')
+    packager.initialize(directory, 'first')
+    def fail(*args):
+        raise OSError('disk full')
+    monkeypatch.setattr(packager, '_write_blob', fail)
+    with pytest.raises(OSError):
+        packager.package([directory], output=tmp_path / 'bundle.shar')
+    assert packager.read_metadata(directory)['status'] == 'initialized'
+    assert [ path.name for path in tmp_path.iterdir() ] == ['a']
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_results_archive(tmp_path, compress):
+    directory = calculation(tmp_path / 'a')
+    packager.initialize(directory)
+    Path(directory, 'OUTCAR').write_text('free  energy   TOTEN  = -1.0 eV\n' * 1000)
+    Path(directory, '.hidden').write_text('skipped')
+    Path(directory, 'old.zip').write_bytes(b'skipped')
+    archive = packager.archive_results(directory, compress=compress, level=9)
+
+    assert archive.parent == directory
+    with zipfile.ZipFile(archive) as f:
+        names = f.namelist()
+        assert sorted(names) == sorted( path.name for path in packager.result_files(directory)
+                                        if path != archive )
+        assert f.read('OUTCAR') == Path(directory, 'OUTCAR').read_bytes()
+        method = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        assert all( info.compress_type == method for info in f.infolist() )
+    assert not( '.hidden' in names or 'old.zip' in names )
+
+
+def test_bundle_reads_each_file_once(tmp_path, monkeypatch):
+    # Copies of one POTCAR, so only their content says they are the same
+    directories = [ calculation(tmp_path / name) for name in ['a', 'b', 'c'] ]
+    opened = []
+    open_source = packager._open_source
+    def counted(source):
+        opened.append(source)
+        return open_source(source)
+    monkeypatch.setattr(packager, '_open_source', counted)
+    bundle = packager.package(directories, output=tmp_path / 'bundle.shar')
+
+    files = [ source for source in opened if isinstance(source, Path) ]
+    assert len(files) == len(set(files)) == 3 * 5
+    text = bundle.read_bytes()
+    assert text.count(b'PAW_PBE Fe 06Sep2000\n' * 100) == 1
+    assert not( b'0' * packager.DIGEST_CHARS in text )
+    unpack(bundle, tmp_path / 'out', '--unpack-only')
+    for directory in directories:
+        extracted = Path(tmp_path, 'out', f'{packager.OUTPUT_PREFIX}{packager.read_metadata(directory)["id"]}')
+        assert Path(extracted, 'POTCAR').read_bytes() == Path(directory, 'POTCAR').read_bytes()
+
+
+def test_linked_files_are_not_read_again(tmp_path, monkeypatch):
+    first = calculation(tmp_path / 'a')
+    second = calculation(tmp_path / 'b')
+    Path(second, 'POTCAR').unlink()
+    Path(second, 'POTCAR').hardlink_to(Path(first, 'POTCAR'))
+    opened = []
+    open_source = packager._open_source
+    monkeypatch.setattr(packager, '_open_source', lambda source: opened.append(source) or open_source(source))
+    packager.package([first, second], output=tmp_path / 'bundle.shar')
+    assert not( Path(second, 'POTCAR') in opened )
+
+
+def results(directory:Path) -> Path:
+    calculation(directory)
+    packager.initialize(directory)
+    Path(directory, 'OUTCAR').write_text('free  energy   TOTEN  = -1.0 eV\n' * 1000)
+    Path(directory, 'vasprun.xml').write_bytes(bytes(range(256)) * 1000)
+    Path(directory, 'ünicode').write_text('named in UTF-8\n')
+    Path(directory, 'empty').write_bytes(b'')
+    return directory
+
+
+def check_archive(archive:Path, directory:Path) -> None:
+    with zipfile.ZipFile(archive) as f:
+        assert f.testzip() is None
+        assert f.namelist() == [ path.name for path in packager.result_files(directory) if path != archive ]
+        for name in f.namelist():
+            assert f.read(name) == Path(directory, name).read_bytes()
+    if shutil.which('unzip') is not None:
+        subprocess.run(['unzip', '-tq', str(archive)], check=True, capture_output=True)
+
+
+@pytest.mark.parametrize('compress', [False, True])
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_results_archive_is_valid(tmp_path, compress, jobs):
+    directory = results(tmp_path / 'a')
+    archive = packager.archive_results(directory, compress=compress, jobs=jobs)
+    check_archive(archive, directory)
+    if compress:
+        assert archive.stat().st_size < Path(directory, 'OUTCAR').stat().st_size
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_results_archive_zip64(tmp_path, monkeypatch, compress):
+    # Small enough that every size and offset takes the zip64 records
+    monkeypatch.setattr(packager, 'ZIP64_LIMIT', 10)
+    directory = results(tmp_path / 'a')
+    archive = packager.archive_results(directory, compress=compress)
+    assert b'PK\x06\x06' in archive.read_bytes()
+    check_archive(archive, directory)
@@ -0,0 +1,292 @@
+'''
+POSCAR array storage, ion views, parsing and writing, and copy-on-write copies
+'''
+
+from copy import deepcopy
+import numpy as np
+import pickle
+import pytest
+
+from vasptypes import Ion, Poscar
+import vasptypes
+
+from synthetic import synthetic_poscar, write_synthetic_contcar
+
+
+def small_poscar() -> Poscar:
+    positions = np.array([[0.0, 0.0, 0.0], [0.5, 0.5, 0.5], [0.25, 0.25, 0.25]])
+    dynamics = np.array([[True, True, False], [False, False, False], [True, True, True]])
+    return Poscar('Test', np.ones(3), 4.0 * np.identity(3), {'Fe': 2, 'O': 1}, True, 'Direct',
+                  positions=positions, dynamics=dynamics)
+
+
+def test_arrays_match_species():
+    poscar = small_poscar()
+    assert poscar.positions.shape == (3,3)
+    assert poscar.dynamics.dtype == bool
+    assert np.array_equal(poscar.velocities, np.zeros((3,3)))
+    assert poscar.species_indices.tolist() == [0, 0, 1]
+
+
+def test_species_count_mismatch():
+    with pytest.raises(RuntimeError):
+        Poscar('Test', np.ones(3), np.identity(3), {'Fe': 2}, False, 'Direct', positions=np.zeros((3,3)))
+
+
+def test_ion_views_read_and_write_arrays():
+    poscar = small_poscar()
+    ion = poscar.ions[1]
+    assert ion.species == 'Fe'
+    assert np.array_equal(ion.position, [0.5, 0.5, 0.5])
+    assert not( ion.selective_dynamics.any() )
+
+    ion.position = [0.1, 0.2, 0.3]
+    assert np.array_equal(poscar.positions[1], [0.1, 0.2, 0.3])
+    # In place edits through a view write to the POSCAR too
+    poscar.ions[2].position[0] = 0.75
+    assert poscar.positions[2,0] == 0.75
+    poscar.positions[0,2] = 0.125
+    assert poscar.ions[0].position[2] == 0.125
+
+
+def test_ions_setter_groups_by_species():
+    poscar = small_poscar()
+    poscar.ions = [ Ion([0.1, 0.1, 0.1], 'O'), Ion([0.2, 0.2, 0.2], 'Fe'),
+                    Ion([0.3, 0.3, 0.3], 'O') ]
+    assert poscar.species == {'O': 2, 'Fe': 1}
+    assert poscar.species_indices.tolist() == [0, 0, 1]
+    assert [ ion.species for ion in poscar.ions ] == ['O', 'O', 'Fe']
+    assert np.allclose(poscar.positions[:,0], [0.1, 0.3, 0.2])
+
+
+def test_detached_ion_is_independent():
+    poscar = small_poscar()
+    ion = poscar.ions[0].detach()
+    ion.position = [0.9, 0.9, 0.9]
+    assert np.array_equal(poscar.positions[0], [0.0, 0.0, 0.0])
+
+
+def fixed_block(values:np.array, fmt:str, flags:np.array=None) -> bytes:
+    lines = []
+    for i, row in enumerate(values):
+        line = ''.join( fmt.format(v) for v in row )
+        if flags is not None:
+            line += ''.join( '   T' if f else '   F' for f in flags[i] )
+        lines.append(line + '\n')
+    return ''.join(lines).encode()
+
+
+@pytest.mark.parametrize('fmt', ['{:20.16f}', '{:21.16f}', '{:13.8f}', '{:16.8E}', '{:22.14e}'])
+def test_fixed_width_parse_matches_tokenizer(fmt):
+    rng = np.random.default_rng(3)
+    # Small enough that the fixed formats always leave a blank between columns
+    values = rng.uniform(-9, 9, (500,3)) * 10.0**rng.integers(-4, 1, (500,3))
+    values[0] = [-0.0, 0.0, 1.0]
+    block = fixed_block(values, fmt)
+    fixed = vasptypes._parse_fixed(block, len(values), 3)
+    assert fixed is not None
+    expected = np.fromstring(block, dtype=float, sep=' ').reshape(-1,3)
+    assert np.array_equal(fixed.view(np.int64), expected.view(np.int64))
+
+
+def test_fixed_width_parse_with_flags(monkeypatch):
+    rng = np.random.default_rng(4)
+    values, flags = rng.random((64,3)), rng.random((64,3)) < 0.5
+    block = fixed_block(values, '{:20.16f}', flags)
+    monkeypatch.setattr(vasptypes, '_FIXED_MIN_ROWS', 1)
+    positions, dynamics = vasptypes._parse_block(block, 64, flags=True)
+    monkeypatch.setattr(vasptypes, '_FIXED_MIN_ROWS', 1 << 30)
+    expected_positions, expected_dynamics = vasptypes._parse_block(block, 64, flags=True)
+    assert np.array_equal(positions, expected_positions)
+    assert np.array_equal(dynamics, flags)
+    assert np.array_equal(dynamics, expected_dynamics)
+
+
+def test_fixed_width_parse_declines_other_layouts():
+    values = np.random.default_rng(5).random((8,3))
+    ragged = b''.join( ' '.join( str(v) for v in row ).encode() + b'\n' for row in values )
+    assert vasptypes._parse_fixed(ragged, 8, 3) is None
+    labelled = b''.join( b'%20.16f%20.16f%20.16f Fe\n' % tuple(row) for row in values )
+    assert vasptypes._parse_fixed(labelled, 8, 3) is None
+    # Both still parse through the slower paths
+    positions, _ = vasptypes._parse_block(labelled, 8)
+    assert np.allclose(positions, values)
+
+
+def tokenized(block:bytes, n:int, flags:bool=False) -> tuple[np.array, np.array]:
+    """
+    Parse a block with the fixed width conversion turned off
+    """
+    minimum = vasptypes._FIXED_MIN_ROWS
+    vasptypes._FIXED_MIN_ROWS = 1 << 62
+    try:
+        return vasptypes._parse_block(block, n, flags)
+    finally:
+        vasptypes._FIXED_MIN_ROWS = minimum
+
+
+@pytest.mark.parametrize('fmt, fixed', [('{:20.16f}', True), ('{:16.8E}', True), ('{:16.8e}', True),
+                                        ('{:16g}', False), ('{:>24}', False)])
+@pytest.mark.parametrize('newline', [b'\n', b'\r\n'])
+@pytest.mark.parametrize('flags', [False, True])
+def test_large_blocks_parse_like_tokenizer(fmt, fixed, newline, flags):
+    n = vasptypes._FIXED_MIN_ROWS + 3
+    rng = np.random.default_rng(10)
+    values = rng.uniform(-9, 9, (n,3)) * 10.0**rng.integers(-6, 1, (n,3))
+    block = fixed_block(values, fmt, rng.random((n,3)) < 0.5 if flags else None).replace(b'\n', newline)
+    assert (vasptypes._parse_fixed(block, n, 6 if flags else 3) is not None) == fixed
+
+    positions, dynamics = vasptypes._parse_block(block, n, flags)
+    expected_positions, expected_dynamics = tokenized(block, n, flags)
+    assert np.array_equal(positions.view(np.int64), expected_positions.view(np.int64))
+    assert np.array_equal(dynamics, expected_dynamics)
+    # The last line need not end in a newline
+    positions, dynamics = vasptypes._parse_block(block[:-len(newline)], n, flags)
+    assert np.array_equal(positions.view(np.int64), expected_positions.view(np.int64))
+    assert np.array_equal(dynamics, expected_dynamics)
+
+
+def test_large_file_with_crlf_and_no_final_newline():
+    poscar = synthetic_poscar(vasptypes._FIXED_MIN_ROWS * 2)
+    text = poscar.to_string()
+    expected = Poscar.from_bytes(text.encode())
+    for data in [text.replace('\n', '\r\n').encode(), text.rstrip('\n').encode()]:
+        parsed = Poscar.from_bytes(data)
+        assert parsed.species == expected.species and parsed.comment == 'Synthetic'
+        assert np.array_equal(parsed.positions, expected.positions)
+        assert np.array_equal(parsed.dynamics, expected.dynamics)
+
+
+def test_malformed_block_raises(monkeypatch):
+    monkeypatch.setattr(vasptypes, '_FIXED_MIN_ROWS', 1)
+    block = fixed_block(np.ones((4,3)), '{:20.16f}')[:-25] + b'\n'
+    with pytest.raises(ValueError):
+        vasptypes._parse_block(block, 4)
+
+
+@pytest.mark.parametrize('n', [5, 70000])
+def test_write_parse_round_trip(n):
+    poscar = synthetic_poscar(n)
+    poscar.velocities = np.random.default_rng(6).normal(0, 1e-3, (n,3))
+    parsed = Poscar.from_bytes(poscar.to_string().encode())
+    assert parsed.species == poscar.species
+    assert parsed.selective_dynamics and parsed.is_direct()
+    # Written to eight decimals, as VASP writes them
+    assert np.allclose(parsed.lattice, poscar.lattice, rtol=0, atol=5e-9)
+    assert np.allclose(parsed.positions, poscar.positions, rtol=0, atol=5e-9)
+    assert np.array_equal(parsed.dynamics, poscar.dynamics)
+    assert np.allclose(parsed.velocities, poscar.velocities, rtol=1e-7, atol=0)
+    # Writing what was read gives the same text back
+    assert parsed.to_string() == poscar.to_string()
+
+
+def test_file_round_trip(tmp_path):
+    write_synthetic_contcar(tmp_path / 'CONTCAR', 5000)
+    poscar = Poscar.from_file(tmp_path / 'CONTCAR', cache=False)
+    assert len(poscar.positions) == 5000
+    assert not( poscar.dynamics[:,2].any() ) and poscar.dynamics[:,0:2].all()
+    poscar.to_file(tmp_path / 'out' / 'POSCAR')
+    again = Poscar.from_file(tmp_path / 'out' / 'POSCAR', cache=False)
+    assert np.allclose(again.positions, poscar.positions, rtol=0, atol=5e-9)
+    assert np.allclose(again.velocities, poscar.velocities, rtol=1e-7, atol=0)
+    assert again.to_string() == poscar.to_string()
+
+
+def test_copy_shares_until_written():
+    parent = small_poscar()
+    child = parent.copy()
+    assert child.__dict__['_positions'] is parent.__dict__['_positions']
+
+    child.positions[0] = [0.9, 0.9, 0.9]
+    assert np.array_equal(parent.positions[0], [0.0, 0.0, 0.0])
+    parent.dynamics[0] = False
+    assert child.dynamics[0].tolist() == [True, True, False]
+    # Arrays neither side touched are still shared
+    assert child.__dict__['_velocities'] is parent.__dict__['_velocities']
+
+
+def test_copy_small_arrays_are_private():
+    parent = small_poscar()
+    child = parent.copy()
+    child.lattice[0,0] = 8.0
+    child.species['Fe'] = 5
+    assert parent.lattice[0,0] == 4.0
+    assert parent.species == {'Fe': 2, 'O': 1}
+
+
+def test_copy_changes():
+    parent = small_poscar()
+    child = parent.copy(comment='Child', positions=np.zeros((3,3)))
+    assert child.comment == 'Child' and parent.comment == 'Test'
+    assert np.array_equal(parent.positions[1], [0.5, 0.5, 0.5])
+    with pytest.raises(AttributeError):
+        parent.copy(foo=1)
+
+
+def test_ion_view_writes_after_copy():
+    parent = small_poscar()
+    child = parent.copy()
+    child.ions[1].position[0] = 0.75
+    assert child.positions[1,0] == 0.75
+    assert parent.positions[1,0] == 0.5
+    parent.ions[1].species = 'O'
+    assert child.ions[1].species == 'Fe'
+
+
+def test_pickles_and_deep_copies_own_their_arrays():
+    parent = small_poscar()
+    sibling = parent.copy()
+    for other in [pickle.loads(pickle.dumps(parent)), deepcopy(parent)]:
+        other.positions[0,0] = 0.5
+        assert parent.positions[0,0] == 0.0
+        assert sibling.positions[0,0] == 0.0
+
+
+def folded(poscar:Poscar, lattice:np.array) -> np.array:
+    '''
+    Direct positions of a POSCAR's ions in another lattice, wrapped into its cell
+    '''
+    cartesian = poscar.positions @ poscar.lattice if poscar.is_direct() else poscar.positions
+    direct = cartesian @ np.linalg.inv(lattice)
+    direct = np.round(direct - np.floor(direct), 8)
+    return direct % 1.0
+
+
+@pytest.mark.parametrize('matrix', [[2, 3, 1], [[1, 1, 0], [-1, 1, 0], [0, 0, 2]]])
+def test_supercell(matrix):
+    poscar = synthetic_poscar(30, seed=8)
+    poscar.velocities = np.random.default_rng(8).normal(0, 1, (30,3))
+    supercell = poscar.supercell(matrix)
+    images = int(round(abs(np.linalg.det(np.diag(matrix) if np.ndim(matrix) == 1 else matrix))))
+
+    assert len(supercell.positions) == 30 * images
+    assert supercell.species == { name:count*images for name, count in poscar.species.items() }
+    assert np.allclose(supercell.lattice, (np.diag(matrix) if np.ndim(matrix) == 1
+                                           else np.array(matrix)) @ poscar.lattice)
+    assert supercell.species_indices.tolist() == sorted(supercell.species_indices.tolist())
+    assert np.all((supercell.positions >= 0) & (supercell.positions < 1))
+    # The images of each ion are adjacent and carry its flags and velocity
+    assert np.array_equal(supercell.dynamics, np.repeat(poscar.dynamics, images, axis=0))
+    assert np.array_equal(supercell.velocities, np.repeat(poscar.velocities, images, axis=0))
+    # Folded back into the original cell, every image lands on its ion
+    expected = np.repeat(folded(poscar, poscar.lattice), images, axis=0)
+    assert np.allclose(folded(supercell, poscar.lattice), expected, atol=1e-7)
+    # No two images coincide
+    assert len(np.unique(folded(supercell, supercell.lattice), axis=0)) == 30 * images
+
+
+def test_supercell_keeps_cartesian_mode():
+    poscar = synthetic_poscar(10)
+    poscar._convert_to_cartesian()
+    supercell = poscar.supercell([1, 1, 2])
+    assert supercell.is_cartesian()
+    assert np.allclose(supercell.positions[0::2], poscar.positions)
+    assert np.allclose(supercell.positions[1::2], poscar.positions + poscar.lattice[2])
+
+
+def test_supercell_rejects_bad_matrices():
+    poscar = synthetic_poscar(10)
+    with pytest.raises(RuntimeError):
+        poscar.supercell([1, 0, 1])
+    with pytest.raises(RuntimeError):
+        poscar.supercell([1.5, 1, 1])
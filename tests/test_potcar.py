@@ -0,0 +1,58 @@
+'''
+Potential header index used for electron counts
+'''
+
+from pathlib import Path
+import os
+import pytest
+
+from vasptypes import PotentialIndex
+
+from synthetic import write_synthetic_potentials
+
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    monkeypatch.setenv('VAPACK_CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.delenv('VAPACK_CACHE', raising=False)
+    monkeypatch.setattr(PotentialIndex, '_loaded', {})
+    directory = write_synthetic_potentials(tmp_path / 'potentials', size=4096)
+    # Shared libraries are often read-only
+    for path in [directory, *directory.iterdir()]:
+        os.chmod(path, 0o555)
+    yield directory
+    for path in [directory, *directory.iterdir()]:
+        os.chmod(path, 0o755)
+
+
+def test_index_lives_in_the_cache(tmp_path, library):
+    before = sorted( str(path) for path in library.parent.rglob('*') )
+    index = PotentialIndex.of(library)
+    index.build()
+    assert index['Fe']['zval'] == 8.0 and index['O']['titel'] == 'PAW_PBE O 08Apr2002'
+    assert sorted( str(path) for path in library.parent.rglob('*') ) == before
+    assert len(list(Path(tmp_path, 'cache').glob('potcar-*.json'))) == 1
+    # A new process loads the saved entries
+    assert PotentialIndex(library).entries == index.entries
+
+
+def test_lookups_notice_edited_potentials(library):
+    index = PotentialIndex.of(library)
+    assert index['Fe']['enmax'] == pytest.approx(267.882)
+    path = Path(library, 'Fe', 'POTCAR')
+    os.chmod(path, 0o644)
+    path.write_text(path.read_text().replace('267.882', '300.000'))
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert index['Fe']['enmax'] == 300.0
+    assert PotentialIndex(library)['Fe']['enmax'] == 300.0
+
+    with pytest.raises(RuntimeError):
+        index['Xx']
+
+
+def test_disabled_cache_keeps_the_index_in_memory(tmp_path, library, monkeypatch):
+    monkeypatch.setenv('VAPACK_CACHE', '0')
+    index = PotentialIndex(library)
+    assert index['H']['zval'] == 1.0
+    assert not( Path(tmp_path, 'cache').exists() )
@@ -0,0 +1,121 @@
+'''
+Random access readers of XDATCAR and OUTCAR files
+'''
+
+from pathlib import Path
+import numpy as np
+import pytest
+
+from vasptypes import Outcar, Trajectory
+
+
+def write_xdatcar(path:Path, frames:np.array, lattices:np.array=None) -> None:
+    '''
+    Write frames in the layout VASP uses, repeating the header before every
+    frame when lattices are given for a variable cell run
+    '''
+    def header(lattice):
+        text = 'MD run\n           1\n'
+        text += ''.join( '  {:12.6f}{:12.6f}{:12.6f}\n'.format(*v) for v in lattice )
+        return text + '   Fe   O\n     3     2\n'
+
+    with path.open('w') as f:
+        for i, frame in enumerate(frames):
+            if i == 0 or lattices is not None:
+                f.write(header(np.diag([5.0, 6.0, 7.0]) if lattices is None else lattices[i]))
+            f.write(f'Direct configuration= {i+1:5d}\n')
+            f.write(''.join( '  {:10.8f}  {:10.8f}  {:10.8f}\n'.format(*r) for r in frame ))
+
+
+def test_trajectory_frames(tmp_path):
+    frames = np.round(np.random.default_rng(7).random((6,5,3)), 8)
+    write_xdatcar(tmp_path / 'XDATCAR', frames)
+    with Trajectory(tmp_path / 'XDATCAR', cache=False) as trajectory:
+        assert len(trajectory) == 6 and trajectory.natoms == 5
+        assert not( trajectory.variable_cell )
+        assert np.allclose(trajectory[2], frames[2])
+        assert np.allclose(trajectory[-1], frames[-1])
+        assert np.allclose(np.stack(list(trajectory)), frames)
+
+        subset = trajectory[1::2]
+        assert len(subset) == 3
+        assert np.allclose(subset[1], frames[3])
+
+        frame = trajectory.frame(4)
+        assert frame.species == {'Fe': 3, 'O': 2} and frame.is_direct()
+        assert np.allclose(frame.positions, frames[4])
+        assert np.allclose(trajectory.lattice(4), np.diag([5.0, 6.0, 7.0]))
+        with pytest.raises(IndexError):
+            trajectory[6]
+
+
+def test_variable_cell_trajectory(tmp_path):
+    frames = np.round(np.random.default_rng(8).random((4,5,3)), 8)
+    lattices = np.array([ np.diag([5.0, 6.0, 7.0]) * (1 + 0.01*i) for i in range(4) ])
+    write_xdatcar(tmp_path / 'XDATCAR', frames, lattices)
+    with Trajectory(tmp_path / 'XDATCAR', dtype=np.float32, cache=False) as trajectory:
+        assert len(trajectory) == 4 and trajectory.variable_cell
+        assert trajectory[3].dtype == np.float32
+        assert np.allclose(trajectory[3], frames[3], atol=1e-6)
+        assert np.allclose(trajectory.lattice(2), lattices[2])
+        assert np.allclose(trajectory.frame(1).lattice, lattices[1])
+
+
+def outcar_step(step:int, table:np.array) -> str:
+    '''
+    Text of one ionic step of an OUTCAR, with its stress, force table and energies
+    '''
+    rule = ' ' + '-'*83 + '\n'
+    text = f'{"-"*39} Iteration {step:6d}(   1)  {"-"*39}\n'
+    text += '  FORCE on cell =-STRESS in cart. coord.  units (eV):\n'
+    text += f'  in kB  {step:11.5f}     2.00000     3.00000     0.10000     0.20000     0.30000\n'
+    text += ' POSITION                                       TOTAL-FORCE (eV/Angst)\n' + rule
+    text += ''.join( '  {:11.5f}  {:11.5f}  {:11.5f}   {:13.6f}{:13.6f}{:13.6f}\n'.format(*r) for r in table )
+    text += rule + '    total drift:  0 0 0\n\n'
+    text += f'  free  energy   TOTEN  =  {-10.0-step:20.8f} eV\n\n'
+    text += f'  energy  without entropy={-10.1-step:18.8f}  energy(sigma->0) ={-10.05-step:18.8f}\n\n'
+    return text
+
+
+def test_outcar_steps(tmp_path):
+    tables = np.round(np.random.default_rng(9).random((5,3,6)), 5)
+    path = tmp_path / 'OUTCAR'
+    path.write_text(' vasp.6.3.0\n   number of dos      NEDOS =    301   number of ions     NIONS =      3\n'
+                    + ''.join( outcar_step(i+1, tables[i]) for i in range(3) ))
+
+    with Outcar(path) as outcar:
+        assert len(outcar) == 3 and outcar.natoms == 3
+        assert np.allclose(outcar.positions(1), tables[1,:,0:3])
+        assert np.allclose(outcar.forces(-1), tables[2,:,3:6])
+        assert outcar.energy(0) == pytest.approx({'free_energy': -11.0,
+            'energy_without_entropy': -11.1, 'energy_sigma_0': -11.05})
+        assert outcar.stress(2)[0] == 3.0
+
+        # Steps written since opening are found by a refresh
+        with path.open('a') as f:
+            f.write(''.join( outcar_step(i+1, tables[i]) for i in range(3, 5) ))
+        outcar.refresh()
+        assert len(outcar) == 5
+        assert np.allclose(outcar.forces(4), tables[4,:,3:6])
+        assert outcar.energy(4)['free_energy'] == -15.0
+        offsets = outcar.offsets.copy()
+
+    # The saved index is reused by later opens
+    assert (tmp_path / '.OUTCAR.index.npz').exists()
+    with Outcar(path) as outcar:
+        assert outcar._scanned > offsets[-1]
+        assert np.array_equal(outcar.offsets, offsets)
+        assert np.allclose(outcar.positions(3), tables[3,:,0:3])
+
+
+def test_outcar_without_persisting(tmp_path):
+    path = tmp_path / 'OUTCAR'
+    path.write_text('   number of ions     NIONS =      3\n'
+                    + outcar_step(1, np.ones((3,6))))
+    with Outcar(path, persist=False) as outcar:
+        assert len(outcar) == 1
+    assert not( (tmp_path / '.OUTCAR.index.npz').exists() )
+
+    path.write_text('no ions here\n')
+    with pytest.raises(RuntimeError):
+        Outcar(path, persist=False)
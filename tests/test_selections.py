@@ -0,0 +1,97 @@
+'''
+Selections as boolean masks and the geometric predicates that build them
+'''
+
+import numpy as np
+import pytest
+
+from vasptypes import Poscar, Selection
+from vasptypes_extension import box_selection, cylinder_selection, index_selection,\
+    slab_selection, species_selection, sphere_selection
+
+from synthetic import synthetic_poscar
+from test_neighbors import brute_distances
+
+
+def test_set_algebra_matches_python_sets():
+    rng = np.random.default_rng(11)
+    a_indices, b_indices = rng.choice(50, 20, replace=False), rng.choice(50, 25, replace=False)
+    a, b = Selection.from_indices(a_indices, 50), Selection.from_indices(b_indices, 50)
+    a_set, b_set = set(a_indices.tolist()), set(b_indices.tolist())
+    assert list(a) == sorted(a_set) and len(a) == 20
+    assert all( i in a for i in a_set ) and not( any( i in a for i in set(range(50)) - a_set ) )
+    assert list(a | b) == sorted(a_set | b_set)
+    assert list(a & b) == sorted(a_set & b_set)
+    assert list(a - b) == sorted(a_set - b_set)
+    assert list(a ^ b) == sorted(a_set ^ b_set)
+    assert list(~a) == sorted(set(range(50)) - a_set)
+    assert list(~(a | b)) == list(~a & ~b)
+    with pytest.raises(RuntimeError):
+        a | Selection.from_indices([0], 49)
+
+
+def test_selected_ions_are_views():
+    poscar = synthetic_poscar(20)
+    ions = Selection.from_indices([3, 7], 20).ions(poscar)
+    assert ions.indices == [3, 7]
+    ions[1].position = [0.5, 0.5, 0.5]
+    assert np.array_equal(poscar.positions[7], [0.5, 0.5, 0.5])
+
+
+@pytest.mark.parametrize('radius', [1.0, 3.0, 5.5])
+def test_sphere_matches_brute_force(radius):
+    poscar = synthetic_poscar(300, seed=12)
+    distances = brute_distances(poscar, np.array([0, 150]))
+    for row, center in enumerate([poscar.positions[0], poscar.positions[150] + [1.0, -2.0, 0.0]]):
+        selected = sphere_selection(poscar, center, radius)
+        assert list(selected) == np.flatnonzero(distances[row] <= radius).tolist()
+
+    # The same sphere with a cartesian center
+    cartesian = sphere_selection(poscar, poscar.positions[0] @ poscar.lattice, radius, mode='Cartesian')
+    assert list(cartesian) == np.flatnonzero(distances[0] <= radius).tolist()
+
+
+def orthorhombic(n:int, seed:int=0) -> Poscar:
+    rng = np.random.default_rng(seed)
+    return Poscar('Box', np.ones(3), np.diag([10.0, 12.0, 14.0]), {'Fe': n//2, 'O': n - n//2},
+                  False, 'Direct', positions=rng.random((n,3)))
+
+
+@pytest.mark.parametrize('axis', [[0, 0, 1], [1, 0, 0], [0, 1, 0]])
+def test_cylinder_matches_brute_force(axis):
+    poscar = orthorhombic(400, seed=13)
+    center = np.array([0.9, 0.05, 0.5])
+    selected = cylinder_selection(poscar, center, axis, 3.0)
+
+    # Distance from the line to every periodic image of every ion
+    images = np.stack(np.meshgrid(*[np.arange(-1, 2)]*3, indexing='ij'), axis=-1).reshape(-1,3)
+    vectors = ((poscar.positions[:,None,:] + images[None,:,:]) - center) @ poscar.lattice
+    along = vectors @ np.array(axis, dtype=float)
+    perpendicular = np.sqrt((vectors**2).sum(axis=-1) - along**2).min(axis=1)
+    assert list(selected) == np.flatnonzero(perpendicular <= 3.0).tolist()
+
+    cartesian = poscar.copy()
+    cartesian._convert_to_cartesian()
+    assert list(cylinder_selection(cartesian, center @ poscar.lattice, axis, 3.0)) == list(selected)
+
+
+def test_slab_and_box():
+    poscar = synthetic_poscar(300, seed=14)
+    cartesian = poscar.positions @ poscar.lattice
+    normal = np.array([1.0, 1.0, 0.0])
+    heights = cartesian @ normal / np.sqrt(2)
+    assert list(slab_selection(poscar, normal, 2.0, 6.0)) ==\
+        np.flatnonzero((heights >= 2.0) & (heights <= 6.0)).tolist()
+
+    inside = (poscar.positions[:,0] <= 0.5) & (poscar.positions[:,2] >= 0.25) & (poscar.positions[:,2] <= 0.75)
+    assert list(box_selection(poscar, [0, 0.5], None, [0.25, 0.75])) == np.flatnonzero(inside).tolist()
+    inside = (cartesian[:,1] >= 3.0) & (cartesian[:,1] <= 5.0)
+    assert list(box_selection(poscar, y_range=[3.0, 5.0], mode='Cartesian')) == np.flatnonzero(inside).tolist()
+
+
+def test_species_and_index_selections():
+    poscar = synthetic_poscar(100)
+    iron = species_selection(poscar, ['fe'])
+    assert list(iron) == list(range(poscar.species['Fe']))
+    assert len(species_selection(poscar, ['O', 'H']) & iron) == 0
+    assert list(index_selection(poscar, 10, 20, 3)) == list(range(10, 20, 3))
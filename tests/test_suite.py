@@ -0,0 +1,39 @@
+'''
+Environment checks of the benchmark suite's baseline
+'''
+
+import json
+import numpy as np
+import platform
+
+import suite
+
+
+def test_environment_differences():
+    python = platform.python_version()
+    assert suite.environment_differences({'environment': suite.environment()}) == []
+    # Only the minor version of Python matters
+    patched = '.'.join(python.split('.')[:2] + ['999'])
+    assert suite.environment_differences({'environment': {'python': patched, 'numpy': np.__version__}}) == []
+    assert suite.environment_differences({'environment': {'python': python, 'numpy': '1.0.0'}}) ==\
+        [f'numpy {np.__version__} against 1.0.0']
+    # Baselines from before the environment was recorded are never comparable
+    assert len(suite.environment_differences({'machine': {}})) == 2
+
+
+def test_baseline_of_another_environment_is_refused(tmp_path, capsys, monkeypatch):
+    baseline = tmp_path / 'baseline.json'
+    baseline.write_text(json.dumps({'environment': dict(suite.environment(), numpy='1.0.0'),
+                                    'calibration': 1.0, 'results': {}}))
+    def run(*args, **kwargs):
+        raise AssertionError('the suite ran')
+    monkeypatch.setattr(suite, 'run', run)
+    assert suite.execute(['-b', str(baseline)]) == 2
+    assert 'numpy' in capsys.readouterr().out
+
+
+def test_baseline_of_this_environment_is_compared(tmp_path):
+    baseline = tmp_path / 'baseline.json'
+    assert suite.execute(['-k', 'oszicar', '-r', '1', '-b', str(baseline), '-s']) == 0
+    assert json.loads(baseline.read_text())['environment'] == suite.environment()
+    assert suite.execute(['-k', 'oszicar', '-r', '1', '-b', str(baseline), '-t', '100', '-m', '100']) == 0
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+"""
+Manage calculation directories: metadata, packaging for the cluster, and results
+"""
+
+from sys import argv, stderr
+from argparse import ArgumentParser
+from pathlib import Path
+
+import packager
+import calcindex
+from vasptypes import Incar
+
+
+def report_duplicates(directories:list, database:str, link:bool=False) -> dict:
+    """
+    Print the earlier calculations each directory repeats, optionally linking
+    in the results of the first that has any. Returns the duplicates found.
+    """
+    found = calcindex.find_duplicates(directories, database)
+    for directory, matches in found.items():
+        for match in matches:
+            print(f"{directory}: same inputs as {match['path']} ({match['status'] or 'no status'})")
+        if link:
+            results = [ match for match in matches if calcindex.has_result(match) ]
+            if len(results) > 0:
+                linked = calcindex.link_result(directory, results[0])
+                print(f"{directory}: linked {len(linked)} result files from {results[0]['path']}")
+    return found
+
+
+def execute(arguments):
+    parser = ArgumentParser(description='Manage VASP calculation directories')
+    subparsers = parser.add_subparsers(dest='command')
+
+    init = subparsers.add_parser('init', help='Write the metadata of calculations')
+    init.add_argument('directories', nargs='*', default=['.'], help='Calculation directories <DEFAULT .>')
+    init.add_argument('-n', '--name', type=str, help='Human readable name of the calculation')
+
+    package = subparsers.add_parser('package', help='Bundle calculations into a self extracting shell archive')
+    package.add_argument('directories', nargs='*', default=['.'], help='Calculation directories <DEFAULT .>')
+    package.add_argument('-o', '--output', type=str,
+                         help='Archive file <DEFAULT C-<id>.shar, or C-bundle-<id>.shar for several>')
+    package.add_argument('-f', '--files', nargs='+', default=packager.INPUT_FILES,
+                         help='Files of each calculation to include <DEFAULT inputs, job script, and metadata>')
+    package.add_argument('-s', '--submitter', type=str, help='Name recorded in the archive, such as user@site')
+    package.add_argument('--no_submit', action='store_true', help='Do not submit the jobs on extraction')
+    package.add_argument('-d', '--database', type=str, default=calcindex.DEFAULT_DATABASE,
+                         help=f'Index checked for identical calculations <DEFAULT {calcindex.DEFAULT_DATABASE}>')
+    package.add_argument('--force', action='store_true', help='Package calculations even if they were run before')
+    package.add_argument('-l', '--link', action='store_true',
+                         help='Link the results of identical finished calculations into skipped directories')
+
+    status = subparsers.add_parser('status', help='Show or set the status of calculations')
+    status.add_argument('directories', nargs='*', default=['.'], help='Calculation directories <DEFAULT .>')
+    status.add_argument('-s', '--set', type=str, help='New status, such as queued or complete')
+
+    results = subparsers.add_parser('results', help='Archive the results of a finished calculation')
+    results.add_argument('directory', nargs='?', default='.', help='Calculation directory <DEFAULT .>')
+    results.add_argument('-o', '--output', type=str, help='Zip file <DEFAULT C-<id>.zip in the directory>')
+    results.add_argument('-z', '--compress', action='store_true',
+                         help='Deflate the members in parallel instead of storing them')
+    results.add_argument('-l', '--level', type=int, default=6, help='Compression level <DEFAULT 6>')
+    results.add_argument('-j', '--jobs', type=int, help='Number of compression threads <DEFAULT number of CPUs>')
+    results.add_argument('-c', '--complete', action='store_true', help='Mark the calculation complete first')
+
+    index = subparsers.add_parser('index', help='Index calculations into a SQLite database and query it')
+    index.add_argument('root', nargs='?', default='.', help='Directory tree to scan <DEFAULT .>')
+    index.add_argument('-d', '--database', type=str, default=calcindex.DEFAULT_DATABASE,
+                       help=f'Database file <DEFAULT {calcindex.DEFAULT_DATABASE}>')
+    index.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes reading directories <DEFAULT 1>')
+    index.add_argument('-n', '--no_update', action='store_true', help='Query without scanning first')
+    index.add_argument('--status', type=str, help='Only calculations with this status')
+    index.add_argument('--formula', type=str, help='Only calculations with this formula, such as Fe2O3')
+    index.add_argument('--species', nargs='+', default=[], help='Only calculations containing all these species')
+    index.add_argument('--tag', nargs='+', default=[], help='Only calculations with these INCAR values as TAG=VALUE')
+    index.add_argument('--where', type=str, help='Additional SQL condition on the calculations table')
+    index.add_argument('--order', type=str, default='path', help='Column to order by <DEFAULT path>')
+    index.add_argument('--limit', type=int, help='Maximum number of calculations to list')
+
+    duplicates = subparsers.add_parser('duplicates', help='Find earlier calculations with the same inputs')
+    duplicates.add_argument('directories', nargs='*', default=['.'], help='Calculation directories <DEFAULT .>')
+    duplicates.add_argument('-d', '--database', type=str, default=calcindex.DEFAULT_DATABASE,
+                            help=f'Database file <DEFAULT {calcindex.DEFAULT_DATABASE}>')
+    duplicates.add_argument('-l', '--link', action='store_true',
+                            help='Link the results of identical finished calculations into the directories')
+
+    args = parser.parse_args(arguments)
+
+    if args.command == 'init':
+        for directory in args.directories:
+            metadata = packager.initialize(directory, args.name)
+            print(f"{directory}: {packager.OUTPUT_PREFIX}{metadata['id']}")
+
+    elif args.command == 'package':
+        directories = args.directories
+        if not( args.force ):
+            found = report_duplicates(directories, args.database, args.link)
+            directories = [ d for d in directories if not( d in found ) ]
+            if len(found) > 0:
+                print(f'Skipping {len(found)} calculations that were run before, use --force to package them',
+                      file=stderr)
+        if len(directories) == 0:
+            print('Nothing to package')
+            return 0
+        output = packager.package(directories, args.output, args.files, args.submitter,
+                                  submit=not( args.no_submit ))
+        print(f'Packed {len(directories)} calculations into {output}')
+        # Index them now, so they are found if packaged again
+        if Path(args.database).is_file():
+            with calcindex.CalculationIndex(args.database) as database:
+                database.add(directories)
+
+    elif args.command == 'status':
+        for directory in args.directories:
+            if args.set is not None:
+                packager.set_status(directory, args.set)
+            metadata = packager.read_metadata(directory)
+            print(f"{directory}: {metadata.get('status', 'uninitialized')}")
+
+    elif args.command == 'results':
+        if args.complete:
+            packager.set_status(args.directory, 'complete')
+        output = packager.archive_results(args.directory, args.output, args.compress, args.level, args.jobs)
+        print(f'Results written to {output}')
+
+    elif args.command == 'index':
+        tags = {}
+        for entry in args.tag:
+            key, _, value = entry.partition('=')
+            if len(key.strip()) == 0 or len(value.strip()) == 0:
+                parser.error(f'--tag {entry} must be given as TAG=VALUE')
+            tags[key] = Incar.parse_value(value)
+        with calcindex.CalculationIndex(args.database) as database:
+            if not( args.no_update ):
+                counts = database.update(args.root, args.jobs)
+                print(', '.join( f'{count} {name}' for name, count in counts.items() ), file=stderr)
+            rows = database.query(args.status, args.formula, args.species, tags, args.where,
+                                  args.order, args.limit)
+            for row in rows:
+                energy = '' if row['energy_sigma_0'] is None else f"{row['energy_sigma_0']:.6f}"
+                force = '' if row['max_force'] is None else f"{row['max_force']:.4f}"
+                print(f"{row['path']}\t{row['id'] or ''}\t{row['status'] or ''}\t{row['formula'] or ''}"
+                      f"\t{row['nsteps'] if row['nsteps'] is not None else ''}\t{energy}\t{force}")
+
+    elif args.command == 'duplicates':
+        found = report_duplicates(args.directories, args.database, args.link)
+        print(f'{len(found)} of {len(args.directories)} calculations were run before')
+
+    else:
+        parser.print_help(stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    exit(execute(argv[1:]))
@@ -1,8 +1,258 @@
 from pathlib import Path
 import numpy as np
-import itertools as it
-from ast import literal_eval
 import re
+import io
+from cache import default_cache
+from profiling import phase, count_read, count_written
+import mmap
+from copy import copy
+import warnings
+import os
+import shutil
+from functools import lru_cache
+import hashlib
+import json
+
+def transform_positions(positions:np.array, transform:np.array, tol:float=1e-8) -> np.array:
+    """
+    Apply a transformation matrix (3x3) to an array of positions (N,3)
+    in one batched operation, rounding values within tol to zero.
+    """
+    r = positions @ np.asarray(transform).reshape(3,3).T
+    return r * (np.abs(r) > tol)
+
+# Translation of selective dynamics flags to numbers so that a whole
+# block of positions and flags can be tokenized as floats at once
+_FLAG_TABLE = bytes.maketrans(b'TF', b'10')
+
+# Marker in the line that starts each frame of an XDATCAR
+_FRAME_MARKER = b'configuration='
+
+# Marker in the header line of the position and force table of each ionic step
+_FORCE_MARKER = b'TOTAL-FORCE (eV/Angst)'
+
+# Ionic step summary lines of an OSZICAR and their key=value pairs
+_OSZICAR_STEP = re.compile(rb'^\s*([0-9]+)\s+((?:T|F)=.*)$', re.MULTILINE)
+_OSZICAR_PAIR = re.compile(r'([A-Za-z][A-Za-z0-9 ]*?)\s*=\s*([-+.0-9Ee]+)')
+
+# Rows formatted per string operation and size of file write buffers
+_WRITE_CHUNK = 65536
+_WRITE_BUFFER = 1 << 20
+
+# Blocks of at least this many rows are first tried as fixed width columns,
+# which benchmarks/bench_parse.py --tokenize compares with tokenizing them
+_FIXED_MIN_ROWS = 4096
+# Byte masks for converting eight ASCII characters per 64-bit word at once
+_ONES = np.uint64(0x0101010101010101)
+_LOW7 = np.uint64(0x7F7F7F7F7F7F7F7F)
+_HIGH = np.uint64(0x8080808080808080)
+# Powers of ten that are exact doubles, so one division is correctly rounded
+_EXACT_POWERS = np.array([ float(10**k) for k in range(23) ])
+_EXACT_MANTISSA = np.uint64(1 << 53)
+
+def _write_block(f, values:np.array, fmt:str, flags:np.array=None) -> None:
+    """
+    Write an (n,3) array as n lines of the printf-style row format to an
+    open text handle, optionally followed by T/F flags from an (n,3) bool array. Each chunk of rows is
+    formatted by one string operation over a flattened tuple of values.
+    """
+    row = fmt
+    if flags is not None:
+        row += ' %s %s %s'
+    row += '\n'
+    for start in range(0, len(values), _WRITE_CHUNK):
+        chunk = values[start:start+_WRITE_CHUNK]
+        if flags is not None:
+            mixed = np.empty((len(chunk), 6), dtype=object)
+            mixed[:,0:3] = chunk
+            mixed[:,3:6] = np.where(flags[start:start+_WRITE_CHUNK], 'T', 'F')
+            chunk = mixed
+        f.write((row*len(chunk)) % tuple(chunk.ravel().tolist()))
+
+def _matching_bytes(words:np.array, byte:int) -> np.array:
+    """
+    Return words with 0xFF in each byte equal to byte and 0x00 elsewhere.
+    """
+    x = words ^ (_ONES * np.uint64(byte))
+    nonzero = (((x & _LOW7) + _LOW7) | x) & _HIGH
+    return ((nonzero >> np.uint64(7)) ^ _ONES) * np.uint64(0xFF)
+
+def _word_digits(words:np.array) -> np.array:
+    """
+    Return the value of the eight ASCII digits of each word, the first in
+    the lowest byte, or None if any byte is not a digit.
+    """
+    words = words - _ONES * np.uint64(ord('0'))
+    if ((words | (words + _ONES * np.uint64(6))) & (_ONES * np.uint64(0xF0))).any():
+        return None
+    words = (words * np.uint64(10) + (words >> np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    words = (words * np.uint64(100) + (words >> np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    return (words * np.uint64(10000) + (words >> np.uint64(32))) & np.uint64(0xFFFFFFFF)
+
+def _packed_words(chars:np.array, begin:int, end:int, fill:int, words:int=1) -> list[np.array]:
+    """
+    Return columns begin:end of each row right aligned in words of eight
+    bytes, left filled with the fill byte, as one array per word.
+    """
+    buffer = np.full((len(chars), 8*words), fill, dtype=np.uint8)
+    buffer[:,8*words-(end-begin):] = chars[:,begin:end]
+    packed = buffer.view('<u8')
+    return [ packed[:,i] for i in range(words) ]
+
+def _parse_fixed_number(chars:np.array, begin:int, end:int) -> np.array:
+    """
+    Convert columns begin:end of each row, a number with its decimal point
+    and optional exponent in the same columns on every row, to floats. Returns
+    None if any row does not fit that layout.
+    """
+    dots = np.flatnonzero(chars[0,begin:end] == ord('.'))
+    marks = np.flatnonzero(chars[0,begin:end] | 0x20 == ord('e'))
+    if len(dots) != 1 or len(marks) > 1:
+        return None
+    dot = begin + dots[0]
+    mark = begin + marks[0] if len(marks) == 1 else end
+    places = mark - dot - 1
+    if not( 0 < dot-begin <= 8 and 0 < places <= 16 and dot-begin + places <= 19 ):
+        return None
+    if not( (chars[:,dot] == ord('.')).all() ):
+        return None
+
+    # The integer part is blanks, an optional sign, then at least one digit
+    whole, = _packed_words(chars, begin, dot, ord(' '))
+    blanks = _matching_bytes(whole, ord(' '))
+    minus = _matching_bytes(whole, ord('-'))
+    signs = minus | _matching_bytes(whole, ord('+'))
+    first = (blanks + np.uint64(1)) * np.uint64(0xFF)
+    last = (whole >> np.uint64(56)) - np.uint64(ord('0'))
+    if ((blanks & (blanks + np.uint64(1))) | (signs & ~first) | (last > np.uint64(9))).any():
+        return None
+    whole = _word_digits(whole & ~(blanks | signs) | (_ONES * np.uint64(ord('0'))) & (blanks | signs))
+    if whole is None:
+        return None
+    mantissa = whole * np.uint64(10**places)
+    fraction = np.zeros_like(mantissa)
+    for word in _packed_words(chars, dot+1, mark, ord('0'), -(-places // 8)):
+        digits = _word_digits(word)
+        if digits is None:
+            return None
+        fraction = fraction * np.uint64(10**8) + digits
+    mantissa += fraction
+
+    scale = np.full(len(chars), places, dtype=np.int64)
+    if mark < end:
+        if not( 2 <= end-mark-1 <= 4 and (chars[:,mark] | 0x20 == ord('e')).all() ):
+            return None
+        sign = chars[:,mark+1]
+        negative = sign == ord('-')
+        if not( (negative | (sign == ord('+'))).all() ):
+            return None
+        exponent, = _packed_words(chars, mark+2, end, ord('0'))
+        exponent = _word_digits(exponent)
+        if exponent is None:
+            return None
+        exponent = exponent.astype(np.int64)
+        scale += np.where(negative, exponent, -exponent)
+
+    # A mantissa and power of ten that are both exact give a correctly rounded
+    # quotient, the rest are left to the C library
+    powers = _EXACT_POWERS[np.minimum(np.abs(scale), len(_EXACT_POWERS)-1)]
+    values = mantissa.astype(np.float64)
+    values = np.where(scale >= 0, values / powers, values * powers)
+    values[minus != 0] *= -1
+    inexact = np.flatnonzero((mantissa > _EXACT_MANTISSA) | (np.abs(scale) >= len(_EXACT_POWERS)))
+    if len(inexact) > 0:
+        values[inexact] = np.ascontiguousarray(chars[inexact,begin:end]).view(f'S{end-begin}')[:,0].astype(np.float64)
+    return values
+
+def _parse_fixed(block:bytes, n:int, columns:int) -> np.array:
+    """
+    Convert n lines of equal length whose columns of numbers, and of single
+    T/F flags after the first three, line up on every line, as VASP writes
+    them, into an (n,columns) float array with the flags as 1 and 0. The
+    numbers are converted eight digits at a time by integer arithmetic on
+    whole columns. Returns None for any other layout.
+    """
+    if not( block.endswith(b'\n') ):
+        block += b'\n'
+    if len(block) % n != 0:
+        return None
+    chars = np.frombuffer(block, dtype=np.uint8).reshape(n, len(block) // n)
+    if not( (chars[:,-1] == ord('\n')).all() ):
+        return None
+    occupied = chars[:,:-1].max(axis=0) > ord(' ')
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], occupied, [0]]).astype(np.int8)))
+    if len(edges) != 2*columns:
+        return None
+    values = np.empty((n, columns))
+    for column, (begin, end) in enumerate(edges.reshape(-1, 2)):
+        if column >= 3 and end-begin == 1:
+            true = chars[:,begin] == ord('T')
+            if not( (true | (chars[:,begin] == ord('F'))).all() ):
+                return None
+            values[:,column] = true
+            continue
+        parsed = _parse_fixed_number(chars, begin, end)
+        if parsed is None:
+            return None
+        values[:,column] = parsed
+    return values
+
+def _parse_block(block:bytes, n:int, flags:bool=False, dtype=float) -> tuple[np.array, np.array]:
+    """
+    Tokenize n lines of three coordinates, optionally followed by three
+    selective dynamics flags, into an (n,3) float array and an (n,3) bool array.
+    Large blocks in fixed width columns are converted column by column, others
+    are tokenized in one pass, and blocks with trailing labels or comments
+    fall back to splitting by line.
+    """
+    columns = 6 if flags else 3
+    if n >= _FIXED_MIN_ROWS:
+        values = _parse_fixed(block, n, columns)
+        if values is not None:
+            if not( flags ):
+                return values.astype(dtype, copy=False), None
+            return values[:,0:3].astype(dtype), values[:,3:6] != 0
+    # Unparsable data stops the tokenizer early (with a warning or an error
+    # depending on the NumPy version), which shows up as a short count
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            text = block.translate(_FLAG_TABLE) if flags else block
+            values = np.fromstring(text, dtype=dtype, sep=' ')
+    except ValueError:
+        values = np.zeros(0)
+    if values.size == n*columns:
+        values = values.reshape(n, columns)
+        if not( flags ):
+            return values, None
+        return values[:,0:3].copy(), values[:,3:6] != 0
+
+    # Fall back to reading line by line
+    rows = [ line.split() for line in block.splitlines() ]
+    if len(rows) != n or any( len(row) < columns for row in rows ):
+        raise ValueError('Malformed coordinate block!')
+    positions = np.array([ row[0:3] for row in rows ], dtype=dtype)
+    dynamics = None
+    if flags:
+        dynamics = np.array([ [ f[:1] != b'F' for f in row[3:6] ] for row in rows ], dtype=bool)
+    return positions, dynamics
+
+def _parse_table(block:bytes, rows:int, columns:int, dtype=float) -> np.array:
+    """
+    Tokenize a block of numeric rows into a (rows,columns) array. Fixed width
+    columns that run together fall back to matching numbers individually.
+    """
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            values = np.fromstring(block, dtype=dtype, sep=' ')
+    except ValueError:
+        values = np.zeros(0)
+    if values.size != rows*columns:
+        values = np.array(re.findall(rb'-?[0-9]*\.[0-9]+(?:[eE][-+]?[0-9]+)?', block), dtype=dtype)
+    if values.size != rows*columns:
+        raise ValueError('Malformed numeric table!')
+    return values.reshape(rows, columns)
 
 # Storage of position mode (direct or cartesian) is _only_ done in the POSCAR.
 # The units on position of an ion makes no sense unless taken into context with
@@ -12,7 +262,15 @@ class Ion(object):
     An atom or ion contained within a POSCAR.
     Only has information that is immediately relevant to
     the ion itself. It has limited context of its container.
+
+    An ion is either detached, holding its own small arrays, or a
+    lightweight view of one row of the arrays stored by a POSCAR.
+    Reading or writing the attributes of a view reads or writes
+    the POSCAR directly.
     """
+    __slots__ = ('_poscar', '_index', '_position', '_species',
+                 '_selective_dynamics', '_velocity')
+
     # Note: Index is not included here since it strictly applies
     # to the relative placement of the entry in the POSCAR file.
     # Indices are maintained where ion lists are relevant.
@@ -23,16 +281,96 @@ class Ion(object):
         """
         Initialize an oject to contain ion information.
         """
+        self._poscar = None
+        self._index = None
         self.position = position
         self.species = species
         self.selective_dynamics = selective_dynamics
         self.velocity = velocity
         self._reinforce_types()
 
+    @classmethod
+    def _view(cls, poscar, index:int):
+        """
+        Return an ion that views the given row of a POSCAR's arrays.
+        """
+        ion = cls.__new__(cls)
+        ion._poscar = poscar
+        ion._index = index
+        return ion
+
+    def __deepcopy__(self, memo):
+        """
+        Copies of ions are always detached from their POSCAR.
+        """
+        return self.detach()
+
+    def detach(self):
+        """
+        Return a detached copy of the ion.
+        """
+        return Ion(self.position, self.species,
+                   self.selective_dynamics, self.velocity)
+
+    @property
+    def position(self) -> np.array:
+        if self._poscar is None:
+            return self._position
+        return self._poscar._row('positions', self._index)
+
+    @position.setter
+    def position(self, value:np.array) -> None:
+        if self._poscar is None:
+            self._position = value
+        else:
+            self._poscar._writable('positions')[self._index] = value
+
+    @property
+    def species(self) -> str:
+        if self._poscar is None:
+            return self._species
+        return self._poscar._species_name(self._index)
+
+    @species.setter
+    def species(self, value:str) -> None:
+        if self._poscar is None:
+            self._species = value
+        else:
+            self._poscar._set_species(self._index, value)
+
+    @property
+    def selective_dynamics(self) -> np.array:
+        if self._poscar is None:
+            return self._selective_dynamics
+        return self._poscar._row('dynamics', self._index)
+
+    @selective_dynamics.setter
+    def selective_dynamics(self, value:np.array) -> None:
+        if self._poscar is None:
+            self._selective_dynamics = value
+        else:
+            self._poscar._writable('dynamics')[self._index] = value
+
+    @property
+    def velocity(self) -> np.array:
+        if self._poscar is None:
+            return self._velocity
+        return self._poscar._row('velocities', self._index)
+
+    @velocity.setter
+    def velocity(self, value:np.array) -> None:
+        if self._poscar is None:
+            self._velocity = value
+        else:
+            self._poscar._writable('velocities')[self._index] = value
+
     def _reinforce_types(self):
         """
         Check the types and ensure they are consistent with expectations.
+        Views are typed by the arrays of their POSCAR.
         """
+        if self._poscar is not None:
+            return
         self.position = np.array(self.position, dtype=float)
         self.species = str(self.species)
         self.selective_dynamics = np.array(self.selective_dynamics, dtype=bool)
@@ -42,10 +380,7 @@ class Ion(object):
         """
         Given transformation matrix (3x3), transform the coordinates of the ion.
         """
-        A = transform.reshape(3,3)
-        r = A @ self.position
-        r = r * np.array(np.abs(r)>tol, dtype=int)
-        self.position = r
+        self.position = transform_positions(self.position, transform, tol)
 
     @staticmethod
     def list_to_bools(v):
@@ -65,68 +400,491 @@ class Ion(object):
 
 # For use in POSCAR type hinting and ion portability
 class Ions(list[Ion]):
-    def __init__(self, ions:list[Ion]=[], indices:list=[]):
-        self.indices = indices
+    def __init__(self, ions:list[Ion]=[], indices:list=None):
+        self.indices = [] if indices is None else indices
         super().__init__(ions)
 
+# Selections of ions as boolean masks over a POSCAR
+class Selection(object):
+    """
+    A set of ions in a POSCAR stored as a boolean mask over its rows.
+    Selections combine without touching the structure:
+        a | b   union
+        a & b   intersection
+        a - b   difference
+        a ^ b   symmetric difference
+        ~a      inversion
+    """
+    def __init__(self, mask:np.array):
+        self.mask = np.asarray(mask, dtype=bool)
+
+    @classmethod
+    def from_indices(cls, indices:list[int], size:int):
+        """
+        Return a selection of the given indices out of size ions.
+        """
+        mask = np.zeros(size, dtype=bool)
+        mask[np.asarray(indices, dtype=int)] = True
+        return cls(mask)
+
+    @property
+    def indices(self) -> np.array:
+        return np.flatnonzero(self.mask)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.mask))
+
+    def __iter__(self):
+        return iter(self.indices.tolist())
+
+    def __contains__(self, index:int):
+        return bool(self.mask[index])
+
+    def _check(self, other) -> np.array:
+        if len(self.mask) != len(other.mask):
+            raise RuntimeError('Selections are over different numbers of ions!')
+        return other.mask
+
+    def __or__(self, other):
+        return Selection(self.mask | self._check(other))
+
+    def __and__(self, other):
+        return Selection(self.mask & self._check(other))
+
+    def __sub__(self, other):
+        return Selection(self.mask & ~self._check(other))
+
+    def __xor__(self, other):
+        return Selection(self.mask ^ self._check(other))
+
+    def __invert__(self):
+        return Selection(~self.mask)
+
+    def ions(self, poscar) -> Ions:
+        """
+        Return views of the selected ions of the POSCAR.
+        """
+        indices = self.indices.tolist()
+        return Ions([ Ion._view(poscar, i) for i in indices ], indices)
+
 # Class for an INCAR since it's basically just a dictionary
+# Tokens of INCAR values
+_INCAR_INT = re.compile(r'[+-]?\d+$')
+_INCAR_FLOAT = re.compile(r'[+-]?(\d+\.?\d*|\.\d+)([EeDd][+-]?\d+)?$')
+_INCAR_COMMENT = re.compile(r'\s*[!#]')
+_INCAR_BOOL = {'.TRUE.': True, '.FALSE.': False, '.T.': True, '.F.': False,
+               'T': True, 'F': False, 'TRUE': True, 'FALSE': False}
+
+def _incar_scalar(token:str):
+    """
+    Convert one INCAR token to a bool, int, or float, or return None if it is none of them.
+    """
+    flag = _INCAR_BOOL.get(token.upper())
+    if flag is not None:
+        return flag
+    if _INCAR_INT.match(token):
+        return int(token)
+    if _INCAR_FLOAT.match(token):
+        return float(token.replace('d','e').replace('D','e'))
+    return None
+
+def _format_incar_scalar(value) -> str:
+    if isinstance(value, (bool, np.bool_)):
+        return '.TRUE.' if value else '.FALSE.'
+    if isinstance(value, (float, np.floating)):
+        return repr(float(value))
+    return str(value)
+
+class IncarArray(object):
+    """
+    Multi-valued INCAR tag (such as MAGMOM) stored as runs of repeated values,
+    the way VASP writes them with n*value. The runs are expanded into an
+    array only when the values are used, and written back compactly.
+    """
+    def __init__(self, runs:list[tuple]):
+        self.runs = [ (int(count), value) for count, value in runs ]
+        self._array = None
+
+    @classmethod
+    def from_values(cls, values):
+        """
+        Compress a sequence of values into runs.
+        """
+        runs = []
+        for value in np.asarray(values).reshape(-1).tolist():
+            if len(runs) > 0 and runs[-1][1] == value and type(runs[-1][1]) == type(value):
+                runs[-1] = (runs[-1][0] + 1, value)
+            else:
+                runs.append((1, value))
+        return cls(runs)
+
+    @property
+    def array(self) -> np.array:
+        if self._array is None:
+            values = [ value for _, value in self.runs ]
+            if all( isinstance(v, bool) for v in values ):
+                dtype = bool
+            elif all( isinstance(v, int) for v in values ):
+                dtype = int
+            else:
+                dtype = float
+            self._array = np.repeat(np.array(values, dtype=dtype), [ count for count, _ in self.runs ])
+            self._array.flags.writeable = False
+        return self._array
+
+    def __array__(self, dtype=None, copy=None):
+        return self.array if dtype is None else self.array.astype(dtype)
+
+    def __len__(self):
+        return sum( count for count, _ in self.runs )
+
+    def __iter__(self):
+        return iter(self.array)
+
+    def __getitem__(self, index):
+        return self.array[index]
+
+    def __eq__(self, other):
+        if isinstance(other, IncarArray):
+            other = other.array
+        try:
+            other = np.asarray(other)
+        except Exception:
+            return NotImplemented
+        return self.array.shape == other.shape and bool(np.all(self.array == other))
+
+    def __repr__(self):
+        return f'IncarArray({self.to_string()!r})'
+
+    def to_string(self) -> str:
+        return ' '.join( f'{count}*{_format_incar_scalar(value)}' if count > 1 else _format_incar_scalar(value)
+                         for count, value in self.runs )
+
+# Class to parse and write INCAR files
 class Incar(dict):
+    """
+    Dictionary of INCAR tags with the comment of each tag kept on the side.
+    Tags are upper case, as VASP ignores their case. Values are converted
+    following VASP's rules: .TRUE./.FALSE. (and T/F) are bools, numbers
+    are ints or floats (including Fortran exponents such as 1.0D-5), and
+    several values, possibly with n*value repeats, are an IncarArray.
+    Anything else is kept as a string.
+    """
 
     # Use the normal dictionary constructor
-    # Add a comments list on the side
-    def __init__(self, d:dict, comments:list=[]):
-        self.comments = comments
+    # Add a comments list on the side, one entry per tag in order
+    def __init__(self, d:dict={}, comments:list=None):
+        self.comments = [] if comments is None else list(comments)
         super().__init__(d)
 
+    @staticmethod
+    def parse_value(value:str):
+        """
+        Convert the text of an INCAR value to its Python type.
+        """
+        value = value.strip()
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'':
+            return value[1:-1]
+        tokens = value.split()
+        if len(tokens) == 1 and not( '*' in value ):
+            scalar = _incar_scalar(tokens[0])
+            return value if scalar is None else scalar
+        # Plain lists of numbers are by far the most common, try them first
+        if not( '*' in value ):
+            for kind in (int, float):
+                try:
+                    return IncarArray([ (1, kind(token)) for token in tokens ])
+                except ValueError:
+                    pass
+        runs = []
+        for token in tokens:
+            count, star, item = token.partition('*')
+            if star:
+                if not( _INCAR_INT.match(count) ):
+                    return value
+                scalar = _incar_scalar(item)
+                count = int(count)
+            else:
+                scalar = _incar_scalar(token)
+                count = 1
+            if scalar is None:
+                return value
+            runs.append((count, scalar))
+        return IncarArray(runs)
+
+    @staticmethod
+    def _split_comment(line:str, quoted:bool=False) -> tuple[str, str, bool]:
+        """
+        Split a line into its body and comment, also returning whether
+        a double quoted value is left open at the end of the line.
+        Set quoted if the line starts inside a quoted value.
+        """
+        if not( '"' in line ) and not( quoted ):
+            match = _INCAR_COMMENT.search(line)
+            if match is None:
+                return line, '', False
+            return line[:match.start()], line[match.end():].strip(), False
+        for i, c in enumerate(line):
+            if c == '"':
+                quoted = not( quoted )
+            elif c in '!#' and not( quoted ):
+                return line[:i], line[i+1:].strip(), False
+        return line, '', quoted
+
+    @staticmethod
+    def _statements(text:str):
+        """
+        Split INCAR text into (key, value, comment) statements in one pass.
+        Statements end at newlines or semicolons, comments start with ! or #,
+        double quoted values may span lines, and a trailing backslash
+        continues a line.
+        """
+        lines = text.split('\n')
+        i = 0
+        while i < len(lines):
+            body, comment, open_quote = Incar._split_comment(lines[i])
+            i += 1
+            while i < len(lines) and (open_quote or body.rstrip().endswith('\\')):
+                if open_quote:
+                    body += '\n'
+                else:
+                    body = body.rstrip()[:-1] + ' '
+                more, comment, open_quote = Incar._split_comment(lines[i], open_quote)
+                body += more
+                i += 1
+            if not( '=' in body ):
+                continue
+            # Semicolons outside quotes separate statements, the comment belongs to the last
+            parts = body.split(';') if not( '"' in body ) else re.split(r';(?=(?:[^"]*"[^"]*")*[^"]*$)', body)
+            for j, part in enumerate(parts):
+                key, equals, value = part.partition('=')
+                if equals:
+                    yield key, value, comment if j == len(parts)-1 else ''
+
     @classmethod
-    def from_file(cls, input:str="INCAR"):
-        input_path = Path(input)
+    def from_string(cls, text:str):
         incar_dict = {}
-        comment_list = []
+        comments = {}
+        for key, value, comment in cls._statements(text):
+            key = key.strip().upper()
+            # Make sure the key and value aren't blank
+            if len(key) == 0 or len(value.strip()) == 0:
+                continue
+            incar_dict[key] = cls.parse_value(value)
+            comments[key] = comment
+        return cls(incar_dict, [ comments[key] for key in incar_dict ])
 
+    @classmethod
+    @phase('parse')
+    def from_file(cls, input:str="INCAR"):
+        input_path = Path(input)
         with input_path.open('r') as incar_file:
-            incar_text = incar_file.readlines()
-            for line in incar_text:
-                line = line.strip()
-                # Line formatting sanity checks
-                if len(line) == 0:
-                    continue
-                if line[0] in ('#','!'):
-                    continue
-                if not('=' in line):
-                    continue
-                # Retrieve values without extra whitespace
-                key, value = [i.strip() for i in line.split('=',maxsplit=1)]
-                comment = ''
-                # Determine if there are additional comments after the values
-                if '!' in value or '#' in value:
-                    comment_start = np.array([value.find('!'), value.find('#')])
-                    comment_start *= -1 if -1 in comment_start else 1
-                    comment_start = np.abs( comment_start.min() )
-                    comment = value[comment_start+1:].strip()
-                    value = value[:comment_start].strip()
-                # Make sure the key and value aren't blank
-                if len(key) == 0 or len(value) == 0:
-                    continue
-                # Evaluate the value string to cast as the appropriate type
-                # Defaults to original string in event of failure
-                try:
-                    value = literal_eval(value)
-                except ValueError:
-                    pass
-                except SyntaxError:
-                    pass
-                # Modify the return dictionary and list
-                incar_dict[str(key)] = value
-                comment_list.append(comment)
-        
-        return cls(incar_dict, comment_list)
-    
+            text = incar_file.read()
+        count_read(len(text))
+        return cls.from_string(text)
+
+    @staticmethod
+    def format_value(value) -> str:
+        """
+        Format a value as VASP reads it, so that parsing it gives the value back.
+        """
+        if isinstance(value, IncarArray):
+            return value.to_string()
+        if isinstance(value, (list, tuple, np.ndarray)):
+            return IncarArray.from_values(value).to_string()
+        if isinstance(value, str):
+            # Quote strings that would otherwise be cut short or change type
+            if any( c in value for c in '!#;\n' ) or Incar.parse_value(value) != value:
+                return f'"{value}"'
+            return value
+        return _format_incar_scalar(value)
+
+    def to_string(self) -> str:
+        width = max( [ len(str(key)) for key in self.keys() ] + [0] )
+        lines = []
+        for i, (key, value) in enumerate(self.items()):
+            line = f'{str(key).upper():<{width}} = {self.format_value(value)}'
+            comment = self.comments[i] if i < len(self.comments) else ''
+            if len(comment) > 0:
+                line += f' ! {comment}'
+            lines.append(line)
+        return '\n'.join(lines) + '\n'
+
+    @phase('write')
+    def to_file(self, file:str='INCAR', parents:bool=True) -> None:
+        """
+        Write the INCAR to the given file.
+        """
+        file = Path(file)
+        Path.mkdir(file.parent, parents=parents, exist_ok=True)
+        text = self.to_string()
+        with file.open('w') as f:
+            f.write(text)
+        count_written(len(text))
+
+# Potentials are small and reused across a batch, so keep the recent ones
+_POTENTIAL_CACHE_SIZE = 64
+
+@lru_cache(maxsize=_POTENTIAL_CACHE_SIZE)
+def _read_potential(path:str, size:int, mtime_ns:int) -> bytes:
+    """
+    Read a potential file. Size and mtime are part of the key so that
+    edited files are read again.
+    """
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _copy_into(dst, path:Path) -> None:
+    """
+    Append a file to an open binary file, in kernel space where possible.
+    """
+    with path.open('rb') as src:
+        size = os.fstat(src.fileno()).st_size
+        offset = 0
+        try:
+            while offset < size:
+                sent = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except (AttributeError, OSError):
+            # No sendfile on this platform or file system
+            src.seek(offset)
+            shutil.copyfileobj(src, dst)
+
+# Header fields of a POTCAR, read from its PSCTR parameters
+_POTCAR_FIELDS = {
+    'titel':  re.compile(rb'TITEL\s*=\s*(.*?)\s*$', re.MULTILINE),
+    'zval':   re.compile(rb'ZVAL\s*=\s*([-+.\dEe]+)'),
+    'enmax':  re.compile(rb'ENMAX\s*=\s*([-+.\dEe]+)'),
+    'enmin':  re.compile(rb'ENMIN\s*=\s*([-+.\dEe]+)'),
+    'pomass': re.compile(rb'POMASS\s*=\s*([-+.\dEe]+)'),
+}
+# The header is always within the first few kilobytes
+_POTCAR_HEADER_BYTES = 16384
+
+def _potential_header(path:Path) -> dict:
+    """
+    Parse the TITEL, ZVAL, ENMAX, ENMIN and POMASS of a single potential.
+    """
+    with path.open('rb') as f:
+        header = f.read(_POTCAR_HEADER_BYTES)
+    fields = {}
+    for name, pattern in _POTCAR_FIELDS.items():
+        match = pattern.search(header)
+        if match is None:
+            raise RuntimeError(f'No {name.upper()} in the header of {path}')
+        value = match.group(1).decode()
+        fields[name] = value if name == 'titel' else float(value)
+    return fields
+
+class PotentialIndex(object):
+    """
+    Header metadata of every potential in a directory of POTCAR folders,
+    persisted as JSON in the cache directory (see cache.py) so it is parsed
+    only once, and never written into the potential library itself.
+    Entries record the size and mtime of their POTCAR, which each lookup
+    checks, so an edited potential is parsed again.
+    """
+    # Loaded indexes by directory, shared by every Potcar in the process
+    _loaded = {}
+
+    def __init__(self, directory:str):
+        self.directory = Path(directory).resolve()
+        self.entries = {}
+        path = self._location()
+        if path is None or not( path.exists() ):
+            return
+        try:
+            with path.open('r') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    @classmethod
+    def of(cls, directory:str):
+        """
+        Return the index of a directory, loading it on first use.
+        """
+        key = Path(directory).resolve()
+        if not(key in cls._loaded):
+            cls._loaded[key] = cls(key)
+        return cls._loaded[key]
+
+    def _location(self) -> Path:
+        """
+        File of the index in the cache directory, or None if the cache is disabled.
+        """
+        store = default_cache()
+        if store is None:
+            return None
+        digest = hashlib.sha1(str(self.directory).encode()).hexdigest()
+        return Path(store.directory, f'potcar-{digest}.json')
+
+    def _entry(self, path:Path) -> dict:
+        stat = path.stat()
+        entry = _potential_header(path)
+        entry.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+        return entry
+
+    def _current(self, entry:dict, stat:os.stat_result) -> bool:
+        return entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns
+
+    def save(self) -> None:
+        path = self._location()
+        if path is None:
+            return
+        temporary = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with temporary.open('w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(temporary, path)
+        except OSError:
+            if temporary.exists():
+                temporary.unlink()
+            warnings.warn(f'Could not save the potential index of {self.directory}')
+
+    def build(self) -> None:
+        """
+        Index every potential in the directory, parsing only new or changed ones.
+        """
+        changed = False
+        present = set()
+        for path in sorted(self.directory.glob('*/POTCAR')):
+            name = path.parent.name
+            present.add(name)
+            if not( self._current(self.entries.get(name), path.stat()) ):
+                self.entries[name] = self._entry(path)
+                changed = True
+        for name in set(self.entries) - present:
+            del self.entries[name]
+            changed = True
+        if changed:
+            self.save()
+
+    def __getitem__(self, name:str) -> dict:
+        path = Path(self.directory, name, 'POTCAR')
+        try:
+            stat = path.stat()
+        except OSError:
+            raise RuntimeError(f'Potential {path} does not exist!')
+        if not( self._current(self.entries.get(name), stat) ):
+            self.entries[name] = self._entry(path)
+            self.save()
+        return self.entries[name]
+
 # Class for containing POTCAR info
 # Does not store POTCAR string, but can create it
 class Potcar(object):
     """
+    Concatenation of the POTCARs of a list of species. Outputs are streamed
+    from the source files, and identical outputs may be hard linked to the
+    first one written in this process instead of copied again.
     """
+    # Key of the source files -> first output written from them
+    _written = {}
+
     def __init__(self, potentials:list=[], directory:str='.'):
         self.potentials = potentials
         self.directory = Path(directory)
@@ -138,60 +896,333 @@ class Potcar(object):
         poscar = Poscar.from_file(input)
         return cls(list(poscar.species.keys()), directory)
 
-    def generate_string(self) -> str:
+    def potential_directory(self) -> Path:
+        """
+        Directory of the potential set in use.
+        """
         # Choose the LDA or PBE automatically if it isn't specified
-        if not(self.directory.name.lower() in ['gga', 'lda']):
-            if len(self.potentials) > 1:
-                directory = Path(self.directory, 'GGA')
-            else:
-                directory = Path(self.directory, 'LDA')
+        if self.directory.name.lower() in ['gga', 'lda']:
+            return self.directory
+        if len(self.potentials) > 1:
+            return Path(self.directory, 'GGA')
+        return Path(self.directory, 'LDA')
 
-        # Create a list of paths for the species' POTCARs
-        potential_paths = [ Path(directory, sp, 'POTCAR') for sp in self.potentials ]
+    def potential_paths(self) -> list:
+        """
+        Paths of the species' POTCARs in order.
+        """
+        directory = self.potential_directory()
+        paths = [ Path(directory, sp, 'POTCAR') for sp in self.potentials ]
+        for path in paths:
+            if not(path.is_file()):
+                raise RuntimeError(f'Potential {path} does not exist!')
+        return paths
+
+    def metadata(self) -> list:
+        """
+        Header metadata (titel, zval, enmax, enmin, pomass) of each potential
+        in order, from the persistent index of the potential set.
+        """
+        index = PotentialIndex.of(self.potential_directory())
+        return [ index[sp] for sp in self.potentials ]
+
+    def _counts(self, poscar) -> list:
+        counts = list(poscar.species.values())
+        if len(counts) != len(self.potentials):
+            raise RuntimeError(f'POSCAR has {len(counts)} species but there are '
+                               f'{len(self.potentials)} potentials!')
+        return counts
+
+    def nelect(self, poscar) -> float:
+        """
+        Number of valence electrons of a neutral structure.
+        """
+        return sum( count * data['zval'] for count, data in zip(self._counts(poscar), self.metadata()) )
+
+    def encut(self, factor:float=1.3) -> float:
+        """
+        Suggested plane wave cutoff, the largest ENMAX scaled by factor.
+        """
+        return factor * max( data['enmax'] for data in self.metadata() )
+
+    def nbands(self, poscar, ispin:int=1, magnetization:float=0.0, npar:int=1) -> int:
+        """
+        Estimate VASP's default NBANDS: max((NELECT+2)/2 + max(NIONS/2,3), 0.6*NELECT)
+        without spin, or 0.6*NELECT + total magnetization with ISPIN = 2.
+        The result is rounded up to a multiple of npar as VASP does.
+        """
+        nelect = self.nelect(poscar)
+        nions = sum(self._counts(poscar))
+        if ispin == 2:
+            nbands = int(0.6 * nelect + abs(magnetization))
+        else:
+            nbands = max( int(round(nelect + 2)) // 2 + max(nions // 2, 3), int(0.6 * nelect) )
+        return -(-nbands // npar) * npar
+
+    def _key(self, paths:list) -> tuple:
+        """
+        Identity of the concatenated output, from the source files' metadata.
+        """
+        key = []
+        for path in paths:
+            stat = path.stat()
+            key.append( (str(path.resolve()), stat.st_size, stat.st_mtime_ns) )
+        return tuple(key)
 
-        # Return the POTCARs as one concatenated string
-        contents = ''
-        for sp in potential_paths:
-            contents += sp.read_text()
+    def generate_bytes(self) -> bytes:
+        # Return the POTCARs as one concatenated block, reading each once per batch
+        return b''.join( _read_potential(*source) for source in self._key(self.potential_paths()) )
 
-        return contents
+    def generate_string(self) -> str:
+        return self.generate_bytes().decode()
     
-    def generate_file(self, output:str='POTCAR', parents:bool=True) -> None:
-        # Choose the LDA or PBE automatically if it isn't specified
+    @phase('write')
+    def generate_file(self, output:str='POTCAR', parents:bool=True, link:bool=False) -> None:
+        """
+        Write the POTCAR by copying the sources straight into the output.
+        With link, an output identical to one already written is hard linked
+        to it instead, falling back to a copy across file systems.
+        """
         output_path = Path(output)
         parent = output_path.parent
         Path.mkdir(parent, parents=parents, exist_ok=True)
-        with output_path.open('w') as f:
-            f.write(self.generate_string())
+        paths = self.potential_paths()
+        key = self._key(paths)
+
+        # Write to a temporary name and rename so a failure never leaves a partial POTCAR
+        temporary = Path(parent, f'.{output_path.name}.{os.getpid()}.tmp')
+        try:
+            if link and self._link(key, temporary):
+                pass
+            else:
+                with temporary.open('wb') as f:
+                    for path in paths:
+                        _copy_into(f, path)
+                    count_read(f.tell())
+                    count_written(f.tell())
+            os.replace(temporary, output_path)
+        finally:
+            if temporary.exists():
+                temporary.unlink()
+
+        if link and not(key in Potcar._written):
+            Potcar._written[key] = output_path.resolve()
+
+    def _link(self, key:tuple, target:Path) -> bool:
+        """
+        Hard link target to an earlier identical output if one still exists.
+        """
+        source = Potcar._written.get(key)
+        if source is None:
+            return False
+        expected = sum( size for _, size, _ in key )
+        try:
+            if source.stat().st_size != expected:
+                raise OSError
+            os.link(source, target)
+        except OSError:
+            # Gone, changed, or on another file system
+            del Potcar._written[key]
+            return False
+        return True
+
+
+# Arrays that Poscar copies share with their parent until written
+_SHARED_ARRAYS = ('positions', 'dynamics', 'velocities', 'species_indices')
+_SMALL_ARRAYS = ('scale', 'lattice', 'lattice_velocity')
+
+class _SharedArray(object):
+    """
+    An ion array of a POSCAR that copies of the POSCAR may share.
+    Reading it returns an array the POSCAR may write into, first taking
+    a private copy if another POSCAR still shares it or it is read-only.
+    """
+    def __set_name__(self, owner, name:str):
+        self.name = name
+        self.slot = '_' + name
+
+    def __get__(self, poscar, owner=None) -> np.array:
+        if poscar is None:
+            return self
+        array = poscar.__dict__[self.slot]
+        sharers = poscar._shared.pop(self.name, None)
+        if sharers is not None:
+            sharers[0] -= 1
+        if (sharers is not None and sharers[0] > 0) or not( array.flags.writeable ):
+            array = array.copy()
+            poscar.__dict__[self.slot] = array
+        return array
 
+    def __set__(self, poscar, array:np.array) -> None:
+        sharers = poscar._shared.pop(self.name, None)
+        if sharers is not None:
+            sharers[0] -= 1
+        poscar.__dict__[self.slot] = array
 
 # Class to parse and store POSCAR data in a rich, type hinted, format
 class Poscar(object):
     """
+    Ion data is stored as a structure of arrays rather than a list of objects:
+
+        positions        (N,3) float positions in the current mode
+        dynamics         (N,3) bool selective dynamics flags
+        velocities       (N,3) float velocities
+        species_indices  (N,)  int32 index into the species dictionary
+
+    Ions are always grouped by species in the order of the species dictionary.
+    The ions attribute provides Ion views of the arrays for convenience.
+
+    Structures derived with copy share unchanged ion arrays with their parent.
+    Each structure takes a private copy of a shared array the first time it
+    accesses it, so both sides can edit their arrays in place and only the
+    fields that are used again allocate. An array obtained before the copy
+    is still the one the parent shares.
     """
+    positions = _SharedArray()
+    dynamics = _SharedArray()
+    velocities = _SharedArray()
+    species_indices = _SharedArray()
+
     def __init__(self, comment:str="", scale:np.array=np.ones(3,dtype=float),
                  lattice:np.array=np.identity(3,dtype=float), species:dict= {},
                  selective_dynamics:bool=False, mode:str='Direct', ions:Ions=[],
-                 lattice_velocity:np.array=np.zeros((3,3)), mdextra:str=""):
+                 lattice_velocity:np.array=None, mdextra:str="",
+                 positions:np.array=None, dynamics:np.array=None,
+                 velocities:np.array=None):
         """
-        Initialize a POSCAR from argument data only
+        Initialize a POSCAR from argument data only.
+        Ion data may be given either as a list of ions or as arrays
+        ordered to match the species dictionary.
         """
         self.comment = comment
         self.scale = scale
         self.lattice = lattice
-        self.species = species
+        self.species = dict(species)
         self.selective_dynamics = selective_dynamics
         self.mode = mode
-        self.ions = ions
         self.lattice_velocity = lattice_velocity
         self.mdextra = mdextra
+        self.velocity_mode = None
+        self._ions = None
+        # Sharer counts of the ion arrays shared with copies, by name
+        self._shared = {}
+
+        if positions is None:
+            self.ions = ions
+            return
+
+        n = len(positions)
+        self.positions = np.array(positions, dtype=float).reshape(n,3)
+        self.dynamics = np.ones((n,3), dtype=bool) if dynamics is None\
+            else np.array(dynamics, dtype=bool).reshape(n,3)
+        self.velocities = np.zeros((n,3), dtype=float) if velocities is None\
+            else np.array(velocities, dtype=float).reshape(n,3)
+        self.species_indices = np.repeat(np.arange(len(self.species), dtype=np.int32),
+                                         list(self.species.values()))
+        if len(self.species_indices) != n:
+            raise RuntimeError('Mismatch between species and ion counts!')
 
     def __str__(self):
         """
         Automatic string conversion
         """
         return self.to_string()
-    
+
+    def __getstate__(self):
+        """
+        Leave the cached ion views out of copies and pickles, which own their arrays.
+        """
+        state = self.__dict__.copy()
+        state['_ions'] = None
+        state['_shared'] = {}
+        return state
+
+    def copy(self, **changes):
+        """
+        Return a copy-on-write copy of the POSCAR that shares its ion arrays.
+        Keyword arguments replace the named attributes of the copy.
+        """
+        poscar = Poscar.__new__(Poscar)
+        poscar.__dict__.update(self.__getstate__())
+        poscar.species = dict(self.species)
+        for name in _SMALL_ARRAYS:
+            setattr(poscar, name, copy(getattr(self, name)))
+        for name in _SHARED_ARRAYS:
+            sharers = self._shared.setdefault(name, [1])
+            sharers[0] += 1
+            poscar._shared[name] = sharers
+        for name, value in changes.items():
+            if not( hasattr(Poscar, name) or name in poscar.__dict__ ):
+                raise AttributeError(f'POSCAR has no attribute {name}')
+            setattr(poscar, name, value)
+        return poscar
+
+    def _writable(self, name:str) -> np.array:
+        """
+        Return the named array for writing, which reading already ensures.
+        """
+        return getattr(self, name)
+
+    def _peek(self, name:str) -> np.array:
+        """
+        Return the named array without taking a private copy, for reading only.
+        """
+        return self.__dict__['_' + name]
+
+    def _row(self, name:str, index:int) -> np.array:
+        """
+        Return one row of the named array as a view, so in-place edits
+        through an ion view write to the POSCAR.
+        """
+        return getattr(self, name)[index]
+
+    @property
+    def ions(self) -> Ions:
+        """
+        Ion views of every row in the POSCAR.
+        Editing a view edits the POSCAR, but adding or removing entries
+        from the returned list does not. Assign a new list instead.
+        """
+        if self._ions is None or len(self._ions) != len(self.positions):
+            n = len(self.positions)
+            self._ions = Ions([ Ion._view(self, i) for i in range(n) ], list(range(n)))
+        return self._ions
+
+    @ions.setter
+    def ions(self, ions:list[Ion]) -> None:
+        """
+        Replace the ion data with the contents of a list of ions.
+        """
+        n = len(ions)
+        self.positions = np.zeros((n,3), dtype=float)
+        self.dynamics = np.ones((n,3), dtype=bool)
+        self.velocities = np.zeros((n,3), dtype=float)
+        self.species_indices = np.zeros(n, dtype=np.int32)
+        self.species = {}
+        self._ions = None
+        for i, ion in enumerate(ions):
+            self.positions[i] = ion.position
+            self.dynamics[i] = ion.selective_dynamics
+            self.velocities[i] = ion.velocity
+            self._set_species(i, ion.species)
+        self._reconcile_ions()
+
+    def _species_name(self, index:int) -> str:
+        """
+        Return the species name of the ion at the given index.
+        """
+        return list(self.species.keys())[self.species_indices[index]]
+
+    def _set_species(self, index:int, name:str) -> None:
+        """
+        Set the species of the ion at the given index.
+        Populations are not updated until the ions are reconciled.
+        """
+        name = name.lower().capitalize()
+        if not( name in self.species ):
+            self.species[name] = 0
+        self._writable('species_indices')[index] = list(self.species.keys()).index(name)
+
     def _reconcile_ions(self):
         """
         Count the population of each species of ions and update
@@ -200,21 +1231,21 @@ class Poscar(object):
         and species populations since it's more intuitive to edit
         ions directly.
         """
-        # Make sure the species list is in order
-        species = {}
-        for ion in self.ions:
-            isp = ion.species.lower().capitalize()
-            if species.__contains__(isp):
-                species[isp] += 1
-            else:
-                species[isp] = 1
-        self.species = species
+        # Count each species and drop any that are no longer present
+        names = list(self.species.keys())
+        counts = np.bincount(self.species_indices, minlength=len(names))
+        present = np.flatnonzero(counts)
+        remap = np.zeros(len(names), dtype=np.int32)
+        remap[present] = np.arange(len(present), dtype=np.int32)
+        self.species_indices = remap[self.species_indices]
+        self.species = { names[i]:int(counts[i]) for i in present }
         # Make sure the ions are sorted properly
-        ions = []
-        for sp in self.species.keys():
-            mask = [ i.species==sp for i in self.ions ]
-            ions += list( it.compress(self.ions, mask) )
-        self.ions = ions
+        order = np.argsort(self.species_indices, kind='stable')
+        if np.any(order != np.arange(len(order))):
+            self.positions = self.positions[order]
+            self.dynamics = self.dynamics[order]
+            self.velocities = self.velocities[order]
+            self.species_indices = self.species_indices[order]
 
     def _toggle_mode(self) -> None:
         """
@@ -227,6 +1258,7 @@ class Poscar(object):
         else:
             raise RuntimeError('Unrecognized mode descriptor when attempting to toggle!')
 
+    @phase('transform')
     def _convert_to_direct(self, error=False) -> None:
         """
         Convert the mode to direct.
@@ -242,13 +1274,12 @@ class Poscar(object):
         A = self.lattice.transpose()
         Ainv = np.linalg.inv(A)
         # Convert all ion positions to fractions of the lattice vectors and round to zero
-
-        for i,_ in enumerate(self.ions):
-            self.ions[i]._apply_transformation(Ainv)
+        self.positions = transform_positions(self.positions, Ainv)
 
         # Change the mode string
         self.mode = "Direct"
 
+    @phase('transform')
     def _convert_to_cartesian(self, error=False) -> None:
         """
         Convert the mode to cartesian.
@@ -263,12 +1294,12 @@ class Poscar(object):
         # Convert all ion positions to fractions of the lattice vectors and round to zero
         # Create the transformation matrix and tolerance
         A = self.lattice.transpose()
-        for i, ion in enumerate(self.ions):
-            self.ions[i]._apply_transformation(A)
+        self.positions = transform_positions(self.positions, A)
 
         # Change the mode string
         self.mode = "Cartesian"
 
+    @phase('transform')
     def _constrain(self) -> None:
         """
         Make sure all ions lie within boundary of cell.
@@ -281,13 +1312,70 @@ class Poscar(object):
 
         # If any direct mode coordinate exceeds +-1
         # subtract the floor from that coordinate, keeping the fraction
-        for i, ion in enumerate(self.ions):
-            self.ions[i].position = ion.position - ion.position // 1
+        self.positions = self.positions - np.floor(self.positions)
 
         # Reconvert if necessary
         if converted:
             self._convert_to_cartesian()
 
+    @phase('transform')
+    def supercell(self, matrix) -> 'Poscar':
+        """
+        Return a supercell whose lattice vectors are the rows of matrix times
+        the current lattice vectors. The matrix may be three integers for a
+        diagonal supercell or a general 3x3 integer matrix. Ions keep their
+        species grouping, selective dynamics, and velocities, with the images
+        of each ion adjacent to one another.
+        """
+        matrix = np.asarray(matrix)
+        if matrix.size == 3:
+            matrix = np.diag(matrix.reshape(3))
+        matrix = matrix.reshape(3,3)
+        if np.any(matrix != np.round(matrix)):
+            raise RuntimeError('Supercell matrix must be integer valued!')
+        matrix = np.round(matrix).astype(int)
+        images = int(round(abs(np.linalg.det(matrix))))
+        if images == 0:
+            raise RuntimeError('Supercell matrix must not be singular!')
+        inverse = np.linalg.inv(matrix)
+        diagonal = np.all(matrix == np.diag(np.diag(matrix)))
+
+        # Lattice translations inside the supercell, from the box bounding its corners
+        corners = np.array([ [i,j,k] for i in (0,1) for j in (0,1) for k in (0,1) ]) @ matrix
+        axes = [ np.arange(lo, hi) for lo, hi in zip(corners.min(axis=0), corners.max(axis=0)) ]
+        translations = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1,3)
+        if not( diagonal ):
+            direct = translations @ inverse
+            inside = np.all((direct > -1e-8) & (direct < 1 - 1e-8), axis=1)
+            translations = translations[inside]
+        if len(translations) != images:
+            raise RuntimeError('Could not enumerate the supercell translations!')
+
+        # Every image of every ion at once, each ion's images kept together
+        A = self.lattice.transpose()
+        positions = self.positions if self.is_direct() else transform_positions(self.positions, np.linalg.inv(A))
+        positions = (positions[:,None,:] + translations[None,:,:]).reshape(-1,3)
+        positions = transform_positions(positions, inverse.T)
+        if not( diagonal ):
+            positions = positions - np.floor(positions)
+        lattice = matrix @ self.lattice
+        if self.is_cartesian():
+            positions = transform_positions(positions, lattice.transpose())
+
+        # Velocities in direct mode are fractions of the lattice vectors too
+        velocities = np.repeat(self.velocities, images, axis=0)
+        if self.velocity_mode == 'Direct':
+            velocities = transform_positions(velocities, inverse.T)
+
+        return self.copy(lattice=lattice,
+                         lattice_velocity=None if self.lattice_velocity is None else matrix @ self.lattice_velocity,
+                         species={ name:count*images for name, count in self.species.items() },
+                         positions=positions,
+                         dynamics=np.repeat(self.dynamics, images, axis=0),
+                         velocities=velocities,
+                         species_indices=np.repeat(self.species_indices, images),
+                         mdextra="")
+
     def is_cartesian(self) -> bool:
         """
         Return true if position mode is cartesian.
@@ -301,133 +1389,243 @@ class Poscar(object):
         return self.mode[0].lower() == 'd'
 
     @classmethod
-    def from_file(cls, poscar_file:str):
+    @phase('parse')
+    def from_file(cls, poscar_file:str, cache:bool=True):
         """
         Return a POSCAR object with data matching the provided poscar_file.
+        The file is read in one go and the position, selective dynamics,
+        and velocity blocks are each tokenized in a single pass.
+        Large files are kept in the on-disk cache (see cache.py) so that
+        later loads map the parsed arrays instead.
         """
         file_path = Path(poscar_file)
+        store = default_cache() if cache else None
+        if store is not None:
+            cached = store.load(file_path, 'poscar')
+            if cached is not None:
+                return cls._from_cached(*cached)
 
-        with file_path.open('r') as f:
-            # Read comment line
-            s_comment = f.readline().strip()
-
-            # Read scaling factor(s)
-            scale = f.readline().strip().split()
-            if len(scale) == 1:
-                scale = scale*3
-            elif len(scale) != 3:
-                raise ValueError( 'Wrong number of scaling \
-                                 factors supplied in POSCAR!' )
-            s_scale = np.array(scale, dtype=float)
-
-            # Read lattice vectors
-            vec = np.array([],dtype=float)
-            for _ in range(3):
-                line = f.readline()
-                v = np.array(line.strip().split(), dtype=float)
-                vec = np.append(vec, v)
-            s_lattice = vec.reshape((3,3))
-
-            # Mandatory check, species names
-            # Enforce capitalization
-            line = f.readline()
-            species = []
-            if line.replace(' ','').strip().isalpha():
-                species = [sp.lower().capitalize() for sp in line.split() ]
-                line = f.readline()
-            
-            # Read ions per species
-            counts = line.strip().split()
-            # Handle the optional case of no species specified
-            if len(species) == 0:
-                species = ['H'+str(i+1) for i in range(len(counts))]
-            elif len(species) != len(counts):
-                raise RuntimeError('Mismatch between species and ion counts!')
-            s_species = {str(sp.lower().capitalize()):int(ct) for sp, ct in zip(species,counts)}
-
-            # Optional check, selective dynamics
-            line = f.readline()
-            s_selective_dynamics = False
-            if line[0].lower() == 's':
-                s_selective_dynamics = True
-                line = f.readline()
-
-            # Read ion position mode
-            if line[0].lower() in ('c','k'):
-                s_mode = 'Cartesian'
-            elif line[0].lower() == 'd':
-                s_mode = 'Direct'
-            else:
-                raise RuntimeError('Unknown position mode')
-            
-            # Read in ion 
-            s_ions = []
-            ions = it.chain.from_iterable([ [sp]*c for sp, c in s_species.items() ])
-            for sp in ions:
-                line = f.readline().split()
-                r = np.array(line[0:3], dtype=float)
-                sd = ['True']*3
-                if s_selective_dynamics:
-                    sd = np.array([ False if f=='F' else True for f in line[3:6]], dtype=bool)
-                v = np.zeros(3)
-                s_ions.append(Ion(r, sp, sd, v))
-
-            # Leave velocity as zero
-            # Leave mdextra as empty
-
-            return cls(s_comment, s_scale, s_lattice, s_species,
-                       s_selective_dynamics, s_mode, s_ions)
+        data = file_path.read_bytes()
+        count_read(len(data))
+        poscar = cls.from_bytes(data)
+        if store is not None:
+            store.store(file_path, 'poscar', *poscar._to_cached())
+        return poscar
+
+    def _to_cached(self) -> tuple[dict, dict]:
+        """
+        Return the arrays and metadata that describe the POSCAR in the cache.
+        """
+        arrays = {'positions': self.positions, 'dynamics': self.dynamics}
+        if self.velocity_mode is not None:
+            arrays['velocities'] = self.velocities
+        lattice_velocity = None if self.lattice_velocity is None\
+            else np.asarray(self.lattice_velocity).tolist()
+        data = {'comment': self.comment, 'scale': np.asarray(self.scale).tolist(),
+                'lattice': np.asarray(self.lattice).tolist(), 'species': list(self.species.items()),
+                'selective_dynamics': self.selective_dynamics, 'mode': self.mode,
+                'lattice_velocity': lattice_velocity, 'mdextra': self.mdextra,
+                'velocity_mode': self.velocity_mode}
+        return arrays, data
+
+    @classmethod
+    def _from_cached(cls, arrays:dict, data:dict):
+        """
+        Return a POSCAR built from cached arrays, which are used in place.
+        """
+        lattice_velocity = data['lattice_velocity']
+        poscar = cls(data['comment'], np.array(data['scale']), np.array(data['lattice']),
+                     {}, data['selective_dynamics'], data['mode'],
+                     lattice_velocity=None if lattice_velocity is None else np.array(lattice_velocity),
+                     mdextra=data['mdextra'], positions=np.zeros((0,3)))
+        n = len(arrays['positions'])
+        poscar.species = dict(data['species'])
+        poscar.positions = arrays['positions']
+        poscar.dynamics = arrays['dynamics']
+        poscar.velocities = arrays['velocities'] if 'velocities' in arrays else np.zeros((n,3))
+        poscar.species_indices = np.repeat(np.arange(len(poscar.species), dtype=np.int32),
+                                           list(poscar.species.values()))
+        poscar.velocity_mode = data['velocity_mode']
+        return poscar
+
+    @classmethod
+    def from_bytes(cls, data:bytes):
+        """
+        Return a POSCAR object parsed from the contents of a POSCAR or CONTCAR.
+        """
+        # Offsets of every line ending, used to slice whole blocks at once
+        newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == 10)
+        if len(data) > 0 and data[-1:] != b'\n':
+            newlines = np.append(newlines, len(data))
+        cursor = 0
+        def line_range(start:int, count:int=1) -> tuple[int,int]:
+            """
+            Return the byte range of count lines starting at line number start.
+            """
+            if start+count > len(newlines):
+                raise RuntimeError('Unexpected end of POSCAR!')
+            begin = 0 if start == 0 else newlines[start-1]+1
+            return begin, newlines[start+count-1]
+        def line(start:int) -> str:
+            begin, end = line_range(start)
+            return data[begin:end].decode()
+
+        # Read comment line
+        s_comment = line(cursor).strip()
+        cursor += 1
+
+        # Read scaling factor(s)
+        scale = line(cursor).strip().split()
+        cursor += 1
+        if len(scale) == 1:
+            scale = scale*3
+        elif len(scale) != 3:
+            raise ValueError( 'Wrong number of scaling \
+                             factors supplied in POSCAR!' )
+        s_scale = np.array(scale, dtype=float)
+
+        # Read lattice vectors
+        s_lattice = np.array([ line(cursor+i).split()[0:3] for i in range(3) ], dtype=float)
+        cursor += 3
+
+        # Mandatory check, species names
+        # Enforce capitalization
+        species = []
+        if line(cursor).replace(' ','').strip().isalpha():
+            species = [sp.lower().capitalize() for sp in line(cursor).split() ]
+            cursor += 1
+
+        # Read ions per species
+        counts = line(cursor).strip().split()
+        cursor += 1
+        # Handle the optional case of no species specified
+        if len(species) == 0:
+            species = ['H'+str(i+1) for i in range(len(counts))]
+        elif len(species) != len(counts):
+            raise RuntimeError('Mismatch between species and ion counts!')
+        s_species = {str(sp.lower().capitalize()):int(ct) for sp, ct in zip(species,counts)}
+
+        # Optional check, selective dynamics
+        s_selective_dynamics = False
+        if line(cursor)[0].lower() == 's':
+            s_selective_dynamics = True
+            cursor += 1
+
+        # Read ion position mode
+        mode = line(cursor)
+        cursor += 1
+        if mode[0].lower() in ('c','k'):
+            s_mode = 'Cartesian'
+        elif mode[0].lower() == 'd':
+            s_mode = 'Direct'
+        else:
+            raise RuntimeError('Unknown position mode')
+
+        # Read in ion positions and flags as one block
+        n = sum(s_species.values())
+        begin, end = line_range(cursor, n)
+        cursor += n
+        s_positions, s_dynamics = _parse_block(data[begin:end+1], n, s_selective_dynamics)
+
+        # Optional lattice velocities and vectors (only the velocities are kept)
+        s_lattice_velocity = None
+        if cursor < len(newlines) and line(cursor).strip()[:1].lower() == 'l':
+            begin, end = line_range(cursor+2, 3)
+            s_lattice_velocity, _ = _parse_block(data[begin:end], 3, False)
+            cursor += 8
+
+        # Optional ion velocities, preceded by a blank or mode line
+        s_velocities, s_velocity_mode = None, None
+        if cursor+n < len(newlines) and n > 0:
+            mode = line(cursor).strip()
+            begin, end = line_range(cursor+1, n)
+            try:
+                s_velocities, _ = _parse_block(data[begin:end+1], n, False)
+                s_velocity_mode = 'Direct' if mode[:1].lower() == 'd' else 'Cartesian'
+                cursor += n+1
+            except ValueError:
+                s_velocities = None
+
+        # Keep anything that remains (predictor-corrector data) verbatim
+        s_mdextra = ''
+        if cursor < len(newlines):
+            begin, _ = line_range(cursor)
+            s_mdextra = data[begin:].decode()
+            if len(s_mdextra.strip()) == 0:
+                s_mdextra = ''
+
+        poscar = cls(s_comment, s_scale, s_lattice, s_species,
+                     s_selective_dynamics, s_mode,
+                     lattice_velocity=s_lattice_velocity, mdextra=s_mdextra,
+                     positions=s_positions, dynamics=s_dynamics,
+                     velocities=s_velocities)
+        poscar.velocity_mode = s_velocity_mode
+        return poscar
 
     def to_string(self) -> str:
         """
         Return a formatted string of the POSCAR dictionary as would be found in a file.
         """
+        buffer = io.StringIO()
+        self.write(buffer)
+        return buffer.getvalue()
+
+    def write(self, f) -> None:
+        """
+        Stream the POSCAR, as would be found in a file, to an open text handle.
+        Ion blocks are formatted a chunk of rows at a time rather than line by line.
+        """
         # Write comment line
-        poscar_string = ""
-        poscar_string += self.comment + '\n'
+        header = [self.comment + '\n']
 
         # Write scaling factor
         if np.allclose(self.scale, [self.scale[0]]*3):
-            poscar_string += '  {:>11.8f}\n'.format(self.scale[0])
+            header.append('  {:>11.8f}\n'.format(self.scale[0]))
         else:
-            poscar_string += '  {:>11.8f}  {:>11.8f}  {:>11.8f}\n'.format(*self.scale)
+            header.append('  {:>11.8f}  {:>11.8f}  {:>11.8f}\n'.format(*self.scale))
 
         # Write lattice vectors
         for i in self.lattice:
-            poscar_string += '    {:>11.8f}  {:>11.8f}  {:>11.8f}\n'.format(*i)
-        
+            header.append('    {:>11.8f}  {:>11.8f}  {:>11.8f}\n'.format(*i))
+
         # Write the species names
-        line = ''
         # If all the species are placeholder H0, H1, H2, ..., then skip writing this line
         if False in [ bool(re.match( r"H[0-9]+", sp )) for sp in self.species.keys() ]:
-            line += ' '.join( [f"{sp:>6s}" for sp in self.species.keys()] ) + '\n'
-        else:
-            line = ''
-        poscar_string += line
+            header.append(' '.join( [f"{sp:>6s}" for sp in self.species.keys()] ) + '\n')
 
         # Write species numbers
-        line = ''
-        line += ' '.join( [f"{c:>6d}" for c in self.species.values()] ) + '\n'
-        poscar_string += line
+        header.append(' '.join( [f"{c:>6d}" for c in self.species.values()] ) + '\n')
 
         # Write selective dynamics if enabled
         if self.selective_dynamics:
-            poscar_string += 'Selective dynamics\n'
+            header.append('Selective dynamics\n')
 
         # Write position mode
-        poscar_string += self.mode + '\n'
+        header.append(self.mode + '\n')
+        f.write(''.join(header))
 
         # Write the ion positions with selective dynamics tags if needed
-        for ion in self.ions:
-            line = '{:>11.8f}  {:>11.8f}  {:>11.8f}'.format(*ion.position)
-            if self.selective_dynamics:
-                line += ' {:>1s} {:>1s} {:>1s}'.format(*[ 'T' if t else 'F' for t in ion.selective_dynamics])
-            poscar_string += line + '\n'
+        flags = self._peek('dynamics') if self.selective_dynamics else None
+        _write_block(f, self._peek('positions'), '%11.8f  %11.8f  %11.8f', flags)
 
-        # TODO: Write littec vector and ion velocities and MD extra
+        # Write the lattice velocities along with the current lattice vectors
+        if self.lattice_velocity is not None:
+            f.write('Lattice velocities and vectors\n  1\n')
+            _write_block(f, np.asarray(self.lattice_velocity, dtype=float).reshape(3,3),
+                         '  %15.8E %15.8E %15.8E')
+            _write_block(f, self.lattice, '  %15.8E %15.8E %15.8E')
 
-        return poscar_string
-    
+        # Write the ion velocities if they were read or have been set
+        velocities = self._peek('velocities')
+        if self.velocity_mode is not None or np.any(velocities):
+            f.write('Direct\n' if self.velocity_mode == 'Direct' else '\n')
+            _write_block(f, velocities, '  %15.8E %15.8E %15.8E')
+
+        # Write the MD extra (predictor-corrector) data verbatim
+        if len(self.mdextra) > 0:
+            f.write(self.mdextra if self.mdextra.endswith('\n') else self.mdextra + '\n')
+
+    @phase('write')
     def to_file(self, file:str, parents=True) -> None:
         """
         Write the POSCAR to the given file.
@@ -435,9 +1633,10 @@ class Poscar(object):
         file = Path(file)
         parent = file.parent
         Path.mkdir(parent, parents=parents, exist_ok=True)
-        with file.open('w') as f:
-            f.write(self.to_string())
-        
+        with file.open('w', buffering=_WRITE_BUFFER) as f:
+            self.write(f)
+            count_written(f.tell())
+
     def generate_potcar_str(self, potcar_dir:str='.') -> str:
         """
         Generate a POTCAR for the current POSCAR.
@@ -453,18 +1652,718 @@ class Poscar(object):
         potcar = Potcar(self.species.keys(), potcar_dir)
         potcar.generate_file(output)
 
-    def edit_ions(self, ions:Ions):
+    def _selection_mask(self, ions) -> np.array:
+        """
+        Return a boolean mask over the ions from a Selection, a boolean
+        array, an Ions list, or a list of indices.
+        """
+        n = len(self.positions)
+        if isinstance(ions, Selection):
+            mask = ions.mask
+        elif isinstance(ions, Ions):
+            mask = Selection.from_indices(ions.indices, n).mask
+        else:
+            mask = np.asarray(ions)
+            if mask.dtype != bool:
+                mask = Selection.from_indices(mask.reshape(-1), n).mask
+        if len(mask) != n:
+            raise RuntimeError('Selection does not match the number of ions!')
+        return mask
+
+    def edit_ions(self, ions, position:np.array=None, species:str=None,
+                  selective_dynamics:np.array=None, velocity:np.array=None):
         """
         Overwrite matching ions in the POSCAR by index.
+        Given Ions, each ion's data is copied to its index. Given a Selection
+        (or mask), the provided attributes are applied to every selected ion.
         """
-        for i, ion in zip(ions.indices, ions):
-            self.ions[i] = ion
+        attributes = (position, species, selective_dynamics, velocity)
+        if isinstance(ions, Ions) and all( a is None for a in attributes ):
+            indices = np.asarray(ions.indices, dtype=int)
+            if len(indices) == 0:
+                return
+            positions = np.array([ ion.position for ion in ions ], dtype=float)
+            dynamics = np.array([ ion.selective_dynamics for ion in ions ], dtype=bool)
+            velocities = np.array([ ion.velocity for ion in ions ], dtype=float)
+            names = [ ion.species for ion in ions ]
+            self._writable('positions')[indices] = positions
+            self._writable('dynamics')[indices] = dynamics
+            self._writable('velocities')[indices] = velocities
+            for i, name in zip(indices, names):
+                self._set_species(i, name)
+            self._reconcile_ions()
+            return
+
+        mask = self._selection_mask(ions)
+        if position is not None:
+            self._writable('positions')[mask] = position
+        if selective_dynamics is not None:
+            self._writable('dynamics')[mask] = np.asarray(selective_dynamics, dtype=bool)
+        if velocity is not None:
+            self._writable('velocities')[mask] = velocity
+        if species is not None:
+            indices = np.flatnonzero(mask)
+            if len(indices) > 0:
+                self._set_species(indices[0], species)
+                self._writable('species_indices')[mask] = self.species_indices[indices[0]]
+            self._reconcile_ions()
+
+    def remove_ions(self, ions):
+        """
+        Remove the ions provided in the list, selection, or mask according to index.
+        """
+        keep = ~self._selection_mask(ions)
+        self.positions = self.positions[keep]
+        self.dynamics = self.dynamics[keep]
+        self.velocities = self.velocities[keep]
+        self.species_indices = self.species_indices[keep]
         self._reconcile_ions()
 
-    def remove_ions(self, ions:Ions):
+    def _pair_thresholds(self, threshold, first:np.array, second:np.array) -> np.array:
+        """
+        Per pair thresholds from a single value or a dictionary of values per
+        species, taking the larger value of the two species in each pair.
+        """
+        if not( isinstance(threshold, dict) ):
+            return np.full(len(first), float(threshold))
+        names = [ name.lower() for name in self.species.keys() ]
+        default = threshold.get('default', 0.0)
+        lookup = { name.lower():value for name, value in threshold.items() }
+        values = np.array([ lookup.get(name, default) for name in names ], dtype=float)
+        return np.maximum(values[self.species_indices[first]], values[self.species_indices[second]])
+
+    @phase('select')
+    def overlaps(self, threshold=0.5) -> tuple[np.array, np.array, np.array]:
+        """
+        Find pairs of ions closer than a threshold across periodic images.
+        The threshold is one distance, or a dictionary of distances per species
+        (with an optional 'default' entry) where each pair uses the larger
+        value of its two species. Returns first indices, second indices, and
+        distances of the overlapping pairs.
+        """
+        if isinstance(threshold, dict):
+            cutoff = max(threshold.values())
+        else:
+            cutoff = float(threshold)
+        if len(self.positions) < 2 or cutoff <= 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+        first, second, distances = NeighborIndex(self, cutoff).pairs()
+        close = distances < self._pair_thresholds(threshold, first, second)
+        return first[close], second[close], distances[close]
+
+    @phase('transform')
+    def merge_duplicates(self, tolerance:float=0.1) -> int:
+        """
+        Remove ions that duplicate another ion of the same species within
+        tolerance, keeping the first ion of each group.
+        Returns the number of ions removed.
+        """
+        first, second, _ = self.overlaps(tolerance)
+        same = self.species_indices[first] == self.species_indices[second]
+        first, second = first[same], second[same]
+        if len(first) == 0:
+            return 0
+
+        # Label each group of duplicates by its lowest index
+        labels = np.arange(len(self.positions))
+        while True:
+            lowest = np.minimum(labels[first], labels[second])
+            updated = labels.copy()
+            np.minimum.at(updated, first, lowest)
+            np.minimum.at(updated, second, lowest)
+            if np.array_equal(updated, labels):
+                break
+            labels = updated
+        duplicates = labels != np.arange(len(labels))
+        self.remove_ions(duplicates)
+        return int(duplicates.sum())
+
+# Periodic cell list for fixed radius neighbor searches
+class NeighborIndex(object):
+    """
+    Spatial index of the ions in a POSCAR for periodic radius queries.
+    Ions are binned along each lattice vector into cells at least one cutoff
+    wide (measured perpendicular to the opposite faces), so triclinic cells
+    are handled exactly and a query only inspects the neighboring cells.
+    The index is a snapshot: rebuild it after moving ions.
+    """
+    @phase('select')
+    def __init__(self, poscar:Poscar, cutoff:float):
+        """
+        Build the index for queries up to the cutoff radius.
+        """
+        if cutoff <= 0:
+            raise RuntimeError('Neighbor cutoff must be positive!')
+        self.cutoff = float(cutoff)
+        self.lattice = np.array(poscar.lattice, dtype=float)
+        self._inverse = np.linalg.inv(self.lattice)
+
+        # Wrapped fractional and cartesian positions
+        direct = poscar.positions if poscar.is_direct()\
+            else transform_positions(poscar.positions, self._inverse.transpose(), 0)
+        self.direct = direct - np.floor(direct)
+        self.cartesian = self.direct @ self.lattice
+
+        # Number of cells along each lattice vector and how many cells a query must reach
+        volume = abs(np.linalg.det(self.lattice))
+        areas = np.linalg.norm(np.cross(self.lattice[[1,2,0]], self.lattice[[2,0,1]]), axis=1)
+        widths = volume / areas
+        self.shape = np.maximum(1, np.floor(widths / self.cutoff)).astype(int)
+        # A cutoff far below the ion spacing would give mostly empty cells, so
+        # widen them until there are about as many cells as ions
+        limit = max(1, 2*len(self.direct))
+        if self.shape.prod() > limit:
+            factor = (self.shape.prod() / limit)**(1/3)
+            self.shape = np.maximum(1, np.floor(self.shape / factor)).astype(int)
+        self.reach = np.ceil(self.cutoff * self.shape / widths - 1e-12).astype(int)
+
+        # Sort the ions by cell so that each cell is a contiguous slice
+        cells = np.minimum((self.direct * self.shape).astype(int), self.shape-1)
+        ids = np.ravel_multi_index(cells.transpose(), self.shape)
+        self.order = np.argsort(ids, kind='stable')
+        self.starts = np.searchsorted(ids[self.order], np.arange(self.shape.prod()+1))
+
+        # Every cell offset a query has to visit
+        self.offsets = np.array(np.meshgrid(*[ np.arange(-r, r+1) for r in self.reach ],
+                                            indexing='ij')).reshape(3,-1).transpose()
+
+    def __len__(self):
+        return len(self.order)
+
+    def query(self, point:np.array, radius:float=None, direct:bool=False) -> tuple[np.array, np.array]:
+        """
+        Return the indices of ions within radius of a point along with their
+        minimum image distances, sorted by index. The point is cartesian unless
+        direct is set.
+        """
+        radius = self.cutoff if radius is None else radius
+        if radius > self.cutoff:
+            raise RuntimeError('Query radius exceeds the neighbor index cutoff!')
+        point = np.asarray(point, dtype=float)
+        point = point if direct else point @ self._inverse
+        point = point - np.floor(point)
+        cell = np.minimum((point * self.shape).astype(int), self.shape-1)
+
+        # Neighboring cells and the periodic image each one is taken from
+        visit = cell + self.offsets
+        images = np.floor_divide(visit, self.shape)
+        ids = np.ravel_multi_index(np.mod(visit, self.shape).transpose(), self.shape)
+
+        # Gather the members of every visited cell in one go
+        lengths = self.starts[ids+1] - self.starts[ids]
+        total = lengths.sum()
+        if total == 0:
+            return np.zeros(0, dtype=int), np.zeros(0)
+        first = np.repeat(self.starts[ids] - np.cumsum(lengths) + lengths, lengths)
+        members = self.order[first + np.arange(total)]
+        shifts = np.repeat(images, lengths, axis=0) @ self.lattice
+
+        # Distances to each image, keeping the nearest image of each ion
+        vectors = self.cartesian[members] + shifts - point @ self.lattice
+        distances = np.sqrt((vectors**2).sum(axis=1))
+        keep = distances <= radius
+        members, distances = members[keep], distances[keep]
+        order = np.lexsort((distances, members))
+        members, distances = members[order], distances[order]
+        first = np.ones(len(members), dtype=bool)
+        first[1:] = members[1:] != members[:-1]
+        return members[first], distances[first]
+
+    def neighbors(self, index:int, radius:float=None) -> tuple[np.array, np.array]:
+        """
+        Return the neighbors of the ion at index (excluding itself) and their distances.
+        """
+        members, distances = self.query(self.direct[index], radius, direct=True)
+        keep = members != index
+        return members[keep], distances[keep]
+
+    def pairs(self, radius:float=None) -> tuple[np.array, np.array, np.array]:
+        """
+        Return every pair of ions (i < j) within radius of each other as arrays
+        of first indices, second indices, and minimum image distances, sorted
+        by pair. Cost is linear in the number of ions at fixed density.
+        """
+        radius = self.cutoff if radius is None else radius
+        if radius > self.cutoff:
+            raise RuntimeError('Query radius exceeds the neighbor index cutoff!')
+        n = len(self.order)
+        cells = np.minimum((self.direct * self.shape).astype(int), self.shape-1)
+        found_i, found_j, found_d = [], [], []
+
+        # One neighboring cell offset at a time for every ion at once
+        for offset in self.offsets:
+            visit = cells + offset
+            images = np.floor_divide(visit, self.shape)
+            ids = np.ravel_multi_index(np.mod(visit, self.shape).transpose(), self.shape)
+            lengths = self.starts[ids+1] - self.starts[ids]
+            total = lengths.sum()
+            if total == 0:
+                continue
+            first = np.repeat(np.arange(n), lengths)
+            position = np.repeat(self.starts[ids] - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+            second = self.order[position]
+            keep = first < second
+            first, second = first[keep], second[keep]
+            shifts = np.repeat(images, lengths, axis=0)[keep] @ self.lattice
+            vectors = self.cartesian[second] + shifts - self.cartesian[first]
+            distances = np.sqrt((vectors**2).sum(axis=1))
+            close = distances <= radius
+            found_i.append(first[close])
+            found_j.append(second[close])
+            found_d.append(distances[close])
+
+        if len(found_i) == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+        first, second, distances = np.concatenate(found_i), np.concatenate(found_j), np.concatenate(found_d)
+
+        # Small cells can reach the same pair through several images, keep the nearest
+        order = np.lexsort((distances, second, first))
+        first, second, distances = first[order], second[order], distances[order]
+        unique = np.ones(len(first), dtype=bool)
+        unique[1:] = (first[1:] != first[:-1]) | (second[1:] != second[:-1])
+        return first[unique], second[unique], distances[unique]
+
+# Class for reading XDATCAR trajectories without loading them into memory
+class Trajectory(object):
+    """
+    Frames of an XDATCAR accessed through a memory map of the file.
+    Opening builds an index of the byte offset of every frame, after which
+    frames are read on demand:
+
+        len(trajectory)        number of frames
+        trajectory[i]          (N,3) direct positions of frame i
+        trajectory[i:j:k]      a trajectory of the selected frames
+        iter(trajectory)       generator of the positions of each frame
+        trajectory.lattice(i)  lattice vectors of frame i
+        trajectory.frame(i)    frame i as a POSCAR
+
+    Variable cell (NPT) files, which repeat the header before every frame,
+    are detected automatically. Positions may be read as float32 to halve
+    their memory.
+    """
+    @phase('parse')
+    def __init__(self, file:str, dtype=np.float64, cache:bool=True):
+        """
+        Map the file and index the offset of every frame. The index of
+        large files is kept in the on-disk cache (see cache.py).
+        """
+        self.path = Path(file)
+        self.dtype = np.dtype(dtype)
+        self._file = self.path.open('rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # The header together with the first frame is a valid POSCAR
+        first = self._map.find(_FRAME_MARKER)
+        if first < 0:
+            raise RuntimeError('No configurations found in XDATCAR!')
+        first = self._map.rfind(b'\n', 0, first) + 1
+        header = self._map[:first].split(b'\n')
+        self._header_lines = len(header) - 1
+        self.natoms = sum( int(c) for c in header[-2].split() )
+
+        # Reuse the frame index from the cache if the file is unchanged
+        store = default_cache() if cache else None
+        cached = None if store is None else store.load(self.path, 'xdatcar')
+        if cached is not None:
+            self.offsets = cached[0]['offsets']
+        else:
+            self.offsets = self._index_frames(first)
+        self.header = self._poscar_at(0, 0)
+
+        # Variable cell files repeat the header between frames
+        self.variable_cell = False
+        if len(self.offsets) > 1:
+            _, end = self._block_range(0)
+            self.variable_cell = len(self._map[end:self.offsets[1]].strip()) > 0
+
+        if store is not None and cached is None:
+            store.store(self.path, 'xdatcar', {'offsets': self.offsets}, {})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        """
+        Release the memory map and file handle.
+        """
+        if self._file.closed:
+            return
+        self._map.close()
+        self._file.close()
+
+    def _index_frames(self, first:int) -> np.array:
+        """
+        Return the offsets of the line that starts each frame. Frames are
+        usually evenly spaced, so each predicted offset is checked before
+        falling back to a search, which avoids scanning the whole file.
+        A final frame that is still being written is left out.
+        """
+        offsets = [first]
+        stride = None
+        size = len(self._map)
+        while True:
+            previous = offsets[-1]
+            found = -1
+            if stride is not None and previous+stride < size:
+                guess = previous + stride
+                line_end = self._map.find(b'\n', guess)
+                line_end = size if line_end < 0 else line_end
+                if self._map[guess-1:guess] == b'\n'\
+                and self._map.find(_FRAME_MARKER, guess, line_end) >= 0:
+                    found = guess
+            if found < 0:
+                found = self._map.find(_FRAME_MARKER, self._map.find(b'\n', previous)+1)
+                if found < 0:
+                    break
+                found = self._map.rfind(b'\n', 0, found) + 1
+            stride = found - previous
+            offsets.append(found)
+        self.offsets = np.array(offsets, dtype=np.int64)
+        try:
+            self._block_range(len(offsets)-1)
+        except RuntimeError:
+            self.offsets = self.offsets[:-1]
+        return self.offsets
+
+    def _block_range(self, index:int) -> tuple[int,int]:
+        """
+        Return the byte range of the coordinate lines of a frame.
+        """
+        start = self._map.find(b'\n', self.offsets[index]) + 1
+        stop = self.offsets[index+1] if index+1 < len(self.offsets) else len(self._map)
+        if start == 0:
+            raise RuntimeError(f'Frame {index} of the XDATCAR is truncated!')
+        region = np.frombuffer(self._map, dtype=np.uint8, count=stop-start, offset=start)
+        newlines = np.flatnonzero(region == 10)
+        if len(newlines) >= self.natoms:
+            return start, start + int(newlines[self.natoms-1])
+        # The last line of the file may not end with a newline
+        if stop == len(self._map) and len(newlines) == self.natoms-1\
+        and len(self._map[start+newlines[-1]+1:stop].split()) >= 3:
+            return start, stop
+        raise RuntimeError(f'Frame {index} of the XDATCAR is truncated!')
+
+    def _header_start(self, index:int) -> int:
+        """
+        Return the offset of the header preceding a frame.
+        """
+        start = self.offsets[index]
+        for _ in range(self._header_lines):
+            start = self._map.rfind(b'\n', 0, start-1) + 1
+        return start
+
+    def _poscar_at(self, index:int, offset:int) -> Poscar:
+        """
+        Parse the header starting at offset together with the frame as a POSCAR.
+        """
+        _, end = self._block_range(index)
+        return Poscar.from_bytes(self._map[offset:end] + b'\n')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, key):
+        """
+        Return the positions of one frame, or a trajectory of a slice of frames.
+        """
+        if isinstance(key, (slice, list, np.ndarray)):
+            subset = copy(self)
+            subset.offsets = self.offsets[key]
+            return subset
+        index = range(len(self.offsets))[key]
+        start, end = self._block_range(index)
+        positions, _ = _parse_block(self._map[start:end], self.natoms, dtype=self.dtype)
+        return positions
+
+    def __iter__(self):
+        """
+        Yield the positions of each frame in turn.
+        """
+        for index in range(len(self.offsets)):
+            yield self[index]
+
+    def lattice(self, index:int) -> np.array:
+        """
+        Return the lattice vectors of a frame.
+        """
+        if not( self.variable_cell ):
+            return self.header.lattice
+        index = range(len(self.offsets))[index]
+        return self._poscar_at(index, self._header_start(index)).lattice
+
+    def frame(self, index:int) -> Poscar:
+        """
+        Return a frame as a POSCAR in direct mode.
+        """
+        index = range(len(self.offsets))[index]
+        if self.variable_cell:
+            return self._poscar_at(index, self._header_start(index))
+        return self.header.copy(positions=np.asarray(self[index], dtype=float))
+
+# Class for random access to the ionic steps of an OUTCAR
+class Outcar(object):
+    """
+    Ionic steps of an OUTCAR read on demand through a memory map.
+    Opening finds the byte offset of the POSITION/TOTAL-FORCE table of every
+    ionic step in one pass. The index is kept in a small sidecar file beside
+    the OUTCAR so later opens, even of a file that has since grown, do not
+    rescan what has already been indexed.
+
+        len(outcar)           number of ionic steps
+        outcar.positions(i)   (N,3) cartesian positions of step i
+        outcar.forces(i)      (N,3) total forces of step i
+        outcar.energy(i)      free energy, energy without entropy and sigma->0
+        outcar.stress(i)      (6,) stress in kB (XX YY ZZ XY YZ ZX) or None
+        outcar.timing(i)      cpu and real time of the ionic loop or None
+    """
+    def __init__(self, file:str='OUTCAR', persist:bool=True):
+        """
+        Map the file and load or build the index of ionic steps.
+        """
+        self.path = Path(file)
+        self.persist = persist
+        self._file = None
+        self._map = None
+        self.offsets = np.zeros(0, dtype=np.int64)
+        self._scanned = 0
+        self.natoms = None
+        self._load_index()
+        self.refresh()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        """
+        Release the memory map and file handle.
+        """
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+            self._map = None
+
+    @property
+    def _index_path(self) -> Path:
+        return Path(self.path.parent, f'.{self.path.name}.index.npz')
+
+    def _load_index(self) -> None:
+        """
+        Load a previously saved index if it still describes the start of the file.
+        """
+        if not( self.persist ) or not( self._index_path.exists() ):
+            return
+        try:
+            with np.load(self._index_path) as saved:
+                scanned = int(saved['scanned'])
+                head = saved['head'].tobytes()
+                with self.path.open('rb') as f:
+                    if self.path.stat().st_size < scanned or f.read(len(head)) != head:
+                        return
+                self.offsets = saved['offsets']
+                self.natoms = int(saved['natoms'])
+                self._scanned = scanned
+        except (OSError, KeyError, ValueError):
+            return
+
+    def _save_index(self) -> None:
+        """
+        Save the index beside the OUTCAR, skipping quietly if that is not possible.
+        """
+        if not( self.persist ):
+            return
+        try:
+            head = np.frombuffer(self._map[:4096], dtype=np.uint8)
+            with self._index_path.open('wb') as f:
+                np.savez(f, offsets=self.offsets, natoms=self.natoms,
+                         scanned=self._scanned, head=head)
+        except OSError:
+            pass
+
+    @phase('parse')
+    def refresh(self) -> None:
+        """
+        Extend the index with any ionic steps appended since it was built.
+        """
+        self.close()
+        self._file = self.path.open('rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.natoms is None:
+            start = self._map.find(b'NIONS =')
+            if start < 0:
+                raise RuntimeError('Number of ions not found in OUTCAR!')
+            self.natoms = int(self._map[start+7:self._map.find(b'\n', start)].split()[0])
+
+        # Only scan what has been written since the last scan
+        if len(self._map) == self._scanned:
+            return
+        offsets = []
+        found = self._map.find(_FORCE_MARKER, self._scanned)
+        while found >= 0:
+            offsets.append(found)
+            found = self._map.find(_FORCE_MARKER, found+1)
+
+        # Leave out a final table that is still being written
+        if len(offsets) > 0 and self._table_range(offsets[-1]) is None:
+            offsets.pop()
+        scanned = offsets[-1]+1 if len(offsets) > 0 else self._scanned
+        count_read(scanned - self._scanned)
+        self._scanned = scanned
+        self.offsets = np.append(self.offsets, np.array(offsets, dtype=np.int64))
+        self._save_index()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _step(self, index:int) -> int:
+        return int(self.offsets[range(len(self.offsets))[index]])
+
+    def _table_range(self, offset:int) -> tuple[int,int]:
+        """
+        Return the byte range of the rows of the table at offset, or None if incomplete.
+        """
+        start = self._map.find(b'\n', offset)
+        start = self._map.find(b'\n', start+1) + 1
+        end = start
+        for _ in range(self.natoms):
+            end = self._map.find(b'\n', end) + 1
+            if end == 0:
+                return None
+        return start, end
+
+    def _table(self, index:int) -> np.array:
+        """
+        Return the (N,6) position and force table of an ionic step.
+        """
+        start, end = self._table_range(self._step(index))
+        return _parse_table(self._map[start:end], self.natoms, 6)
+
+    def _region(self, index:int, after:bool=True) -> tuple[int,int]:
+        """
+        Return the byte range between the table of an ionic step and the
+        next table (after) or the previous table (before).
+        """
+        index = range(len(self.offsets))[index]
+        if after:
+            stop = self.offsets[index+1] if index+1 < len(self.offsets) else len(self._map)
+            return int(self.offsets[index]), int(stop)
+        return (int(self.offsets[index-1]) if index > 0 else 0), int(self.offsets[index])
+
+    def _find_line(self, marker:bytes, index:int, after:bool=True) -> str:
+        """
+        Return the line containing the marker nearest to the table of an ionic step.
+        """
+        start, stop = self._region(index, after)
+        found = self._map.find(marker, start, stop) if after\
+            else self._map.rfind(marker, start, stop)
+        if found < 0:
+            return None
+        begin = self._map.rfind(b'\n', 0, found) + 1
+        return self._map[begin:self._map.find(b'\n', found)].decode()
+
+    def positions(self, index:int) -> np.array:
+        """
+        Return the cartesian positions of an ionic step.
+        """
+        return self._table(index)[:,0:3].copy()
+
+    def forces(self, index:int) -> np.array:
+        """
+        Return the total forces on each ion of an ionic step.
+        """
+        return self._table(index)[:,3:6].copy()
+
+    def energy(self, index:int) -> dict:
+        """
+        Return the energies of an ionic step in eV.
+        """
+        energies = {}
+        line = self._find_line(b'free  energy   TOTEN', index)
+        if line is not None:
+            energies['free_energy'] = float(line.split('=')[1].split()[0])
+        line = self._find_line(b'energy  without entropy', index)
+        if line is not None:
+            values = line.split('=')
+            energies['energy_without_entropy'] = float(values[1].split()[0])
+            energies['energy_sigma_0'] = float(values[2].split()[0])
+        return energies
+
+    def stress(self, index:int) -> np.array:
+        """
+        Return the stress of an ionic step in kB, or None if it was not computed.
+        """
+        line = self._find_line(b'  in kB', index, after=False)
+        if line is None:
+            return None
+        return np.array(line.split()[2:8], dtype=float)
+
+    def timing(self, index:int) -> dict:
+        """
+        Return the cpu and real time in seconds of the ionic loop of a step.
+        """
+        line = self._find_line(b'LOOP+:', index)
+        if line is None:
+            return None
+        values = re.findall(r'(cpu|real) time\s*([0-9.]+)', line)
+        return { key:float(value) for key, value in values }
+
+# Class for the ionic step summaries of an OSZICAR
+class Oszicar(object):
+    """
+    Ionic step summary lines of an OSZICAR, such as
+        1 F= -.10E+02 E0= -.10E+02  d E =-.10E+02
+        1 T=   300. E= -.10E+02 F= -.10E+02 E0= -.10E+02  EK= 0.1E+00 ...
+    read incrementally: refresh parses only the bytes appended since the
+    previous call, so following a running job never rereads the file.
+    """
+    def __init__(self, file:str='OSZICAR'):
+        self.path = Path(file)
+        self._reset()
+        self.refresh()
+
+    def _reset(self) -> None:
+        self.steps = []
+        self.values = []
+        self._offset = 0
+        self._partial = b''
+
+    def __len__(self):
+        return len(self.steps)
+
+    @phase('parse')
+    def refresh(self) -> int:
+        """
+        Parse any newly appended lines and return the number of new ionic steps.
+        A file that shrinks (a restarted job) is read again from the start.
+        """
+        size = self.path.stat().st_size
+        if size < self._offset:
+            self._reset()
+        if size == self._offset:
+            return 0
+        with self.path.open('rb') as f:
+            f.seek(self._offset)
+            data = self._partial + f.read(size - self._offset)
+        count_read(size - self._offset)
+        self._offset = size
+
+        # Hold back an incomplete final line until the rest is written
+        complete = data.rfind(b'\n') + 1
+        self._partial = data[complete:]
+        count = len(self.steps)
+        for match in _OSZICAR_STEP.finditer(data[:complete]):
+            pairs = _OSZICAR_PAIR.findall(match.group(2).decode())
+            self.steps.append(int(match.group(1)))
+            self.values.append({ key.replace(' ',''):float(value) for key, value in pairs })
+        return len(self.steps) - count
+
+    def __getitem__(self, key:str) -> np.array:
         """
-        Remove the ions provided in the list according to index.
+        Return one quantity (e.g. 'F', 'E0', 'T') of every ionic step, NaN where absent.
         """
-        for i in ions.indices:
-            self.ions.pop(i)
-        self._reconcile_ions()
\ No newline at end of file
+        return np.array([ v.get(key, np.nan) for v in self.values ], dtype=float)
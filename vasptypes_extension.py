@@ -1,107 +1,316 @@
-from vasptypes import Poscar, Ions
+from vasptypes import Poscar, Ions, NeighborIndex, Selection, transform_positions
+from profiling import phase
 import numpy as np
-from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import warnings
 
 def translate(ions:Ions, r=np.array(float)) -> Ions:
     """
     Translate the given selection along the x, y, or z dimension.
+    Returns detached copies of the ions with the same indices.
     """
-    ions_t = deepcopy(ions)
-    for i,_ in zip(ions.indices, ions):
-        ions_t[i].position += r
+    positions = np.array([ ion.position for ion in ions ], dtype=float).reshape(-1,3) + r
+    ions_t = Ions([ ion.detach() for ion in ions ], list(ions.indices))
+    for ion, position in zip(ions_t, positions):
+        ion.position = position
     return ions_t
 
+def positions_in_mode(poscar:Poscar, mode:str=None) -> np.array:
+    """
+    Return the ion positions in the given mode without converting the POSCAR.
+    """
+    mode = poscar.mode if mode is None else mode
+    if mode[0].lower() == poscar.mode[0].lower():
+        return poscar.positions
+    A = poscar.lattice.transpose()
+    if mode[0].lower() == 'd':
+        return transform_positions(poscar.positions, np.linalg.inv(A))
+    return transform_positions(poscar.positions, A)
+
+@phase('select')
+def box_selection(poscar:Poscar, x_range:list[float]=None, y_range:list[float]=None,\
+                  z_range:list[float]=None, mode:str=None) -> Selection:
+    """
+    Select ions whose coordinates lie within the given (inclusive) ranges.
+    Ranges are in the given mode, which defaults to the mode of the POSCAR.
+    """
+    positions = positions_in_mode(poscar, mode)
+    mask = np.ones(len(positions), dtype=bool)
+    for axis, limits in enumerate((x_range, y_range, z_range)):
+        if limits is not None:
+            mask &= (limits[0] <= positions[:,axis]) & (positions[:,axis] <= limits[1])
+    return Selection(mask)
+
+@phase('select')
+def sphere_selection(poscar:Poscar, center:np.array, radius:float, mode:str=None) -> Selection:
+    """
+    Select ions within radius (in Angstroms) of the center, including periodic images.
+    The center is given in the provided mode, defaulting to the mode of the POSCAR.
+    """
+    mode = poscar.mode if mode is None else mode
+    index = NeighborIndex(poscar, radius)
+    members, _ = index.query(center, direct=mode[0].lower() == 'd')
+    return Selection.from_indices(members, len(poscar.positions))
+
+@phase('select')
+def cylinder_selection(poscar:Poscar, center:np.array, axis:np.array, radius:float,\
+                       mode:str=None) -> Selection:
+    """
+    Select ions within radius (in Angstroms) of the infinite line through center
+    along the cartesian axis, using the nearest periodic image of each ion.
+    The center is given in the provided mode, defaulting to the mode of the POSCAR.
+    """
+    mode = poscar.mode if mode is None else mode
+    center = np.asarray(center, dtype=float)
+    if mode[0].lower() != 'd':
+        center = center @ np.linalg.inv(poscar.lattice)
+    c = positions_in_mode(poscar, 'direct') - center
+    c = (c - np.round(c)) @ poscar.lattice
+    axis = np.asarray(axis, dtype=float) / np.linalg.norm(axis)
+    perpendicular = c - np.outer(c @ axis, axis)
+    return Selection((perpendicular**2).sum(axis=1) <= radius**2)
+
+@phase('select')
+def slab_selection(poscar:Poscar, normal:np.array, lower:float, upper:float) -> Selection:
+    """
+    Select ions between two planes with the given cartesian normal, where lower
+    and upper are distances (in Angstroms) from the origin along the normal.
+    """
+    normal = np.asarray(normal, dtype=float) / np.linalg.norm(normal)
+    height = positions_in_mode(poscar, 'cartesian') @ normal
+    return Selection((lower <= height) & (height <= upper))
+
+@phase('select')
+def species_selection(poscar:Poscar, species:list[str]) -> Selection:
+    """
+    Select all ions of the given species.
+    """
+    wanted = [ s.lower() for s in species ]
+    names = np.array([ s.lower() in wanted for s in poscar.species.keys() ], dtype=bool)
+    return Selection(names[poscar.species_indices])
+
+@phase('select')
+def index_selection(poscar:Poscar, start:int=0, stop:int=None, step:int=1) -> Selection:
+    """
+    Select ions by a range of indices, as in range(start, stop, step).
+    """
+    mask = np.zeros(len(poscar.positions), dtype=bool)
+    mask[start:stop:step] = True
+    return Selection(mask)
+
 def box_select(poscar:Poscar, x_range:list[float]=None, y_range:list[float]=None,\
                z_range:list[float]=None, mode:str=None) -> Ions:
-    # If mode was not set, grab it automatically
-    poscar_cp = deepcopy(poscar)
-    mode = poscar_cp.mode if mode is None else mode
-
-    # Convert the POSCAR to the correct mode if necessary
-    converted = False
-    if poscar_cp.mode[0].lower() != mode[0].lower():
-        poscar_cp._toggle_mode()
-        converted = True
-    
-    # Add ions that reside within box to selection list
-    selection, indices = [], []
-    for i, ion in enumerate(poscar_cp.ions):
-        if  ( x_range is None or (x_range[0] <= ion.position[0] <= x_range[1]) )\
-        and ( y_range is None or (y_range[0] <= ion.position[1] <= y_range[1]) )\
-        and ( z_range is None or (z_range[0] <= ion.position[2] <= z_range[1]) ):
-            indices.append(i)
-            selection.append(ion)
-
-    # Reconvert the POSCAR if necessary
-    if converted:
-        poscar_cp._toggle_mode()
-        
-    return Ions(selection, indices)
+    """
+    Return views of the ions that reside within the box. See box_selection.
+    """
+    return box_selection(poscar, x_range, y_range, z_range, mode).ions(poscar)
 
+@phase('transform')
 def center_around(poscar:Poscar, index:int) -> Poscar:
-    # Create a copy of the poscar
-    poscar_cp = deepcopy(poscar)
-    # Convert to direct if needed
-    converted = False
-    if poscar_cp.is_cartesian():
-        poscar_cp._convert_to_direct()
-        converted = True
-
-    # Make sure everything is "inside" the cell
-    poscar_cp._constrain()
+    """
+    Return a copy of the POSCAR with every ion moved to its periodic image
+    nearest the ion at index. Only the positions of the copy are new.
+    """
+    # Work in direct coordinates, with everything "inside" the cell
+    positions = positions_in_mode(poscar, 'direct')
+    positions = positions - np.floor(positions)
     # If something is more than 0.5*lattice vector away,
-    # either add or subtract to retrieve the appropriate image
-    for i, ion in enumerate(poscar_cp.ions):
-        c = ion.position - poscar_cp.ions[index].position
-        c = -1 * np.array(np.abs(c) > 0.5, dtype=int) * np.sign(c)
-        poscar_cp.ions[i].position += c
-    
+    # either add or subtract to retrieve the appropriate (minimum) image
+    c = positions - positions[index]
+    positions = positions - (np.abs(c) > 0.5) * np.sign(c)
+
     # Reconvert if needed
-    if converted:
-        poscar_cp._toggle_mode()
-    
-    return poscar_cp
+    if poscar.is_cartesian():
+        positions = transform_positions(positions, poscar.lattice.transpose())
 
+    return poscar.copy(positions=positions)
+
+@phase('select')
 def chain_select(poscar:Poscar, start_index:int, jump_distance:float=1.0,\
                  extent:int=np.inf, species_blacklist:list[str]=[],\
-                 index_blacklist:list[int]=[], hydrogen_termination:bool=True):
-
+                 index_blacklist:list[int]=[], hydrogen_termination:bool=True,\
+                 index:NeighborIndex=None) -> Ions:
+    """
+    Breadth first selection of ions connected to the starting ion by jumps
+    no longer than jump_distance. A neighbor index may be passed in to be
+    reused across selections on the same POSCAR.
+    """
     species_blacklist = [ s.lower() for s in species_blacklist ]
+    if index is None:
+        index = NeighborIndex(poscar, jump_distance)
+
+    # Ions that may never be added to the selection
+    names = np.array([ s.lower() for s in poscar.species.keys() ])
+    excluded = np.isin(names[poscar.species_indices], species_blacklist)
+    excluded[list(index_blacklist)] = True
+    hydrogen = names[poscar.species_indices] == 'h'
 
     # Initial quantities
-    jump_distance2 = jump_distance**2
-    selection = Ions([poscar.ions[start_index]], [start_index])
+    selected = np.zeros(len(poscar.positions), dtype=bool)
+    selected[start_index] = True
+    order = [start_index]
     jumps = [0]
 
-    # From the selected ion, find neighbors in range
+    # From each selected ion, in the order found, add neighbors in range
     first_hydrogen = True
-    for i, selected_ion, jump in zip(selection.indices, selection, jumps):
+    for i, jump in zip(order, jumps):
         if jump >= extent:
             continue
         if hydrogen_termination \
         and not( first_hydrogen ) \
-        and selected_ion.species == "H":
+        and hydrogen[i]:
             continue
-        poscar_cp = center_around(poscar, i)
-        poscar_cp._convert_to_cartesian()
-        poscar_cp_enum = enumerate(poscar_cp.ions)
-        for j, ion in poscar_cp_enum:
-            if j in selection.indices:
-                continue
-            if ion.species.lower() in species_blacklist:
-                continue
-            if j in index_blacklist:
-                continue
-            if ((poscar_cp.ions[i].position - poscar_cp.ions[j].position)**2).sum() > jump_distance2:
-                continue
-            
-            # Append a copy of the original ion
-            selection.append(poscar.ions[j])
-            selection.indices.append(j)
-            # Record how many jumps it took to get here
-            jumps.append(jump+1)
-
-        if first_hydrogen:
-            first_hydrogen = False
-
-    return selection
\ No newline at end of file
+        first_hydrogen = False
+
+        neighbors, _ = index.neighbors(i, jump_distance)
+        neighbors = neighbors[~selected[neighbors] & ~excluded[neighbors]]
+        selected[neighbors] = True
+        order.extend(neighbors.tolist())
+        # Record how many jumps it took to get here
+        jumps.extend([jump+1]*len(neighbors))
+
+    return Ions([ poscar.ions[i] for i in order ], order)
+
+@phase('transform')
+def interpolate_path(poscar1:Poscar, poscar2:Poscar, images:int=1) -> np.array:
+    """
+    Linearly interpolate images between two structures, returning the
+    (images+2, N, 3) direct positions of the path including both endpoints.
+    Each ion takes the shortest (minimum image) route to its final position,
+    and the last image matches poscar2 exactly.
+    """
+    if poscar1.species != poscar2.species:
+        raise RuntimeError('Species of the endpoints do not match!')
+    start = positions_in_mode(poscar1, 'direct')
+    end = positions_in_mode(poscar2, 'direct')
+    displacement = end - start
+    displacement = displacement - np.round(displacement)
+
+    t = np.linspace(0.0, 1.0, images+2)[:,None,None]
+    path = start[None,:,:] + t * displacement[None,:,:]
+    path[-1] = end
+    # Avoid writing rounding noise as -0.0
+    path[np.abs(path) < 1e-12] = 0.0
+    return path
+
+# Largest pair array built at once by the IDPP, in elements
+_IDPP_CHUNK = 1 << 24
+
+def _pair_vectors(positions:np.array, lattice:np.array) -> tuple[np.array, np.array]:
+    """
+    Minimum image vectors and distances between every pair of ions for a
+    stack of (M, N, 3) direct positions. The diagonal distances are set to one.
+    """
+    d = positions[:,:,None,:] - positions[:,None,:,:]
+    d -= np.rint(d)
+    vectors = d @ lattice
+    distances = np.sqrt(np.einsum('...k,...k', vectors, vectors))
+    diagonal = np.arange(positions.shape[1])
+    distances[:,diagonal,diagonal] = 1.0
+    return vectors, np.maximum(distances, 1e-6)
+
+def _idpp_forces(path:np.array, targets:np.array, lattice:np.array) -> np.array:
+    """
+    Cartesian forces of the IDPP objective sum( w(d) (d_target - d)^2 ),
+    w(d) = 1/d^4, on every ion of each intermediate image.
+    """
+    m, n = targets.shape[:2]
+    chunk = max(1, _IDPP_CHUNK // (3*n*n))
+    forces = np.empty((m, n, 3))
+    for lo in range(0, m, chunk):
+        vectors, distances = _pair_vectors(path[lo:lo+chunk], lattice)
+        error = targets[lo:lo+chunk] - distances
+        gradient = -4.0 * error**2 / distances**5 - 2.0 * error / distances**4
+        forces[lo:lo+chunk] = -np.matmul((gradient / distances)[:,:,None,:], vectors)[:,:,0,:]
+    return forces
+
+@phase('transform')
+def idpp_path(path:np.array, lattice:np.array, steps:int=100, fmax:float=0.1,
+              spring:float=5.0, max_step:float=0.2) -> tuple[np.array, int]:
+    """
+    Refine a path of direct positions with the image dependent pair potential
+    (Smidstrup et al., J. Chem. Phys. 140, 214106 (2014)). Pair distances of
+    each intermediate image are pulled towards a linear interpolation of the
+    endpoint distances by a nudged elastic band relaxed with FIRE.
+    Returns the refined path and the number of steps taken, warning if
+    the forces are still above fmax after the last step.
+    """
+    lattice = np.asarray(lattice, dtype=float)
+    inverse = np.linalg.inv(lattice)
+    _, first = _pair_vectors(path[:1], lattice)
+    _, last = _pair_vectors(path[-1:], lattice)
+    t = np.linspace(0.0, 1.0, len(path))[1:-1,None,None]
+    targets = first + t * (last - first)
+
+    # Relax the intermediate images in cartesian coordinates, endpoints fixed.
+    # Each image is unwrapped to the nearest image of the one before, so the
+    # tangents and spring lengths of an ion crossing the cell boundary are
+    # the short ones rather than nearly a whole cell.
+    jumps = np.diff(path, axis=0)
+    jumps -= np.rint(jumps)
+    x = np.concatenate([path[:1], path[:1] + np.cumsum(jumps, axis=0)]) @ lattice
+    velocity = np.zeros_like(x[1:-1])
+    dt, alpha, positive = 0.1, 0.1, 0
+    for step in range(steps):
+        forces = _idpp_forces(x[1:-1] @ inverse, targets, lattice)
+
+        # Project out the force along the path and add springs along it
+        tangent = x[2:] - x[:-2]
+        tangent /= np.linalg.norm(tangent, axis=(1,2), keepdims=True)
+        forces -= np.sum(forces*tangent, axis=(1,2), keepdims=True) * tangent
+        lengths = np.linalg.norm(np.diff(x, axis=0), axis=(1,2))
+        forces += spring * (lengths[1:] - lengths[:-1])[:,None,None] * tangent
+
+        if np.linalg.norm(forces, axis=2).max() < fmax:
+            break
+
+        # FIRE update
+        power = np.sum(forces*velocity)
+        if power > 0:
+            velocity = (1-alpha)*velocity \
+                + alpha*np.linalg.norm(velocity)/np.linalg.norm(forces)*forces
+            if positive > 5:
+                dt, alpha = min(dt*1.1, 1.0), alpha*0.99
+            positive += 1
+        else:
+            velocity[:] = 0.0
+            dt, alpha, positive = dt*0.5, 0.1, 0
+        velocity += dt*forces
+        dr = dt*velocity
+        norms = np.linalg.norm(dr, axis=2, keepdims=True)
+        dr *= np.minimum(1.0, max_step / np.maximum(norms, 1e-12))
+        x[1:-1] += dr
+    else:
+        step = steps
+        warnings.warn(f'IDPP did not converge to fmax {fmax:g} in {steps} steps')
+
+    refined = path.copy()
+    refined[1:-1] = x[1:-1] @ inverse
+    return refined, step
+
+def _write_image(poscar:Poscar, output_path:Path) -> None:
+    poscar.to_file(output_path)
+
+@phase('write')
+def write_images(template:Poscar, path:np.array, directory:str='.', workers:int=None) -> list[Path]:
+    """
+    Write each image of a path of direct positions to the numbered
+    directories 00, 01, ... NN as POSCARs based on the template, in the
+    template's mode. Images are written by a pool of worker processes.
+    """
+    outputs = [ Path(directory, str(i).zfill(2), 'POSCAR') for i in range(len(path)) ]
+    A = template.lattice.transpose()
+    poscars = []
+    for positions in path:
+        if template.is_cartesian():
+            positions = transform_positions(positions, A)
+        poscars.append(template.copy(positions=positions))
+
+    if workers == 1 or len(path) == 1:
+        for poscar, output_path in zip(poscars, outputs):
+            _write_image(poscar, output_path)
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            list(pool.map(_write_image, poscars, outputs))
+    return outputs